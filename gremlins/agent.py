@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A long-running gremlin agent that takes commands from a coordinator.
+
+The agent keeps warm state between commands: faults are evaluated once
+and cached by name, prepare() can stage firewall chains ahead of time,
+and the process table stays cached. This makes firing a fault on
+command a matter of milliseconds, which is what lets a coordinator line
+up faults across machines.
+
+The protocol is one JSON object per line in each direction. On
+connecting, the agent sends {"challenge": NONCE}. An agent started with
+a secret only takes commands once the client has answered with an auth
+request whose "hmac" is the hex HMAC-SHA256 of NONCE keyed by the
+secret; without a secret, the challenge is null and needs no answer.
+After that, every request carries an "op" and an "id", and the response
+echoes the id along with either "ok": true and op-specific fields, or
+"ok": false and an "error" string. Ops:
+
+  auth     hmac                 -> (first, when challenged)
+  ping                          -> time (agent wall clock)
+  prepare  fault                -> prepare the fault ahead of firing it
+  fire     fault [at]           -> activation; at is agent wall clock time
+  cancel   activation           -> revert an active fault now
+  active                        -> activations: [{id, fault, details, expires_in}],
+                                   firing: fire requests still in progress
+  resolve  daemons              -> pids: {daemon: [pid, ...]}
+"""
+import binascii
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import SocketServer
+import threading
+import time
+
+from gremlins import procutils, runtime
+from gremlins.clock import monotonic
+
+DEFAULT_HOST = "127.0.0.1"
+
+def is_loopback(host):
+  return host == "localhost" or host == "::1" or host.startswith("127.")
+
+def sign(secret, challenge):
+  """Return the answer to the given challenge for an agent with secret."""
+  return hmac.new(secret, challenge, hashlib.sha256).hexdigest()
+
+def read_secret(path):
+  """Read a shared secret from a file, as given to --agent-secret-file."""
+  with open(path) as f:
+    secret = f.read().strip()
+  if not secret:
+    raise ValueError("%s is empty" % path)
+  return secret
+
+def send_message(wfile, message):
+  wfile.write(json.dumps(message, separators=(",", ":")) + "\n")
+  wfile.flush()
+
+def recv_message(rfile):
+  """Read one message, or return None at end of stream."""
+  line = rfile.readline()
+  if not line:
+    return None
+  return json.loads(line)
+
+
+class Agent(object):
+  """
+  Serves the agent protocol on a TCP port.
+
+  Agents run as root, and a fault expression is arbitrary python, so an
+  agent listens on localhost unless given a secret to authenticate its
+  clients with.
+
+  @param port: port to listen on (0 picks a free one; see self.port)
+  @param namespace: dict that fault expressions are evaluated in, or None
+                    to allow only names from the registry
+  @param host: address to bind
+  @param registry: mapping of fault name -> fault, looked up before
+                   evaluating anything
+  @param secret: shared secret clients must prove they know
+  """
+  def __init__(self, port, namespace, host=DEFAULT_HOST, registry=None, secret=None):
+    if secret is None and not is_loopback(host):
+      raise ValueError("An agent listening on %r needs a secret" % host)
+    self.namespace = namespace
+    self.registry = registry
+    self.secret = secret
+    self.faults = {}
+    self.faults_lock = threading.Lock()
+    # Activations fired through this agent that are still active
+    self.fired = {}
+    # Fire requests waiting for their time or still injecting
+    self.firing = 0
+    self.runtime = runtime.current()
+    if self.runtime is None:
+      self.runtime = runtime.Runtime()
+      runtime.install(self.runtime)
+    self.server = _Server((host, port), _Handler)
+    self.server.agent = self
+    self.port = self.server.server_address[1]
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.server.serve_forever,
+                                   name="gremlin-agent")
+    self.thread.setDaemon(True)
+    self.thread.start()
+    logging.info("Gremlin agent listening on port %d" % self.port)
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+    prepared = self.faults.values()
+    if self.registry is not None:
+      prepared += self.registry.values()
+    for fault in prepared:
+      fault_unprepare = getattr(fault, "unprepare", None)
+      if fault_unprepare:
+        fault_unprepare()
+    self.runtime.shutdown()
+
+  def join(self):
+    self.thread.join()
+
+  def lookup(self, name):
+    """Return the fault for the given expression, evaluating it only once."""
+    if self.registry is not None and name in self.registry:
+      return self.registry[name]
+    if self.namespace is None:
+      raise KeyError("No fault named %s" % name)
+    with self.faults_lock:
+      fault = self.faults.get(name)
+      if fault is None:
+        fault = eval(name, dict(self.namespace))
+        if not callable(fault):
+          raise ValueError("Fault must be a callable!")
+        self.faults[name] = fault
+      return fault
+
+  def new_challenge(self):
+    """Return a challenge for a new connection, or None if not needed."""
+    if self.secret is None:
+      return None
+    return binascii.hexlify(os.urandom(16))
+
+  def authenticate(self, challenge, answer):
+    if not isinstance(answer, basestring):
+      return False
+    return hmac.compare_digest(sign(self.secret, challenge), str(answer))
+
+  def handle(self, request):
+    op = request.get("op")
+    handler = getattr(self, "op_" + str(op), None)
+    if handler is None:
+      raise Exception("Unknown op: %s" % op)
+    return handler(request)
+
+  def op_ping(self, request):
+    return {"time": time.time()}
+
+  def op_prepare(self, request):
+    fault = self.lookup(request["fault"])
+    if hasattr(fault, "prepare"):
+      fault.prepare()
+    return {}
+
+  def op_fire(self, request):
+    fault = self.lookup(request["fault"])
+    with self.faults_lock:
+      self.firing += 1
+    try:
+      at = request.get("at")
+      if at is not None:
+        # The coordinator's lead time is usually well under a second
+        delay = at - time.time()
+        if delay > 0:
+          time.sleep(delay)
+      fired_at = time.time()
+      result = fault()
+      response = {"fired_at": fired_at}
+      if isinstance(result, runtime.Activation):
+        with self.faults_lock:
+          self.fired[result.id] = result
+        result.add_done_callback(self._activation_done)
+        response["activation"] = result.id
+        response["duration"] = result.fault.duration
+      return response
+    finally:
+      with self.faults_lock:
+        self.firing -= 1
+
+  def _activation_done(self, activation):
+    with self.faults_lock:
+      self.fired.pop(activation.id, None)
+
+  def op_cancel(self, request):
+    with self.faults_lock:
+      activation = self.fired.get(request["activation"])
+    if activation is None:
+      raise Exception("No active activation %s" % request["activation"])
+    self.runtime.cancel(activation)
+    return {}
+
+  def op_active(self, request):
+    with self.faults_lock:
+      fired = sorted(self.fired.values(), key=lambda a: a.id)
+      firing = self.firing
+    now = monotonic()
+    activations = []
+    for a in fired:
+      record = {"id": a.id, "fault": repr(a.fault), "details": a.details}
+      if a.injected_mono is not None:
+        record["expires_in"] = max(0, a.fault.duration - (now - a.injected_mono))
+      activations.append(record)
+    return {"activations": activations, "firing": firing}
+
+  def op_resolve(self, request):
+    return {"pids": dict((daemon, procutils.find_jvms(daemon))
+                         for daemon in request["daemons"])}
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+  def setup(self):
+    SocketServer.StreamRequestHandler.setup(self)
+    # Commands are tiny and latency matters more than throughput
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  def handle(self):
+    agent = self.server.agent
+    challenge = agent.new_challenge()
+    send_message(self.wfile, {"challenge": challenge})
+    if challenge is not None:
+      request = recv_message(self.rfile)
+      if request is None:
+        return
+      if request.get("op") != "auth" or not agent.authenticate(challenge, request.get("hmac")):
+        logging.warn("Agent client %s failed to authenticate" % self.client_address[0])
+        send_message(self.wfile, {"ok": False, "error": "authentication failed",
+                                  "id": request.get("id")})
+        return
+      send_message(self.wfile, {"ok": True, "id": request.get("id")})
+    while True:
+      request = recv_message(self.rfile)
+      if request is None:
+        return
+      try:
+        response = agent.handle(request)
+        response["ok"] = True
+      except Exception, e:
+        logging.exception("Agent request %s failed" % repr(request))
+        response = {"ok": False, "error": repr(e)}
+      response["id"] = request.get("id")
+      send_message(self.wfile, response)
@@ -0,0 +1,599 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Backends carry out everything gremlins does to the host: running
+commands, signalling processes and looking processes and sockets up.
+
+procutils uses its SubprocessBackend by default. FakeBackend models a
+host in memory (processes, listening sockets and iptables chains), so
+profiles can run without root or a cluster, and so the cost of gremlins
+itself can be benchmarked (see gremlins.bench).
+"""
+import collections
+import copy
+import errno
+import itertools
+import os
+import re
+import signal
+import threading
+
+from gremlins import pidfd
+
+class Backend(object):
+  """
+  Base class for backends. Counts the commands executed, by program name.
+  """
+  def __init__(self):
+    self.execs_lock = threading.Lock()
+    self.execs = {}
+
+  def count_exec(self, cmdv):
+    name = os.path.basename(cmdv[0])
+    with self.execs_lock:
+      self.execs[name] = self.execs.get(name, 0) + 1
+
+  def exec_count(self):
+    """Return the total number of commands executed so far."""
+    with self.execs_lock:
+      return sum(self.execs.values())
+
+  def run(self, cmdv, input=None):
+    """Run a command, returning its output; raise if it fails."""
+    raise NotImplementedError()
+
+  def call(self, cmdv):
+    """Run a command, returning its exit code."""
+    raise NotImplementedError()
+
+  def run_batch(self, commands):
+    """
+    Run a list of (cmdv, input) commands in order, returning their
+    outputs; raise at the first that fails.
+    """
+    return [self.run(cmdv, input) for cmdv, input in commands]
+
+  def kill(self, pid, sig):
+    raise NotImplementedError()
+
+  def find_processes(self, main_class=None, cmdline_regex=None, cgroup=None, fresh=False):
+    raise NotImplementedError()
+
+  def listening_ports(self, pids):
+    """Return a dict of pid -> sorted list of listening TCP ports."""
+    raise NotImplementedError()
+
+  def listening_addresses(self, pids):
+    """Return a dict of pid -> sorted list of (address, port) listened on."""
+    raise NotImplementedError()
+
+  def ephemeral_port_range(self):
+    """Return the (low, high) range ephemeral ports are picked from."""
+    raise NotImplementedError()
+
+  def can_connect(self, address, timeout):
+    """Return True if a TCP connection to the given (host, port) succeeds."""
+    raise NotImplementedError()
+
+  def peer_connections(self, pids):
+    """
+    Return the sorted (local port, ip, port) of the connections the given
+    pids made to other servers.
+    """
+    raise NotImplementedError()
+
+  def process_uids(self, pids):
+    """Return a dict of pid -> effective uid, leaving out pids that have exited."""
+    raise NotImplementedError()
+
+  def start_time(self, pid):
+    """
+    Return the start time of the given pid, which tells it apart from a
+    later process reusing the pid; raise OSError if it has exited.
+    """
+    raise NotImplementedError()
+
+  def process_tree(self, pids):
+    """Return the given pids plus all their descendants, sorted."""
+    raise NotImplementedError()
+
+  def watch_exits(self, pids):
+    """Return a pidfd.ExitWatcher for the given pids."""
+    raise NotImplementedError()
+
+  # Control files, eg under /sys/fs/cgroup. Errors are raised as
+  # IOError or OSError with the errno the kernel would give.
+
+  def read_file(self, path):
+    raise NotImplementedError()
+
+  def write_file(self, path, data):
+    raise NotImplementedError()
+
+  def make_dir(self, path):
+    raise NotImplementedError()
+
+  def remove_dir(self, path):
+    raise NotImplementedError()
+
+
+class FakeProcess(object):
+  __slots__ = ["pid", "daemon", "main_class", "argv", "ports", "peers", "stopped", "cgroup",
+               "start_time"]
+
+  def __init__(self, pid, daemon, main_class, argv, ports, peers=(), start_time=0):
+    self.pid = pid
+    self.start_time = start_time
+    self.daemon = daemon
+    self.main_class = main_class
+    self.argv = argv
+    self.ports = ports
+    self.peers = list(peers)
+    self.stopped = False
+    self.cgroup = "/"
+
+
+class FakeCommandError(Exception):
+  pass
+
+
+BUILTIN_CHAINS = ("INPUT", "FORWARD", "OUTPUT")
+
+# The local port of a fake daemon's first connection to a peer
+FAKE_LOCAL_PORT = 40000
+
+class FakeBackend(Backend):
+  """
+  An in-memory host.
+
+  Daemons are added with add_daemon(); starting a daemon through one of
+  procutils.START_COMMANDS spawns a fresh fake process for it. run()
+  understands iptables, iptables-restore, iptables-save, ipset, tc,
+  jps and lsof, which is everything the fault hot path executes. Control files live
+  in a dict; writing a pid to a cgroup.procs file moves that process,
+  and /proc/<pid>/cgroup reports where it is.
+  """
+  def __init__(self):
+    Backend.__init__(self)
+    self.lock = threading.RLock()
+    self.pids = itertools.count(10000)
+    self.ticks = itertools.count(1)
+    self.processes = {}
+    # main class -> set of pids
+    self.by_class = {}
+    self.templates = {}
+    self.chains = self._empty_ruleset()
+    from gremlins import cgroups
+    self.files = {}
+    self.dirs = set(["/", cgroups.CGROUP_ROOT])
+    # (device, parent) -> qdisc spec, and (device, prio) -> filter specs
+    self.qdiscs = {}
+    self.filters = {}
+    # set name -> (type, set of entries)
+    self.ipsets = {}
+
+  def _empty_ruleset(self):
+    chains = collections.OrderedDict()
+    for chain in BUILTIN_CHAINS:
+      chains[chain] = []
+    return chains
+
+  # Processes
+
+  def add_daemon(self, daemon, ports=(), main_class=None, argv=None, peers=()):
+    """
+    Start a fake daemon.
+
+    @param daemon: the daemon name, as used by procutils.start_daemon
+    @param ports: TCP ports it listens on
+    @param peers: (ip, port) servers it is connected to
+    @param main_class: jps-style main class; defaults to daemon
+    @param argv: command line; defaults to a java command for main_class
+    @returns the new pid
+    """
+    main_class = main_class or daemon
+    if argv is None:
+      argv = ["java", "-Xmx1g", "-cp", "fake.jar", "org.example.%s" % main_class]
+    with self.lock:
+      self.templates[daemon] = (main_class, list(argv), list(ports), list(peers))
+      return self._spawn(daemon)
+
+  def _spawn(self, daemon):
+    main_class, argv, ports, peers = self.templates[daemon]
+    pid = next(self.pids)
+    self.processes[pid] = FakeProcess(pid, daemon, main_class, argv, list(ports), peers,
+                                      next(self.ticks))
+    self.by_class.setdefault(main_class, set()).add(pid)
+    return pid
+
+  def call(self, cmdv):
+    self.count_exec(cmdv)
+    from gremlins import procutils
+    with self.lock:
+      for daemon, cmd in procutils.START_COMMANDS.iteritems():
+        if list(cmd) == list(cmdv) and daemon in self.templates:
+          self._spawn(daemon)
+          return 0
+    return 127
+
+  def kill(self, pid, sig):
+    with self.lock:
+      proc = self.processes.get(pid)
+      if proc is None:
+        raise OSError(3, "No such process")
+      if sig == signal.SIGSTOP:
+        proc.stopped = True
+      elif sig == signal.SIGCONT:
+        proc.stopped = False
+      elif sig != 0:
+        del self.processes[pid]
+        self.by_class[proc.main_class].discard(pid)
+
+  def find_processes(self, main_class=None, cmdline_regex=None, cgroup=None, fresh=False):
+    if cmdline_regex is not None and not hasattr(cmdline_regex, "search"):
+      cmdline_regex = re.compile(cmdline_regex)
+    if cgroup is not None and not hasattr(cgroup, "search"):
+      cgroup = re.compile(cgroup)
+    with self.lock:
+      if main_class is not None:
+        procs = [self.processes[pid] for pid in self.by_class.get(main_class, ())]
+      else:
+        procs = self.processes.values()
+    pids = []
+    for proc in procs:
+      if main_class is not None and proc.main_class != main_class:
+        continue
+      if cmdline_regex is not None and not cmdline_regex.search(" ".join(proc.argv)):
+        continue
+      if cgroup is not None and not cgroup.search(proc.cgroup):
+        continue
+      pids.append(proc.pid)
+    return sorted(pids)
+
+  def listening_ports(self, pids):
+    with self.lock:
+      return dict((pid, sorted(self.processes[pid].ports) if pid in self.processes else [])
+                  for pid in pids)
+
+  def listening_addresses(self, pids):
+    # Fake daemons listen on every address
+    return dict((pid, [("0.0.0.0", port) for port in ports])
+                for pid, ports in self.listening_ports(pids).iteritems())
+
+  def ephemeral_port_range(self):
+    return (32768, 60999)
+
+  def can_connect(self, address, timeout):
+    port = address[1]
+    with self.lock:
+      return any(port in proc.ports and not proc.stopped
+                 for proc in self.processes.itervalues())
+
+  def peer_connections(self, pids):
+    # Each fake connection gets a made-up local port
+    with self.lock:
+      return sorted(set((FAKE_LOCAL_PORT + i, ip, port)
+                        for pid in pids if pid in self.processes
+                        for i, (ip, port) in enumerate(self.processes[pid].peers)))
+
+  def process_uids(self, pids):
+    with self.lock:
+      return dict((pid, 0) for pid in pids if pid in self.processes)
+
+  def start_time(self, pid):
+    with self.lock:
+      proc = self.processes.get(pid)
+      if proc is None:
+        raise OSError(errno.ESRCH, "No such process")
+      return proc.start_time
+
+  def process_tree(self, pids):
+    # Fake processes have no children
+    with self.lock:
+      return sorted(pid for pid in set(pids) if pid in self.processes)
+
+  def watch_exits(self, pids):
+    def alive(pid):
+      with self.lock:
+        return pid in self.processes
+    return pidfd.ExitWatcher(pids, alive=alive)
+
+  # Control files
+
+  def _cgroup_of_dir(self, path):
+    from gremlins import cgroups
+    return "/" + os.path.relpath(path, cgroups.CGROUP_ROOT).lstrip(".")
+
+  def read_file(self, path):
+    with self.lock:
+      m = re.search(r"/(\d+)/cgroup$", path)
+      if m:
+        proc = self.processes.get(int(m.group(1)))
+        if proc is None:
+          raise IOError(errno.ENOENT, "No such file or directory", path)
+        return "0::%s\n" % proc.cgroup
+      if os.path.basename(path) == "cgroup.procs":
+        cgroup = self._cgroup_of_dir(os.path.dirname(path))
+        return "".join("%d\n" % pid for pid, proc in sorted(self.processes.items())
+                       if proc.cgroup == cgroup)
+      if path not in self.files:
+        raise IOError(errno.ENOENT, "No such file or directory", path)
+      return self.files[path]
+
+  def write_file(self, path, data):
+    with self.lock:
+      if os.path.dirname(path) not in self.dirs:
+        raise IOError(errno.ENOENT, "No such file or directory", path)
+      if os.path.basename(path) == "cgroup.procs":
+        proc = self.processes.get(int(data))
+        if proc is None:
+          raise IOError(errno.ESRCH, "No such process", path)
+        proc.cgroup = self._cgroup_of_dir(os.path.dirname(path))
+        return
+      self.files[path] = data
+
+  def make_dir(self, path):
+    with self.lock:
+      if path in self.dirs:
+        raise OSError(errno.EEXIST, "File exists", path)
+      self.dirs.add(path)
+
+  def remove_dir(self, path):
+    with self.lock:
+      if path not in self.dirs:
+        raise OSError(errno.ENOENT, "No such file or directory", path)
+      cgroup = self._cgroup_of_dir(path)
+      if any(proc.cgroup == cgroup for proc in self.processes.itervalues()):
+        raise OSError(errno.EBUSY, "Device or resource busy", path)
+      self.dirs.discard(path)
+      for name in [name for name in self.files if os.path.dirname(name) == path]:
+        del self.files[name]
+
+  # Commands
+
+  def run(self, cmdv, input=None):
+    self.count_exec(cmdv)
+    name = os.path.basename(cmdv[0])
+    handler = getattr(self, "_run_" + name.replace("-", "_"), None)
+    if handler is None:
+      raise Exception("Fake backend cannot run %s" % name)
+    with self.lock:
+      try:
+        return handler(cmdv[1:], input)
+      except FakeCommandError, e:
+        raise Exception("Bad status code: 1 (%s)" % e)
+
+  def _run_jps(self, args, input):
+    return "".join("%d %s\n" % (proc.pid, proc.main_class)
+                   for proc in sorted(self.processes.values(), key=lambda p: p.pid))
+
+  def _run_lsof(self, args, input):
+    pid = int([arg for arg in args if arg.startswith("-p")][0][2:])
+    lines = ["COMMAND PID USER FD TYPE DEVICE SIZE/OFF NODE NAME"]
+    proc = self.processes.get(pid)
+    if proc:
+      for port in proc.ports:
+        lines.append("java %d hadoop 100u IPv4 12345 0t0 TCP *:%d (LISTEN)" % (pid, port))
+    return "\n".join(lines) + "\n"
+
+  def _run_iptables(self, args, input):
+    return self._iptables(self.chains, list(args))
+
+  def _run_iptables_restore(self, args, input):
+    if "--noflush" in args:
+      chains = copy.deepcopy(self.chains)
+    else:
+      chains = self._empty_ruleset()
+    for line in input.splitlines():
+      line = line.strip()
+      if not line or line.startswith("#") or line.startswith("*") or line == "COMMIT":
+        continue
+      if line.startswith(":"):
+        name = line[1:].split()[0]
+        # Declaring a chain creates it, or flushes it if it exists
+        chains[name] = []
+        continue
+      self._iptables(chains, line.split())
+    self.chains = chains
+    return ""
+
+  def _run_iptables_save(self, args, input):
+    lines = ["*filter"]
+    for chain in self.chains:
+      policy = chain in BUILTIN_CHAINS and "ACCEPT" or "-"
+      lines.append(":%s %s [0:0]" % (chain, policy))
+    for chain, rules in self.chains.iteritems():
+      for rule in rules:
+        lines.append("-A %s %s" % (chain, " ".join(rule)))
+    lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+  def _run_ipset(self, args, input):
+    exist = "-exist" in args
+    if "list" in args:
+      return "".join(name + "\n" for name in sorted(self.ipsets))
+    if "restore" not in args:
+      raise FakeCommandError("unsupported ipset command %s" % " ".join(args))
+    # ipset restore is not atomic: commands before a failure stick
+    for line in input.splitlines():
+      words = line.split()
+      if not words:
+        continue
+      op, name = words[0], words[1]
+      if op == "create":
+        if name in self.ipsets:
+          raise FakeCommandError("Set cannot be created: set with the same name already exists")
+        self.ipsets[name] = (words[2], set())
+        continue
+      if name not in self.ipsets:
+        raise FakeCommandError("The set with the given name does not exist")
+      entries = self.ipsets[name][1]
+      if op == "add":
+        if words[2] in entries and not exist:
+          raise FakeCommandError("Element cannot be added to the set: it's already added")
+        entries.add(words[2])
+      elif op == "del":
+        if words[2] not in entries and not exist:
+          raise FakeCommandError("Element cannot be deleted from the set: it's not added")
+        entries.discard(words[2])
+      elif op == "destroy":
+        for rules in self.chains.values():
+          for rule in rules:
+            if "--match-set" in rule and rule[rule.index("--match-set") + 1] == name:
+              raise FakeCommandError("Set cannot be destroyed: it is in use by a kernel component")
+        del self.ipsets[name]
+      else:
+        raise FakeCommandError("unsupported ipset command %s" % op)
+    return ""
+
+  def _run_tc(self, args, input):
+    args = list(args)
+    force = "-force" in args
+    if "-batch" not in args:
+      return self._tc(args) or ""
+    for line in input.splitlines():
+      if not line.strip():
+        continue
+      try:
+        self._tc(line.split())
+      except FakeCommandError:
+        if not force:
+          raise
+    return ""
+
+  def _tc(self, args):
+    kind, op = args[0], args[1]
+    device = args[args.index("dev") + 1]
+    if kind == "qdisc":
+      parent = "root" in args and "root" or args[args.index("parent") + 1]
+      key = (device, parent)
+      if op == "show":
+        spec = self.qdiscs.get(key)
+        if spec is None:
+          return "qdisc noqueue 0: dev %s root refcnt 2\n" % device
+        words = spec.split()
+        handle = words.index("handle")
+        return "qdisc %s %s dev %s root refcnt 2\n" % (words[handle + 2], words[handle + 1], device)
+      if op == "replace":
+        self._tc_clear(device)
+      elif op == "add" and key in self.qdiscs:
+        raise FakeCommandError("RTNETLINK answers: File exists")
+      elif op == "del":
+        if key not in self.qdiscs:
+          raise FakeCommandError("RTNETLINK answers: No such file or directory")
+        if parent == "root":
+          self._tc_clear(device)
+        else:
+          del self.qdiscs[key]
+        return
+      self.qdiscs[key] = " ".join(args[2:])
+    elif kind == "filter":
+      key = (device, int(args[args.index("prio") + 1]))
+      if op == "add":
+        if (device, "root") not in self.qdiscs:
+          raise FakeCommandError("Cannot find specified qdisc on specified device")
+        protocol = args[args.index("protocol") + 1]
+        for other in self.filters.get(key, ()):
+          if other.split()[other.split().index("protocol") + 1] != protocol:
+            raise FakeCommandError("RTNETLINK answers: Invalid argument")
+        self.filters.setdefault(key, []).append(" ".join(args[2:]))
+      elif op == "del":
+        if key not in self.filters:
+          raise FakeCommandError("RTNETLINK answers: No such file or directory")
+        del self.filters[key]
+    else:
+      raise FakeCommandError("unsupported tc command %s" % kind)
+
+  def _tc_clear(self, device):
+    for key in [key for key in self.qdiscs if key[0] == device]:
+      del self.qdiscs[key]
+    for key in [key for key in self.filters if key[0] == device]:
+      del self.filters[key]
+
+  def _iptables(self, chains, args):
+    # Strip flags that don't change the ruleset
+    args = [arg for arg in args if arg not in ("-n", "-w", "--numeric", "--wait")]
+    if not args:
+      raise FakeCommandError("no command")
+    op = args[0]
+    chain = len(args) > 1 and args[1] or None
+    rule = tuple(args[2:])
+
+    def need(chain):
+      if chain not in chains:
+        raise FakeCommandError("No chain/target/match by that name: %s" % chain)
+
+    if op in ("-N", "--new-chain"):
+      if chain in chains:
+        raise FakeCommandError("Chain already exists: %s" % chain)
+      chains[chain] = []
+    elif op in ("-A", "--append"):
+      need(chain)
+      if "--match-set" in rule and rule[rule.index("--match-set") + 1] not in self.ipsets:
+        raise FakeCommandError("Set %s doesn't exist" % rule[rule.index("--match-set") + 1])
+      if "-j" in rule:
+        target = rule[rule.index("-j") + 1]
+        if target not in ("ACCEPT", "DROP", "REJECT", "RETURN", "LOG"):
+          need(target)
+      chains[chain].append(rule)
+    elif op in ("-D", "--delete"):
+      need(chain)
+      if rule not in chains[chain]:
+        raise FakeCommandError("Bad rule (does a matching rule exist in that chain?)")
+      chains[chain].remove(rule)
+    elif op in ("-F", "--flush"):
+      if chain:
+        need(chain)
+        chains[chain] = []
+      else:
+        for name in chains:
+          chains[name] = []
+    elif op in ("-X", "--delete-chain"):
+      need(chain)
+      if chains[chain]:
+        raise FakeCommandError("Directory not empty: %s" % chain)
+      for rules in chains.values():
+        for other in rules:
+          if "-j" in other and other[other.index("-j") + 1] == chain:
+            raise FakeCommandError("Too many links: %s" % chain)
+      del chains[chain]
+    elif op in ("-L", "--list"):
+      names = chain and [chain] or list(chains)
+      lines = []
+      for name in names:
+        need(name)
+        policy = name in BUILTIN_CHAINS and "(policy ACCEPT)" or "(0 references)"
+        lines.append("Chain %s %s" % (name, policy))
+        lines.append("target     prot opt source               destination")
+        for rule in chains[name]:
+          target = "-j" in rule and rule[rule.index("-j") + 1] or ""
+          lines.append("%-10s all  --  anywhere             anywhere" % target)
+        lines.append("")
+      return "\n".join(lines) + "\n"
+    elif op in ("-S", "--list-rules"):
+      lines = []
+      for name, rules in chains.iteritems():
+        if chain and name != chain:
+          continue
+        lines.append(name in BUILTIN_CHAINS and "-P %s ACCEPT" % name or "-N %s" % name)
+        for rule in rules:
+          lines.append("-A %s %s" % (name, " ".join(rule)))
+      return "\n".join(lines) + "\n"
+    else:
+      raise FakeCommandError("unsupported iptables command %s" % op)
+    return ""
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A memory balloon: anonymous memory taken from the host in chunks, to
+squeeze the page cache or push the host into swap.
+
+Each chunk is an anonymous mmap, touched with a single memset so every
+page is really allocated, and optionally mlocked so it cannot be
+swapped out itself. Chunks are added at a fixed ramp rate until the
+target is reached, and freed with munmap, all at once, when the balloon
+is deflated.
+
+The balloon never takes the host below a floor of MemAvailable (from
+/proc/meminfo): it stops inflating once the next chunk would cross it,
+and while held it gives chunks back if something else pushes the host
+below it. The OOM killer should never need to step in.
+"""
+import ctypes
+import logging
+import mmap
+import os
+import threading
+
+from gremlins import procfs
+from gremlins.clock import monotonic
+
+# How often a held balloon checks MemAvailable against the floor
+CHECK_INTERVAL = 0.5
+
+# Default floor: this fraction of MemTotal, but at least MIN_FLOOR
+FLOOR_FRACTION = 0.05
+MIN_FLOOR = 256 << 20
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_mlock = _libc.mlock
+_mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_mlock.restype = ctypes.c_int
+
+def default_floor():
+  """Return the default floor of MemAvailable, in bytes."""
+  return max(MIN_FLOOR, int(procfs.meminfo()["MemTotal"] * FLOOR_FRACTION))
+
+def available():
+  """Return the host's MemAvailable, in bytes."""
+  info = procfs.meminfo()
+  if "MemAvailable" in info:
+    return info["MemAvailable"]
+  # Kernels before 3.14 have no MemAvailable
+  return info["MemFree"] + info.get("Cached", 0)
+
+
+class _Chunk(object):
+  def __init__(self, size, lock):
+    self.size = size
+    self.map = mmap.mmap(-1, size, mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+    self.view = ctypes.c_char.from_buffer(self.map)
+    address = ctypes.addressof(self.view)
+    # Writing (not reading) makes the kernel back each page with real
+    # memory rather than the shared zero page; memset releases the GIL
+    ctypes.memset(address, 0x5a, size)
+    self.locked = False
+    if lock:
+      if _mlock(address, size) == 0:
+        self.locked = True
+      else:
+        err = ctypes.get_errno()
+        logging.warn("Could not mlock balloon memory: %s" % os.strerror(err))
+
+  def free(self):
+    del self.view
+    # munmap also drops any mlock
+    self.map.close()
+
+
+class Balloon(object):
+  """
+  @param target: bytes to take from the host
+  @param ramp_rate: bytes per second to inflate at, or None for as fast
+                    as possible
+  @param chunk_size: bytes to allocate (and lock) at a time
+  @param lock: mlock the memory, so it cannot be swapped out
+  @param floor: bytes of MemAvailable to always leave the host; by
+                default 5% of MemTotal, and at least 256MB
+  """
+  def __init__(self, target, ramp_rate=None, chunk_size=64 << 20, lock=False, floor=None):
+    page = mmap.PAGESIZE
+    self.target = int(target)
+    self.ramp_rate = ramp_rate
+    self.chunk_size = max(page, int(chunk_size) // page * page)
+    self.lock = lock
+    self.floor = floor
+    self.chunks = []
+    self.chunks_lock = threading.Lock()
+    self.stop_event = threading.Event()
+    self.thread = None
+    self.stopped_at_floor = False
+    self.released = 0
+    self.ramp_seconds = None
+
+  def start(self):
+    if self.floor is None:
+      self.floor = default_floor()
+    self.thread = threading.Thread(target=self._run, name="gremlin-balloon")
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def _run(self):
+    try:
+      self._inflate()
+      self._hold()
+    except Exception:
+      logging.exception("Balloon failed")
+
+  def _inflate(self):
+    start = monotonic()
+    inflated = 0
+    while inflated < self.target and not self.stop_event.isSet():
+      size = min(self.chunk_size, self.target - inflated)
+      if available() - size < self.floor:
+        logging.warn("Balloon stopped at %dMB: MemAvailable is near the %dMB floor" %
+                     (inflated >> 20, self.floor >> 20))
+        self.stopped_at_floor = True
+        break
+      chunk = _Chunk(size, self.lock)
+      with self.chunks_lock:
+        self.chunks.append(chunk)
+      inflated += size
+      if self.ramp_rate:
+        delay = start + float(inflated) / self.ramp_rate - monotonic()
+        if delay > 0:
+          self.stop_event.wait(delay)
+    self.ramp_seconds = monotonic() - start
+
+  def _hold(self):
+    while not self.stop_event.wait(CHECK_INTERVAL):
+      # Give memory back, a chunk at a time, while the host is below the floor
+      while available() < self.floor:
+        with self.chunks_lock:
+          if not self.chunks:
+            break
+          chunk = self.chunks.pop()
+        chunk.free()
+        self.released += chunk.size
+        logging.warn("Host below the %dMB MemAvailable floor: released %dMB of balloon" %
+                     (self.floor >> 20, chunk.size >> 20))
+
+  def stop(self):
+    """Deflate the balloon, returning a summary for the fault's details."""
+    self.stop_event.set()
+    if self.thread is not None:
+      self.thread.join()
+    with self.chunks_lock:
+      chunks, self.chunks = self.chunks, []
+    held = sum(chunk.size for chunk in chunks)
+    locked = sum(chunk.size for chunk in chunks if chunk.locked)
+    for chunk in chunks:
+      chunk.free()
+    summary = {"target_mb": self.target >> 20, "held_mb": held >> 20,
+               "locked_mb": locked >> 20, "released_mb": self.released >> 20,
+               "floor_mb": self.floor >> 20, "stopped_at_floor": self.stopped_at_floor,
+               "ramp_seconds": None}
+    if self.ramp_seconds is not None:
+      summary["ramp_seconds"] = round(self.ramp_seconds, 3)
+    return summary
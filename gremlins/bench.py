@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Microbenchmarks for the operations gremlins runs on the fault hot path.
+
+  $ python -m gremlins.bench [-n ITERATIONS] [pid ...]
+  $ python -m gremlins.bench --fake 100 --fake 10000
+  $ python -m gremlins.bench --exec [--ballast-mb MB]
+
+With no pids, benchmarks port lookups against every process on the
+host. With --fake, benchmarks the fault hot path against an in-memory
+host with the given number of daemons, each listening on one port, and
+reports how many commands each operation would have executed. With
+--exec, compares forking a command from gremlins with running it in the
+executor's helper, optionally with gremlins holding MB of memory.
+"""
+import logging
+import time
+from optparse import OptionParser
+
+from gremlins import backends, faults, iptables, procfs, procutils
+
+def timeit(fn, iterations):
+  """Run fn the given number of times, returning the mean seconds per call."""
+  start = time.time()
+  for i in xrange(iterations):
+    fn()
+  return (time.time() - start) / iterations
+
+def report(name, seconds):
+  print "%-40s %10.3f ms" % (name, seconds * 1000)
+
+def bench_listening_ports(pids, iterations):
+  """Compare the /proc socket index against running lsof once per pid."""
+  report("listening ports, /proc, %d pids" % len(pids),
+         timeit(lambda: procutils.get_listening_ports_many(pids), iterations))
+  def lsof():
+    for pid in pids:
+      try:
+        procutils._get_listening_ports_lsof(pid)
+      except Exception:
+        # lsof exits nonzero for pids without tcp sockets
+        pass
+  report("listening ports, lsof, %d pids" % len(pids),
+         timeit(lsof, iterations))
+
+def bench_exec(iterations, ballast_mb=0):
+  """Compare running a command per fork against the executor helper."""
+  # Touched, so that fork has page tables to copy
+  ballast = bytearray(ballast_mb << 20)
+  for i in xrange(0, len(ballast), 4096):
+    ballast[i] = 1
+  subprocess_backend = procutils.SubprocessBackend()
+  executor_backend = procutils.ExecutorBackend()
+  try:
+    # Start the helper outside the timings
+    executor_backend.run(["true"])
+    report("run true, fork (%dMB resident)" % ballast_mb,
+           timeit(lambda: subprocess_backend.run(["true"]), iterations))
+    report("run true, executor",
+           timeit(lambda: executor_backend.run(["true"]), iterations))
+    report("run true x10, executor batch",
+           timeit(lambda: executor_backend.run_batch([(["true"], None)] * 10), iterations))
+  finally:
+    executor_backend.close()
+
+def bench_fake(n, iterations):
+  """Benchmark the fault hot path against a fake host with n daemons."""
+  backend = backends.FakeBackend()
+  daemons = []
+  for i in xrange(n):
+    daemon = "FakeDaemon%d" % i
+    backend.add_daemon(daemon, ports=[20000 + i])
+    daemons.append(daemon)
+  previous = procutils.set_backend(backend)
+  try:
+    pids = procutils.find_processes(cmdline_regex="FakeDaemon")
+    ports = [20000 + i for i in xrange(n)]
+
+    def install_remove_drop_chain():
+      chain = iptables.install_gremlin_chain(ports)
+      iptables.uninstall_gremlin_chains(input_chains=[chain])
+
+    def install_remove_network_failure():
+      chains = iptables.install_gremlin_network_failure("bastion")
+      iptables.uninstall_gremlin_chains([chains[0]], [chains[1]])
+
+    def remove_gremlin_chains():
+      for i in xrange(10):
+        iptables.install_gremlin_chain(ports[:10])
+      iptables.remove_gremlin_chains()
+
+    drop = faults.drop_packets_to_daemons(daemons, 0)
+    pause = faults.pause_daemons(daemons, 0)
+
+    benchmarks = [
+      ("find_jvm", lambda: procutils.find_jvm(daemons[-1])),
+      ("get_listening_ports_many", lambda: procutils.get_listening_ports_many(pids)),
+      ("install+remove drop chain", install_remove_drop_chain),
+      ("install+remove network failure", install_remove_network_failure),
+      ("remove_gremlin_chains (10 chains)", remove_gremlin_chains),
+      ("drop_packets_to_daemons fault", drop),
+      ("pause_daemons fault", pause),
+    ]
+    print "%d fake daemons" % n
+    for name, fn in benchmarks:
+      execs = backend.exec_count()
+      seconds = timeit(fn, iterations)
+      per_op = float(backend.exec_count() - execs) / iterations
+      print "  %-40s %10.3f ms %8.1f execs" % (name, seconds * 1000, per_op)
+  finally:
+    procutils.set_backend(previous)
+
+def main():
+  parser = OptionParser(usage="%prog [options] [pid ...]")
+  parser.add_option("-n", "--iterations", dest="iterations", type="int",
+    default=10, help="iterations per benchmark")
+  parser.add_option("--fake", dest="fake", type="int", action="append",
+    help="benchmark against a fake host with N daemons", metavar="N")
+  parser.add_option("--exec", dest="exec_", action="store_true",
+    help="benchmark running commands by fork and through the executor")
+  parser.add_option("--ballast-mb", dest="ballast_mb", type="int", default=0,
+    help="with --exec, hold this much memory while forking", metavar="MB")
+  (options, args) = parser.parse_args()
+
+  # Faults log every step; keep that out of the timings
+  logging.basicConfig(level=logging.ERROR)
+
+  if options.fake:
+    for n in options.fake:
+      bench_fake(n, options.iterations)
+    return
+  if options.exec_:
+    bench_exec(options.iterations, options.ballast_mb)
+    return
+
+  pids = [int(arg) for arg in args] or procfs.list_pids()
+  bench_listening_ports(pids, options.iterations)
+
+if __name__ == "__main__":
+  main()
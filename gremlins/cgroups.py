@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers for cgroup v2, used by the resource degradation faults.
+
+Faults create a transient cgroup under CGROUP_ROOT/gremlins, set its
+limits, then move a daemon's whole process tree into it. On revert each
+process goes back to the cgroup it came from and the transient cgroup
+is removed. All file access goes through the procutils backend.
+"""
+import errno
+import logging
+import os
+import re
+import stat
+
+from gremlins import procfs, procutils
+
+CGROUP_ROOT = os.getenv("CGROUP_ROOT", "/sys/fs/cgroup")
+
+# Transient cgroups are created under this one
+PARENT = "gremlins"
+
+# The controller each limit file needs enabled in the parent cgroup
+CONTROLLERS = {
+  "cpu.max": "cpu",
+  "cpu.weight": "cpu",
+  "memory.high": "memory",
+  "memory.max": "memory",
+  "io.max": "io",
+  "cgroup.freeze": None,
+}
+
+def path(cgroup, filename=None):
+  """Return the filesystem path of a cgroup (or one of its files)."""
+  result = CGROUP_ROOT + cgroup.rstrip("/")
+  if filename:
+    result += "/" + filename
+  return result
+
+def cgroup_of(pid):
+  """Return the cgroup v2 path of the given pid, eg /system.slice/hbase.service."""
+  data = procutils.get_backend().read_file("%s/%d/cgroup" % (procfs.PROC, pid))
+  for line in data.splitlines():
+    if line.startswith("0::"):
+      return line[3:]
+  raise Exception("pid %d is not in a cgroup v2 hierarchy" % pid)
+
+def procs(cgroup):
+  """Return the pids in the given cgroup."""
+  data = procutils.get_backend().read_file(path(cgroup, "cgroup.procs"))
+  return [int(line) for line in data.split()]
+
+def new_name():
+  """Return a fresh name for a transient cgroup (see procutils.new_name)."""
+  return procutils.new_name()
+
+def write(cgroup, filename, value):
+  procutils.get_backend().write_file(path(cgroup, filename), str(value))
+
+def move(pid, cgroup):
+  write(cgroup, "cgroup.procs", pid)
+
+def _enable_controllers(cgroup, controllers):
+  backend = procutils.get_backend()
+  for controller in controllers:
+    try:
+      backend.write_file(path(cgroup, "cgroup.subtree_control"), "+" + controller)
+    except (IOError, OSError), e:
+      logging.warn("Could not enable the %s controller under %s: %s" %
+                   (controller, cgroup or "/", e))
+
+def create(name, settings):
+  """
+  Create a transient cgroup under PARENT with the given limits.
+
+  @param name: name of the new cgroup
+  @param settings: dict of limit file -> value, eg {"cpu.max": "10000 100000"}
+  @returns the new cgroup's path, relative to CGROUP_ROOT
+  """
+  backend = procutils.get_backend()
+  parent = "/" + PARENT
+  try:
+    backend.make_dir(path(parent))
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+  controllers = sorted(set(CONTROLLERS.get(filename) for filename in settings) - set([None]))
+  _enable_controllers("", controllers)
+  _enable_controllers(parent, controllers)
+  cgroup = "%s/%s" % (parent, name)
+  backend.make_dir(path(cgroup))
+  for filename, value in sorted(settings.iteritems()):
+    write(cgroup, filename, value)
+  return cgroup
+
+def remove(cgroup):
+  procutils.get_backend().remove_dir(path(cgroup))
+
+def device_number(device):
+  """
+  Return the "MAJOR:MINOR" number io.max wants for a block device.
+
+  @param device: a "MAJOR:MINOR" string, a block device such as
+                 /dev/sda, or any path on the filesystem to throttle, in
+                 which case the disk holding it is used
+  """
+  if re.match(r"^\d+:\d+$", device):
+    return device
+  st = os.stat(device)
+  if stat.S_ISBLK(st.st_mode):
+    dev = st.st_rdev
+  else:
+    dev = st.st_dev
+  number = "%d:%d" % (os.major(dev), os.minor(dev))
+  # io.max only accepts whole disks, not partitions
+  sysfs = "/sys/dev/block/" + number
+  if os.path.exists(sysfs + "/partition"):
+    f = open(os.path.join(os.path.realpath(sysfs), "..", "dev"))
+    try:
+      number = f.read().strip()
+    finally:
+      f.close()
+  return number
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A monotonic clock, which python 2 does not provide out of the box.
+
+Timing and scheduling should use monotonic() so that NTP steps or an
+operator changing the date do not stretch or collapse intervals.
+"""
+import ctypes
+import os
+import time
+
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+  _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _libc_monotonic():
+  # The symbols already loaded into python, which include libc's;
+  # ctypes.util.find_library forks ldconfig (or gcc) to find libc
+  libc = ctypes.CDLL(None, use_errno=True)
+  clock_gettime = libc.clock_gettime
+  clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+  def monotonic():
+    ts = _timespec()
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+  return monotonic
+
+if hasattr(time, "monotonic"):
+  monotonic = time.monotonic
+else:
+  monotonic = _libc_monotonic()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+An HTTP API for firing faults on demand, eg from a test harness.
+
+Requests are served on their own threads, and a fault is never run
+inside a request: firing one queues a job on the scheduler's worker
+pool and returns its id straight away. Responses are JSON.
+
+  POST /faults        fault=EXPR  -> 202 {"job": id, "status": "queued"}
+  GET  /jobs                      -> {"jobs": [job, ...]}
+  GET  /jobs/ID                   -> job
+  POST /jobs/ID/cancel            -> job; reverts the fault if active
+  GET  /active                    -> {"activations": [...]}
+
+The fault is a name from the server's registry (eg of a declarative
+profile) or a python expression. It can be posted as a form field
+(urlencoded or multipart) or as a JSON object {"fault": EXPR}. A job's
+status goes queued, running, then active while the fault is injected
+(for Fault objects fired under a runtime), and ends as reverted, done,
+failed or cancelled.
+
+The server listens on localhost unless it is given a secret, or only
+takes registry names: a fault expression is arbitrary python. With a
+secret, every request must carry an X-Gremlin-Signature header holding
+sign_request() of the request, the hex HMAC-SHA256 of its method, path
+and body keyed by the secret.
+"""
+import BaseHTTPServer
+import cgi
+import collections
+import hmac
+import itertools
+import json
+import logging
+import re
+import SocketServer
+import StringIO
+import threading
+import urlparse
+
+from gremlins import runtime, scheduler
+from gremlins.agent import DEFAULT_HOST, is_loopback, sign
+
+SIGNATURE_HEADER = "X-Gremlin-Signature"
+
+# Finished jobs are forgotten, oldest first, beyond this many
+MAX_JOBS = 10000
+
+FINISHED = ("reverted", "done", "failed", "cancelled")
+
+def sign_request(secret, method, path, body=""):
+  """Return the X-Gremlin-Signature of a request to a server with secret."""
+  return sign(secret, "%s %s\n%s" % (method, path, body))
+
+class Job(object):
+  """One request to fire a fault."""
+  _ids = itertools.count(1)
+
+  def __init__(self, expression):
+    self.id = next(Job._ids)
+    self.expression = expression
+    self.status = "queued"
+    self.activation = None
+    self.error = None
+
+  def record(self):
+    record = {"job": self.id, "fault": self.expression, "status": self.status,
+              "error": self.error}
+    if self.activation is not None:
+      record["activation"] = self.activation.id
+      record["details"] = self.activation.details
+    return record
+
+
+class ControlServer(object):
+  """
+  Serves the control API on a TCP port.
+
+  Posted expressions are evaluated, so a server that does so only
+  listens on localhost unless given a secret to authenticate requests.
+
+  @param port: port to listen on (0 picks a free one; see self.port)
+  @param namespace: dict that fault expressions are evaluated in, or None
+                    to allow only names from the registry
+  @param host: address to bind
+  @param sched: scheduler whose workers run the faults
+  @param registry: mapping of fault name -> fault, looked up before
+                   evaluating anything
+  @param secret: shared secret requests must be signed with
+  """
+  def __init__(self, port, namespace, host=DEFAULT_HOST, sched=None, registry=None,
+               secret=None):
+    if secret is None and namespace is not None and not is_loopback(host):
+      raise ValueError("A control server evaluating faults on %r needs a secret" % host)
+    self.namespace = namespace
+    self.registry = registry
+    self.secret = secret
+    self.scheduler = sched
+    self.faults = {}
+    self.lock = threading.Lock()
+    self.jobs = collections.OrderedDict()
+    self.server = _Server((host, port), _Handler)
+    self.server.control = self
+    self.port = self.server.server_address[1]
+    self.thread = None
+
+  def start(self):
+    if self.scheduler is None:
+      self.scheduler = scheduler.get_default()
+    self.thread = threading.Thread(target=self.server.serve_forever,
+                                   name="gremlin-control")
+    self.thread.setDaemon(True)
+    self.thread.start()
+    logging.info("Gremlin control API listening on port %d" % self.port)
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def join(self):
+    if self.thread:
+      self.thread.join()
+
+  def authenticate(self, method, path, body, signature):
+    if self.secret is None:
+      return True
+    if not signature:
+      return False
+    return hmac.compare_digest(sign_request(self.secret, method, path, body),
+                               str(signature))
+
+  def lookup(self, expression):
+    """Return the fault for the given expression, evaluating it only once."""
+    if self.registry is not None and expression in self.registry:
+      return self.registry[expression]
+    if self.namespace is None:
+      raise KeyError("No fault named %s" % expression)
+    with self.lock:
+      fault = self.faults.get(expression)
+    if fault is None:
+      fault = eval(expression, dict(self.namespace))
+      if not callable(fault):
+        raise ValueError("Fault must be a callable!")
+      with self.lock:
+        self.faults[expression] = fault
+    return fault
+
+  # Jobs
+
+  def submit(self, expression):
+    """Queue a fault to be fired, returning its Job."""
+    fault = self.lookup(expression)
+    job = Job(expression)
+    with self.lock:
+      self.jobs[job.id] = job
+      self._expire()
+    self.scheduler.submit(lambda: self._run(job, fault))
+    return job
+
+  def _expire(self):
+    excess = len(self.jobs) - MAX_JOBS
+    if excess <= 0:
+      return
+    for job_id, job in self.jobs.items():
+      if excess <= 0:
+        break
+      if job.status in FINISHED:
+        del self.jobs[job_id]
+        excess -= 1
+
+  def _run(self, job, fault):
+    with self.lock:
+      if job.status == "cancelled":
+        return
+      job.status = "running"
+    logging.info("Control job %d firing %s" % (job.id, job.expression))
+    try:
+      with runtime.trigger_path("control(job %d)" % job.id):
+        result = fault()
+    except Exception, e:
+      logging.exception("Control job %d failed" % job.id)
+      with self.lock:
+        job.status = "failed"
+        job.error = repr(e)
+      return
+    if isinstance(result, runtime.Activation):
+      with self.lock:
+        job.activation = result
+        if job.status == "running":
+          job.status = "active"
+      result.add_done_callback(lambda activation: self._activation_done(job))
+    else:
+      with self.lock:
+        if job.status == "running":
+          job.status = "done"
+
+  def _activation_done(self, job):
+    with self.lock:
+      if job.activation.error:
+        job.status = "failed"
+        job.error = job.activation.error
+      elif job.status != "cancelled":
+        job.status = "reverted"
+
+  def get(self, job_id):
+    with self.lock:
+      job = self.jobs.get(job_id)
+      if job is None:
+        return None
+      return job.record()
+
+  def list(self):
+    with self.lock:
+      return [job.record() for job in self.jobs.values()]
+
+  def cancel(self, job_id):
+    """
+    Cancel a job: a queued one never runs, and an active one is reverted
+    now. Returns the job's record, or None if there is no such job.
+    """
+    with self.lock:
+      job = self.jobs.get(job_id)
+      if job is None:
+        return None
+      activation = job.activation
+      if job.status in ("queued", "active"):
+        job.status = "cancelled"
+    fault_runtime = runtime.current()
+    if activation is not None and fault_runtime is not None:
+      fault_runtime.cancel(activation)
+    return self.get(job_id)
+
+  def active(self):
+    fault_runtime = runtime.current()
+    if fault_runtime is None:
+      return []
+    return [{"id": a.id, "fault": repr(a.fault), "path": list(a.path),
+             "details": a.details} for a in fault_runtime.active()]
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  # The default listen backlog of 5 drops connections when a test
+  # harness opens hundreds at once
+  request_queue_size = 1024
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  # Keep-alive, so a harness can reuse its connections
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    logging.debug("control: " + format % args)
+
+  def send_json(self, code, body):
+    data = json.dumps(body) + "\n"
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def read_body(self):
+    return self.rfile.read(int(self.headers.getheader("Content-Length") or 0))
+
+  def authenticate(self, body=""):
+    """Check the request's signature, replying 401 if it is wrong."""
+    signature = self.headers.getheader(SIGNATURE_HEADER)
+    if self.server.control.authenticate(self.command, self.path, body, signature):
+      return True
+    self.send_json(401, {"error": "Bad or missing %s" % SIGNATURE_HEADER})
+    return False
+
+  def read_fault(self, body):
+    ctype, pdict = cgi.parse_header(self.headers.getheader("Content-Type") or "")
+    if ctype == "multipart/form-data":
+      return cgi.parse_multipart(StringIO.StringIO(body), pdict).get("fault", [None])[0]
+    if ctype == "application/json":
+      return json.loads(body).get("fault")
+    return urlparse.parse_qs(body).get("fault", [None])[0]
+
+  def do_GET(self):
+    control = self.server.control
+    if not self.authenticate():
+      return
+    path = urlparse.urlparse(self.path).path.rstrip("/")
+    m = re.match(r"^/jobs/(\d+)$", path)
+    if path == "/jobs":
+      self.send_json(200, {"jobs": control.list()})
+    elif m:
+      self.reply_job(control.get(int(m.group(1))))
+    elif path == "/active":
+      self.send_json(200, {"activations": control.active()})
+    else:
+      self.send_json(404, {"error": "No such resource %s" % path})
+
+  def do_POST(self):
+    control = self.server.control
+    # Read the whole body, which is signed, and lets the connection be reused
+    body = self.read_body()
+    if not self.authenticate(body):
+      return
+    path = urlparse.urlparse(self.path).path.rstrip("/")
+    m = re.match(r"^/jobs/(\d+)/cancel$", path)
+    if m:
+      self.reply_job(control.cancel(int(m.group(1))))
+    elif path in ("", "/faults"):
+      try:
+        expression = self.read_fault(body)
+        if not expression:
+          self.send_json(400, {"error": "Must post fault="})
+          return
+        job = control.submit(expression)
+      except Exception, e:
+        self.send_json(400, {"error": repr(e)})
+        return
+      self.send_json(202, job.record())
+    else:
+      self.send_json(404, {"error": "No such resource %s" % path})
+
+  def reply_job(self, record):
+    if record is None:
+      self.send_json(404, {"error": "No such job"})
+    else:
+      self.send_json(200, record)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Drives many gremlin agents (see gremlins.agent) from one place.
+
+For example, to kill three RegionServers at the same instant:
+
+  coord = Coordinator(["rs1:7777", "rs2:7777", "rs3:7777"])
+  coord.sync_clocks()
+  coord.fire_all("hbase.rs_kill_long")
+"""
+import itertools
+import logging
+import socket
+import threading
+import time
+
+from gremlins import agent
+
+# How far ahead of now simultaneous faults are scheduled, to give every
+# agent time to receive the command
+DEFAULT_LEAD = 0.1
+
+# Number of pings used to estimate each agent's clock offset
+CLOCK_SAMPLES = 5
+
+# How long a slot stays reserved for an agent that may have fired
+RESERVATION_SECONDS = 3600
+
+class AgentError(Exception):
+  """The agent answered a request with an error; the connection is fine."""
+  pass
+
+class FireError(Exception):
+  """
+  A fault was not confirmed fired on every agent.
+
+  @ivar results: (client, response, exception) for every agent, as
+                 fire_all returns them
+  @ivar failed: the clients that answered with an error, and did not fire
+  @ivar unknown: the clients that did not answer, and may have fired
+  """
+  def __init__(self, fault, results, failed, unknown):
+    Exception.__init__(self, "Firing %s failed on %s and may have failed on %s" %
+                       (fault, ", ".join(c.address for c in failed) or "no agents",
+                        ", ".join(c.address for c in unknown) or "no agents"))
+    self.results = results
+    self.failed = failed
+    self.unknown = unknown
+
+class AgentConnection(object):
+  """
+  A single persistent connection to an agent.
+
+  @param secret: the agent's shared secret, if it has one
+  """
+  def __init__(self, host, port, timeout=None, secret=None):
+    self.sock = socket.create_connection((host, port), timeout)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.rfile = self.sock.makefile("rb")
+    self.wfile = self.sock.makefile("wb")
+    self.ids = itertools.count(1)
+    try:
+      self._authenticate(secret)
+    except Exception:
+      self.close()
+      raise
+
+  def _authenticate(self, secret):
+    hello = agent.recv_message(self.rfile)
+    if hello is None:
+      raise Exception("Agent closed the connection")
+    challenge = hello.get("challenge")
+    if challenge is None:
+      return
+    if secret is None:
+      raise Exception("Agent requires a secret")
+    self.request("auth", hmac=agent.sign(secret, challenge))
+
+  def request(self, op, **args):
+    args["op"] = op
+    args["id"] = next(self.ids)
+    agent.send_message(self.wfile, args)
+    response = agent.recv_message(self.rfile)
+    if response is None:
+      raise Exception("Agent closed the connection")
+    if not response.get("ok"):
+      raise AgentError("Agent error: %s" % response.get("error"))
+    return response
+
+  def close(self):
+    self.rfile.close()
+    self.wfile.close()
+    self.sock.close()
+
+
+class AgentClient(object):
+  """
+  A pool of persistent connections to one agent.
+
+  Requests on different threads use different connections, so a slow
+  command never holds up another one to the same agent.
+  """
+  def __init__(self, address, timeout=None, secret=None):
+    host, _, port = address.rpartition(":")
+    self.address = address
+    self.host = host
+    self.port = int(port)
+    self.timeout = timeout
+    self.secret = secret
+    self.idle = []
+    self.lock = threading.Lock()
+    # agent clock minus our clock, from sync_clock()
+    self.offset = 0.0
+
+  def request(self, op, **args):
+    with self.lock:
+      conn = self.idle and self.idle.pop()
+    if not conn:
+      conn = AgentConnection(self.host, self.port, self.timeout, self.secret)
+    # Only a connection that got a whole response back can be reused;
+    # after anything else it may be out of step with the agent
+    healthy = False
+    try:
+      response = conn.request(op, **args)
+      healthy = True
+      return response
+    except AgentError:
+      healthy = True
+      raise
+    finally:
+      if healthy:
+        with self.lock:
+          self.idle.append(conn)
+      else:
+        conn.close()
+
+  def sync_clock(self, samples=CLOCK_SAMPLES):
+    """
+    Estimate the agent's clock offset from a few pings, trusting the one
+    with the smallest round trip.
+    """
+    best_rtt = None
+    for i in xrange(samples):
+      sent = time.time()
+      agent_time = self.request("ping")["time"]
+      received = time.time()
+      rtt = received - sent
+      if best_rtt is None or rtt < best_rtt:
+        best_rtt = rtt
+        self.offset = agent_time - (sent + received) / 2
+    logging.info("Agent %s clock offset %.2fms (rtt %.2fms)" %
+                 (self.address, self.offset * 1000, best_rtt * 1000))
+    return self.offset
+
+  def close(self):
+    with self.lock:
+      conns, self.idle = self.idle, []
+    for conn in conns:
+      conn.close()
+
+  def __repr__(self):
+    return "AgentClient(%s)" % self.address
+
+
+def _parallel(fn, items):
+  """
+  Call fn on every item at once, each on its own thread.
+
+  @returns a list of (item, result, exception) in the order of items
+  """
+  results = [None] * len(items)
+  def run(i, item):
+    try:
+      results[i] = (item, fn(item), None)
+    except Exception, e:
+      results[i] = (item, None, e)
+  threads = []
+  for i, item in enumerate(items):
+    thread = threading.Thread(target=run, args=(i, item))
+    thread.setDaemon(True)
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    thread.join()
+  return results
+
+
+class Coordinator(object):
+  """
+  Sends commands to a set of agents in parallel.
+
+  @param agents: list of "host:port" agent addresses
+  @param max_active: optional cap on faults active across the whole
+                     cluster at once; fire_all refuses to exceed it
+  @param secret: the agents' shared secret, if they have one
+  """
+  def __init__(self, agents, max_active=None, timeout=30, secret=None):
+    self.clients = [AgentClient(address, timeout, secret) for address in agents]
+    self.max_active = max_active
+    self.lock = threading.Lock()
+    self.reservations = itertools.count(1)
+    # (agent address, activation id) -> expiry, on our wall clock
+    self.active = {}
+
+  def close(self):
+    for client in self.clients:
+      client.close()
+
+  def _select(self, agents):
+    if agents is None:
+      return list(self.clients)
+    return [c for c in self.clients if c.address in agents]
+
+  def sync_clocks(self):
+    """Estimate every agent's clock offset, in parallel."""
+    for client, offset, error in _parallel(lambda c: c.sync_clock(), self.clients):
+      if error:
+        logging.warn("Could not sync clock with %s: %s" % (client.address, error))
+
+  def broadcast(self, op, agents=None, **args):
+    """
+    Send the same request to every (or the given) agents in parallel.
+
+    @returns a list of (client, response, exception)
+    """
+    return _parallel(lambda c: c.request(op, **args), self._select(agents))
+
+  def prepare(self, fault, agents=None):
+    """Have agents stage the given fault so firing it is fast."""
+    return self.broadcast("prepare", agents, fault=fault)
+
+  def count_active(self):
+    """Return the number of faults we have fired that are still held."""
+    now = time.time()
+    with self.lock:
+      for key, expires in self.active.items():
+        if expires <= now:
+          del self.active[key]
+      return len(self.active)
+
+  def refresh(self, client):
+    """
+    Replace what we know of the given agent's active faults with what
+    it reports. Fires it still has in progress keep a slot reserved.
+    """
+    response = client.request("active")
+    now = time.time()
+    with self.lock:
+      for key in self.active.keys():
+        if key[0] == client.address:
+          del self.active[key]
+      for activation in response["activations"]:
+        expires = now + activation.get("expires_in", RESERVATION_SECONDS)
+        self.active[(client.address, activation["id"])] = expires
+      for i in xrange(response.get("firing", 0)):
+        reservation = "firing-%d" % next(self.reservations)
+        self.active[(client.address, reservation)] = now + RESERVATION_SECONDS
+
+  def fire_all(self, fault, agents=None, lead=DEFAULT_LEAD):
+    """
+    Fire a fault on every (or the given) agents at the same instant.
+
+    Each agent is told to fire at now + lead, translated to its own
+    clock using the offset from sync_clocks().
+
+    An agent that did not answer may still have fired, so its active
+    faults are read back from it; if that fails too, its slot under
+    max_active stays reserved until cancel_all().
+
+    @returns a list of (client, response, exception)
+    @raises FireError if the fault was not confirmed fired on every agent
+    """
+    clients = self._select(agents)
+    reservation = "pending-%d" % next(self.reservations)
+    with self.lock:
+      if self.max_active is not None:
+        active = len([1 for expires in self.active.values() if expires > time.time()])
+        if active + len(clients) > self.max_active:
+          raise Exception("Firing %s on %d agents would exceed %d active faults (%d active)" %
+                          (fault, len(clients), self.max_active, active))
+        # Reserve the slots until the agents tell us the real durations
+        for client in clients:
+          self.active[(client.address, reservation)] = time.time() + RESERVATION_SECONDS
+    at = time.time() + lead
+    results = _parallel(lambda c: c.request("fire", fault=fault, at=at + c.offset), clients)
+    failed = []
+    unknown = []
+    with self.lock:
+      for client, response, error in results:
+        if isinstance(error, AgentError):
+          failed.append(client)
+        elif error:
+          # Keep the reservation until we know better
+          unknown.append(client)
+          continue
+        elif "activation" in response:
+          expires = response["fired_at"] - client.offset + response["duration"]
+          self.active[(client.address, response["activation"])] = expires
+        self.active.pop((client.address, reservation), None)
+    for client in unknown:
+      try:
+        self.refresh(client)
+      except Exception, e:
+        logging.warn("Could not read back the active faults of %s: %s" % (client.address, e))
+    if failed or unknown:
+      raise FireError(fault, results, failed, unknown)
+    return results
+
+  def cancel_all(self, agents=None):
+    """Revert every active fault on every (or the given) agents."""
+    def cancel(client):
+      for activation in client.request("active")["activations"]:
+        client.request("cancel", activation=activation["id"])
+    results = _parallel(cancel, self._select(agents))
+    with self.lock:
+      self.active.clear()
+    return results
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Declarative fault profiles, written as JSON (or YAML, if PyYAML is
+installed) instead of python:
+
+  {
+    "faults": {
+      "rs_pause": {"fault": "pause_daemons",
+                   "args": {"jvm_names": ["HRegionServer"], "seconds": 62}},
+      "rs_kill":  {"fault": "kill_daemons",
+                   "args": {"daemons": ["HRegionServer"], "signal": "SIGKILL",
+                            "restart_after": 100}},
+      "rs_flaky": {"maybe": 0.33, "fault": "rs_pause"}
+    },
+    "triggers": [
+      {"periodic": 45, "jitter": 5,
+       "fault": {"pick": [[10, "rs_pause"], [5, "rs_kill"]]}},
+      {"load": ["HRegionServer"], "thresholds": {"cpu": 2.0, "disk": "p95"},
+       "cooldown": 600, "fault": "rs_kill"},
+      {"webserver": 12321}
+    ]
+  }
+
+Wherever a fault is expected, one can be given as:
+
+  "NAME"                               a fault named in the "faults" section
+  {"fault": FACTORY, "args": {...}}    a call to one of the FACTORIES
+  {"pick": [[WEIGHT, FAULT], ...]}     metafaults.pick_fault
+  {"maybe": PROBABILITY, "fault": FAULT}  metafaults.maybe_fault
+  {"parallel": [FAULT, ...]}           metafaults.parallel
+  {"sequence": [[OFFSET, FAULT], ...]} metafaults.sequence
+  {"at_most": N, "fault": FAULT}       metafaults.at_most_n_active
+  {"rate_limit": PER_SECOND, "burst": N, "fault": FAULT}
+                                       metafaults.rate_limit
+
+A profile is validated as a whole (unknown factories or arguments,
+missing names, reference cycles, bad weights) and then compiled once
+into a graph of fault objects, in which a name used in several places
+is the same object. Firing a named fault, from the CLI or over HTTP, is
+then a lookup in the profile's registry rather than an eval.
+
+Validation produces a plan of plain data, which is cached on disk under
+CACHE_DIR keyed by a hash of the source, so a large (or YAML) profile is
+only parsed and checked once.
+"""
+import collections
+import errno
+import hashlib
+import inspect
+import json
+import logging
+import marshal
+import os
+import signal
+import tempfile
+
+from gremlins import faults, loadwatch, metafaults, triggers
+
+# Bumped whenever the plan format changes, invalidating cached plans
+FORMAT_VERSION = 1
+
+CACHE_DIR = os.getenv("GREMLINS_CACHE_DIR", os.path.expanduser("~/.cache/gremlins"))
+
+FACTORIES = dict((name, getattr(faults, name)) for name in (
+  "kill_daemons", "pause_daemons", "drop_packets_to_daemons", "partition_hosts",
+  "fail_network", "throttle_cpu", "freeze_daemons", "limit_memory", "throttle_io",
+  "degrade_network_to_daemons", "delay_packets_to_daemons", "lose_packets_to_daemons",
+  "limit_bandwidth_to_daemons", "reorder_packets_to_daemons", "load_disk", "fsync_storm",
+  "inflate_balloon",
+))
+
+class ProfileError(Exception):
+  """A profile that fails validation; the message says where."""
+  pass
+
+
+def _signal(value):
+  if isinstance(value, basestring):
+    number = getattr(signal, str(value), None)
+    if not isinstance(number, int) or not str(value).startswith("SIG"):
+      raise ValueError("no signal named %s" % value)
+    return number
+  return value
+
+# Arguments, by name, whose values are converted before the factory sees them
+CONVERTERS = {
+  "signal": _signal,
+}
+
+def _plain(value):
+  """Turn parsed JSON into str-keyed, str-valued data (json gives unicode)."""
+  if isinstance(value, unicode):
+    return value.encode("utf-8")
+  if isinstance(value, list):
+    return [_plain(item) for item in value]
+  if isinstance(value, dict):
+    return dict((_plain(k), _plain(v)) for k, v in value.iteritems())
+  return value
+
+def parse(text, path="<profile>"):
+  """Parse the source of a profile. YAML is used for .yaml and .yml paths."""
+  if path.endswith((".yaml", ".yml")):
+    try:
+      import yaml
+    except ImportError:
+      raise ProfileError("%s: reading YAML profiles needs PyYAML; use JSON instead" % path)
+    try:
+      data = yaml.safe_load(text)
+    except yaml.YAMLError, e:
+      raise ProfileError("%s: %s" % (path, e))
+  else:
+    try:
+      data = json.loads(text)
+    except ValueError, e:
+      raise ProfileError("%s: %s" % (path, e))
+  return _plain(data)
+
+
+# Validation turns the source into a plan: plain data that marshal can
+# cache. Fault nodes in a plan are tuples:
+#
+#   ("ref", name)
+#   ("call", factory, kwargs)
+#   ("pick", ((weight, node), ...))
+#   ("maybe", probability, node)
+
+def _number(value, where):
+  if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+    raise ProfileError("%s: expected a number, got %r" % (where, value))
+  return value
+
+def _check_args(factory, args, where):
+  if not isinstance(args, dict):
+    raise ProfileError("%s: args must be an object, got %r" % (where, args))
+  fn = FACTORIES[factory]
+  spec = inspect.getargspec(fn)
+  required = spec.args[:len(spec.args) - len(spec.defaults or ())]
+  unknown = sorted(set(args) - set(spec.args))
+  if unknown and not spec.keywords:
+    raise ProfileError("%s: %s takes no argument %s" % (where, factory, ", ".join(unknown)))
+  missing = [arg for arg in required if arg not in args]
+  if missing:
+    raise ProfileError("%s: %s needs %s" % (where, factory, ", ".join(missing)))
+  converted = {}
+  for name, value in args.iteritems():
+    if name in CONVERTERS:
+      try:
+        value = CONVERTERS[name](value)
+      except ValueError, e:
+        raise ProfileError("%s.%s: %s" % (where, name, e))
+    converted[name] = value
+  return converted
+
+def _node(source, where):
+  if isinstance(source, str):
+    return ("ref", source)
+  if not isinstance(source, dict):
+    raise ProfileError("%s: expected a fault name or object, got %r" % (where, source))
+  if "pick" in source:
+    choices = source["pick"]
+    if not isinstance(choices, list) or not choices:
+      raise ProfileError("%s.pick: expected a list of [weight, fault] pairs" % where)
+    plan = []
+    for i, choice in enumerate(choices):
+      if not isinstance(choice, list) or len(choice) != 2:
+        raise ProfileError("%s.pick[%d]: expected [weight, fault]" % (where, i))
+      weight = _number(choice[0], "%s.pick[%d]" % (where, i))
+      if weight < 0:
+        raise ProfileError("%s.pick[%d]: weights can't be negative" % (where, i))
+      plan.append((weight, _node(choice[1], "%s.pick[%d]" % (where, i))))
+    if not sum(weight for weight, node in plan) > 0:
+      raise ProfileError("%s.pick: needs a positive weight" % where)
+    return ("pick", tuple(plan))
+  if "maybe" in source:
+    probability = _number(source["maybe"], where + ".maybe")
+    if not 0 <= probability <= 1:
+      raise ProfileError("%s.maybe: %r is not a probability" % (where, probability))
+    if "fault" not in source:
+      raise ProfileError("%s: maybe needs a fault" % where)
+    return ("maybe", probability, _node(source["fault"], where + ".fault"))
+  if "parallel" in source:
+    children = source["parallel"]
+    if not isinstance(children, list) or not children:
+      raise ProfileError("%s.parallel: expected a list of faults" % where)
+    return ("parallel", tuple(_node(child, "%s.parallel[%d]" % (where, i))
+                              for i, child in enumerate(children)))
+  if "sequence" in source:
+    steps = source["sequence"]
+    if not isinstance(steps, list) or not steps:
+      raise ProfileError("%s.sequence: expected a list of [offset, fault] pairs" % where)
+    plan = []
+    for i, step in enumerate(steps):
+      if not isinstance(step, list) or len(step) != 2:
+        raise ProfileError("%s.sequence[%d]: expected [offset, fault]" % (where, i))
+      offset = _number(step[0], "%s.sequence[%d]" % (where, i))
+      if offset < 0:
+        raise ProfileError("%s.sequence[%d]: offsets can't be negative" % (where, i))
+      plan.append((offset, _node(step[1], "%s.sequence[%d]" % (where, i))))
+    return ("sequence", tuple(plan))
+  if "at_most" in source:
+    limit = _number(source["at_most"], where + ".at_most")
+    if limit < 1 or limit != int(limit):
+      raise ProfileError("%s.at_most: expected a whole number of faults, got %r" % (where, limit))
+    if "fault" not in source:
+      raise ProfileError("%s: at_most needs a fault" % where)
+    return ("at_most", int(limit), _node(source["fault"], where + ".fault"))
+  if "rate_limit" in source:
+    rate = _number(source["rate_limit"], where + ".rate_limit")
+    burst = _number(source.get("burst", 1), where + ".burst")
+    if rate <= 0 or burst < 1:
+      raise ProfileError("%s: rate_limit needs a positive rate and a burst of at least 1" % where)
+    if "fault" not in source:
+      raise ProfileError("%s: rate_limit needs a fault" % where)
+    return ("rate_limit", rate, burst, _node(source["fault"], where + ".fault"))
+  factory = source.get("fault")
+  if factory not in FACTORIES:
+    raise ProfileError("%s: unknown fault %r; expected one of %s" %
+                       (where, factory, ", ".join(sorted(FACTORIES))))
+  return ("call", factory, _check_args(factory, source.get("args", {}), where + ".args"))
+
+def _refs(node):
+  kind = node[0]
+  if kind == "ref":
+    return [node[1]]
+  if kind == "pick":
+    return sum([_refs(child) for weight, child in node[1]], [])
+  if kind == "maybe":
+    return _refs(node[2])
+  if kind == "parallel":
+    return sum([_refs(child) for child in node[1]], [])
+  if kind == "sequence":
+    return sum([_refs(child) for offset, child in node[1]], [])
+  if kind == "at_most":
+    return _refs(node[2])
+  if kind == "rate_limit":
+    return _refs(node[3])
+  return []
+
+def _order(named, where):
+  """Return the names in an order where each comes after those it refers to."""
+  order = []
+  state = {}
+  def visit(name, chain):
+    if state.get(name) == "done":
+      return
+    if state.get(name) == "visiting":
+      raise ProfileError("%s: reference cycle %s" % (where, " -> ".join(chain + [name])))
+    state[name] = "visiting"
+    for ref in _refs(named[name]):
+      if ref not in named:
+        raise ProfileError("%s.%s: no fault named %s" % (where, name, ref))
+      visit(ref, chain + [name])
+    state[name] = "done"
+    order.append(name)
+  for name in sorted(named):
+    visit(name, [])
+  return order
+
+def _trigger_fault(source, names, where, kind):
+  if "fault" not in source:
+    raise ProfileError("%s: %s needs a fault" % (where, kind))
+  node = _node(source["fault"], where + ".fault")
+  for ref in _refs(node):
+    if ref not in names:
+      raise ProfileError("%s.fault: no fault named %s" % (where, ref))
+  return node
+
+def _load_trigger(source, names, where):
+  daemons = source["load"]
+  if isinstance(daemons, basestring):
+    daemons = [daemons]
+  if not daemons or not isinstance(daemons, list) or \
+      not all(isinstance(daemon, basestring) for daemon in daemons):
+    raise ProfileError("%s.load: expected a list of daemons" % where)
+  thresholds = source.get("thresholds")
+  if not thresholds or not isinstance(thresholds, dict):
+    raise ProfileError("%s: load needs thresholds, eg {\"cpu\": 2.0, \"disk\": \"p95\"}" % where)
+  for metric, spec in thresholds.iteritems():
+    if not isinstance(spec, basestring):
+      _number(spec, "%s.thresholds.%s" % (where, metric))
+    try:
+      loadwatch.parse_threshold(metric, spec)
+    except ValueError, e:
+      raise ProfileError("%s.thresholds: %s" % (where, e))
+  node = _trigger_fault(source, names, where, "load")
+  options = {}
+  for option, default in (("interval", 1.0), ("history", 300), ("cooldown", 300), ("sustain", 3)):
+    options[option] = _number(source.get(option, default), "%s.%s" % (where, option))
+    if options[option] <= 0:
+      raise ProfileError("%s.%s: must be positive" % (where, option))
+  mode = source.get("mode", "any")
+  if mode not in ("any", "all"):
+    raise ProfileError("%s.mode: expected any or all, got %r" % (where, mode))
+  return ("load", tuple(daemons), tuple(sorted(thresholds.iteritems())), node,
+          options["interval"], int(options["history"]), options["cooldown"],
+          int(options["sustain"]), mode)
+
+def _trigger(source, names, where):
+  if not isinstance(source, dict):
+    raise ProfileError("%s: expected an object, got %r" % (where, source))
+  if "webserver" in source:
+    return ("webserver", int(_number(source["webserver"], where + ".webserver")))
+  if "load" in source:
+    return _load_trigger(source, names, where)
+  if "periodic" not in source:
+    raise ProfileError("%s: unknown trigger; expected periodic, load or webserver" % where)
+  period = _number(source["periodic"], where + ".periodic")
+  if period <= 0:
+    raise ProfileError("%s.periodic: the period must be positive" % where)
+  node = _trigger_fault(source, names, where, "periodic")
+  jitter = _number(source.get("jitter", 0), where + ".jitter")
+  return ("periodic", period, node, bool(source.get("fixed_rate", False)), jitter)
+
+def validate(data):
+  """
+  Check a parsed profile, returning its plan.
+
+  @raises ProfileError: naming the first problem found
+  """
+  if not isinstance(data, dict):
+    raise ProfileError("a profile must be an object with faults and/or triggers")
+  unknown = sorted(set(data) - set(["faults", "triggers"]))
+  if unknown:
+    raise ProfileError("unknown sections %s" % ", ".join(unknown))
+  sources = data.get("faults", {})
+  if not isinstance(sources, dict):
+    raise ProfileError("faults: expected an object of name -> fault")
+  named = dict((name, _node(source, "faults." + name))
+               for name, source in sources.iteritems())
+  order = _order(named, "faults")
+  trigger_sources = data.get("triggers", [])
+  if not isinstance(trigger_sources, list):
+    raise ProfileError("triggers: expected a list")
+  plan_triggers = tuple(_trigger(source, named, "triggers[%d]" % i)
+                        for i, source in enumerate(trigger_sources))
+  return {"version": FORMAT_VERSION,
+          "faults": tuple((name, named[name]) for name in order),
+          "triggers": plan_triggers}
+
+
+class Registry(collections.Mapping):
+  """A read-only mapping of fault name -> fault."""
+  def __init__(self, faults):
+    self._faults = dict(faults)
+
+  def __getitem__(self, name):
+    return self._faults[name]
+
+  def __iter__(self):
+    return iter(sorted(self._faults))
+
+  def __len__(self):
+    return len(self._faults)
+
+  def __repr__(self):
+    return "Registry(%s)" % ", ".join(self)
+
+
+class CompiledProfile(object):
+  """
+  The fault graph built from a plan.
+
+  @ivar faults: Registry of the named faults
+  @ivar names: dict of id(fault) -> name, as simulator.fault_names builds
+  """
+  def __init__(self, plan):
+    self.plan = plan
+    built = {}
+    for name, node in plan["faults"]:
+      built[name] = self._build(node, built, "faults." + name)
+    self.faults = Registry(built)
+    self.names = dict((id(fault), name) for name, fault in built.iteritems())
+
+  def _build(self, node, built, where):
+    kind = node[0]
+    if kind == "ref":
+      return built[node[1]]
+    if kind == "pick":
+      return metafaults.pick_fault([(weight, self._build(child, built, where))
+                                    for weight, child in node[1]])
+    if kind == "maybe":
+      return metafaults.maybe_fault(node[1], self._build(node[2], built, where))
+    if kind == "parallel":
+      return metafaults.parallel([self._build(child, built, where) for child in node[1]])
+    if kind == "sequence":
+      return metafaults.sequence([(offset, self._build(child, built, where))
+                                  for offset, child in node[1]])
+    if kind == "at_most":
+      return metafaults.at_most_n_active(node[1], self._build(node[2], built, where))
+    if kind == "rate_limit":
+      return metafaults.rate_limit(node[1], self._build(node[3], built, where), burst=node[2])
+    factory, kwargs = node[1], node[2]
+    try:
+      return FACTORIES[factory](**kwargs)
+    except Exception, e:
+      raise ProfileError("%s: %s(%s) failed: %s" % (where, factory, kwargs, e))
+
+  def triggers(self):
+    """Return a fresh list of the profile's triggers, ready to start."""
+    result = []
+    for i, trigger in enumerate(self.plan["triggers"]):
+      if trigger[0] == "webserver":
+        result.append(triggers.WebServerTrigger(trigger[1], registry=self.faults))
+        continue
+      if trigger[0] == "load":
+        kind, daemons, thresholds, node, interval, history, cooldown, sustain, mode = trigger
+        fault = self._build(node, dict(self.faults), "triggers[%d]" % i)
+        result.append(triggers.LoadTrigger(daemons, fault, dict(thresholds), interval=interval,
+                                           history=history, cooldown=cooldown,
+                                           sustain=sustain, mode=mode))
+        continue
+      kind, period, node, fixed_rate, jitter = trigger
+      fault = self._build(node, dict(self.faults), "triggers[%d]" % i)
+      result.append(triggers.Periodic(period, fault, fixed_rate=fixed_rate, jitter=jitter))
+    return result
+
+
+def _cache_path(text, cache_dir):
+  digest = hashlib.sha1("%d\0%s" % (FORMAT_VERSION, text)).hexdigest()
+  return os.path.join(cache_dir, "profile-%s.plan" % digest)
+
+def _read_cache(path):
+  try:
+    f = open(path, "rb")
+  except IOError:
+    return None
+  try:
+    try:
+      plan = marshal.load(f)
+    except (EOFError, ValueError, TypeError):
+      return None
+  finally:
+    f.close()
+  if not isinstance(plan, dict) or plan.get("version") != FORMAT_VERSION:
+    return None
+  return plan
+
+def _write_cache(path, plan):
+  directory = os.path.dirname(path)
+  try:
+    try:
+      os.makedirs(directory)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+    # Write then rename, so a reader never sees half a plan
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".plan-")
+    try:
+      os.write(fd, marshal.dumps(plan))
+    finally:
+      os.close(fd)
+    os.rename(tmp, path)
+  except (IOError, OSError), e:
+    logging.warn("Could not cache compiled profile in %s: %s" % (directory, e))
+
+def compile_text(text, path="<profile>", cache_dir=None):
+  """
+  Compile the source of a profile.
+
+  @param cache_dir: where to cache the validated plan, or None not to
+  """
+  plan = None
+  cache_path = None
+  if cache_dir:
+    cache_path = _cache_path(text, cache_dir)
+    plan = _read_cache(cache_path)
+  if plan is None:
+    plan = validate(parse(text, path))
+    if cache_path:
+      _write_cache(cache_path, plan)
+  return CompiledProfile(plan)
+
+def compile_file(path, cache_dir=CACHE_DIR):
+  """Compile a profile file, reusing a cached plan if its source is unchanged."""
+  f = open(path, "rb")
+  try:
+    text = f.read()
+  finally:
+    f.close()
+  return compile_text(text, path, cache_dir)
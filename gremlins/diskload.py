@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A rate-controlled disk load generator, for contending with daemons for
+a volume's IOPS and bandwidth.
+
+Load is generated against a scratch file on the volume by a few worker
+threads. Each worker owns one page-aligned buffer, allocated once with
+mmap, and issues pread/pwrite straight from it through libc: nothing is
+allocated or copied per operation, and the GIL is released for the
+duration of each syscall. The file is opened with O_DIRECT where the
+filesystem supports it, so the load reaches the disk rather than the
+page cache.
+
+With a target rate, operations are paced against a shared schedule
+(operation k is due at start + k / rate), so the achieved rate matches
+the target over the run however many workers there are. Without one,
+the workers go as fast as the disk allows.
+
+  $ python -m gremlins.diskload [-p PATTERN] [-s SECONDS] [--iops N] DIR
+"""
+import ctypes
+import errno
+import logging
+import mmap
+import os
+import random
+import threading
+import time
+from optparse import OptionParser
+
+from gremlins.clock import monotonic
+
+PATTERNS = ("seqread", "randread", "seqwrite", "randwrite", "randrw")
+
+# O_DIRECT wants offsets and buffers aligned to the logical block size,
+# which is never more than a page
+ALIGNMENT = 4096
+
+# Once this far behind schedule, workers stop trying to catch up, so a
+# stalled disk is not hit with a burst when it recovers
+MAX_LAG = 1.0
+
+# Scratch files are named this plus a random suffix
+SCRATCH_PREFIX = ".gremlins-diskload-"
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_pread = _libc.pread
+_pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_longlong]
+_pread.restype = ctypes.c_ssize_t
+_pwrite = _libc.pwrite
+_pwrite.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_longlong]
+_pwrite.restype = ctypes.c_ssize_t
+
+def _check(result):
+  if result < 0:
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+  return result
+
+def open_scratch(path, size, direct=True):
+  """
+  Open (creating and filling, if need be) a scratch file of the given
+  size. Returns (fd, direct), where direct says whether O_DIRECT stuck.
+
+  The file is filled with real data rather than preallocated, so that
+  reads hit the disk instead of being answered from unwritten extents.
+  """
+  flags = os.O_RDWR | os.O_CREAT
+  fd = None
+  if direct and hasattr(os, "O_DIRECT"):
+    try:
+      fd = os.open(path, flags | os.O_DIRECT, 0600)
+    except OSError, e:
+      # tmpfs and some FUSE filesystems refuse O_DIRECT
+      if e.errno != errno.EINVAL:
+        raise
+      logging.warn("%s does not support O_DIRECT; load will go through the page cache" % path)
+  if fd is None:
+    direct = False
+    fd = os.open(path, flags, 0600)
+  try:
+    if os.fstat(fd).st_size < size:
+      _fill(fd, size)
+  except:
+    os.close(fd)
+    raise
+  return fd, direct
+
+def _fill(fd, size):
+  chunk = 1 << 20
+  buf = Buffer(chunk)
+  try:
+    buf.fill()
+    offset = 0
+    while offset < size:
+      n = min(chunk, size - offset)
+      offset += _check(_pwrite(fd, buf.address, n, offset))
+    os.fsync(fd)
+  finally:
+    buf.close()
+
+
+class Buffer(object):
+  """A page-aligned buffer, as O_DIRECT requires."""
+  def __init__(self, size):
+    self.size = size
+    self.map = mmap.mmap(-1, size)
+    self.view = ctypes.c_char.from_buffer(self.map)
+    self.address = ctypes.addressof(self.view)
+
+  def fill(self):
+    # Incompressible, so thin-provisioned or compressing storage can't
+    # shortcut the writes
+    self.map[:] = os.urandom(self.size)
+
+  def close(self):
+    del self.view
+    self.map.close()
+
+
+class Pacer(object):
+  """Hands out due times for operations so that they run at a fixed rate."""
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.lock = threading.Lock()
+    self.start = monotonic()
+    self.count = 0
+
+  def next_due(self):
+    with self.lock:
+      due = self.start + self.count / self.rate
+      now = monotonic()
+      if now - due > MAX_LAG:
+        # Too far behind: start the schedule over from now
+        self.start = now
+        self.count = 0
+        due = now
+      self.count += 1
+      return due
+
+
+class _Counters(object):
+  __slots__ = ["reads", "writes", "syncs", "read_bytes", "write_bytes", "busy"]
+
+  def __init__(self):
+    self.reads = self.writes = self.syncs = 0
+    self.read_bytes = self.write_bytes = 0
+    self.busy = 0.0
+
+
+class DiskLoad(object):
+  """
+  Generates load against a scratch file until stopped.
+
+  @param directory: a directory on the volume to load
+  @param pattern: one of PATTERNS
+  @param block_size: bytes per operation, a multiple of ALIGNMENT
+  @param iops: target operations per second, or None for as many as possible
+  @param bps: target bytes per second; overrides iops
+  @param file_size: size of the scratch file; random operations range over it
+  @param threads: worker threads, ie how many operations may be in flight
+  @param fsync_every: fdatasync after every this many writes (0 for never)
+  @param direct: use O_DIRECT if the filesystem supports it
+  @param write_ratio: the fraction of randrw operations that are writes
+  """
+  def __init__(self, directory, pattern="randread", block_size=ALIGNMENT, iops=None,
+               bps=None, file_size=256 << 20, threads=4, fsync_every=0, direct=True,
+               write_ratio=0.5):
+    if pattern not in PATTERNS:
+      raise ValueError("Unknown pattern %s, expected one of %s" % (pattern, ", ".join(PATTERNS)))
+    if block_size <= 0 or block_size % ALIGNMENT:
+      raise ValueError("block_size must be a multiple of %d" % ALIGNMENT)
+    self.path = os.path.join(directory, SCRATCH_PREFIX + os.urandom(4).encode("hex"))
+    self.pattern = pattern
+    self.block_size = block_size
+    self.blocks = max(1, file_size // block_size)
+    self.file_size = self.blocks * block_size
+    if bps:
+      iops = float(bps) / block_size
+    self.iops = iops
+    self.threads = threads
+    self.fsync_every = fsync_every
+    self.direct = direct
+    self.write_ratio = write_ratio
+    self.fd = None
+    self.stop_event = threading.Event()
+    self.workers = []
+    self.counters = []
+    self.started = None
+    self.stopped = None
+    # Next block for sequential patterns, shared so that the workers
+    # between them sweep the file in order
+    self.cursor = 0
+    self.cursor_lock = threading.Lock()
+
+  def start(self):
+    self.fd, self.direct = open_scratch(self.path, self.file_size, self.direct)
+    pacer = self.iops and Pacer(self.iops) or None
+    self.started = monotonic()
+    for i in xrange(self.threads):
+      counters = _Counters()
+      self.counters.append(counters)
+      worker = threading.Thread(target=self._work, args=(pacer, counters),
+                                name="gremlin-diskload-%d" % i)
+      worker.setDaemon(True)
+      self.workers.append(worker)
+      worker.start()
+
+  def stop(self):
+    """Stop the workers and return the achieved throughput."""
+    self.stop_event.set()
+    for worker in self.workers:
+      worker.join()
+    self.stopped = monotonic()
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+    return self.throughput()
+
+  def remove(self):
+    try:
+      os.unlink(self.path)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def throughput(self):
+    """Return a dict of what the workers achieved, for the fault's details."""
+    elapsed = max((self.stopped or monotonic()) - (self.started or monotonic()), 1e-9)
+    total = _Counters()
+    for counters in self.counters:
+      for field in _Counters.__slots__:
+        setattr(total, field, getattr(total, field) + getattr(counters, field))
+    ops = total.reads + total.writes
+    return {"pattern": self.pattern, "block_size": self.block_size, "direct": self.direct,
+            "target_iops": self.iops, "seconds": round(elapsed, 3),
+            "reads": total.reads, "writes": total.writes, "syncs": total.syncs,
+            "iops": round(ops / elapsed, 1),
+            "read_mbps": round(total.read_bytes / elapsed / (1 << 20), 2),
+            "write_mbps": round(total.write_bytes / elapsed / (1 << 20), 2),
+            "mean_latency_ms": ops and round(total.busy / ops * 1000, 3) or None}
+
+  def _next_block(self, rng):
+    if self.pattern.startswith("rand"):
+      return rng.randrange(self.blocks)
+    with self.cursor_lock:
+      block = self.cursor
+      self.cursor = (block + 1) % self.blocks
+      return block
+
+  def _work(self, pacer, counters):
+    buf = Buffer(self.block_size)
+    try:
+      buf.fill()
+      self._loop(buf, pacer, counters)
+    except Exception:
+      logging.exception("Disk load worker on %s failed" % self.path)
+    finally:
+      buf.close()
+
+  def _loop(self, buf, pacer, counters):
+    rng = random.Random()
+    fd = self.fd
+    size = self.block_size
+    address = buf.address
+    writes_only = self.pattern.endswith("write")
+    mixed = self.pattern == "randrw"
+    while not self.stop_event.isSet():
+      if pacer is not None:
+        delay = pacer.next_due() - monotonic()
+        if delay > 0:
+          # Wakes early on stop
+          self.stop_event.wait(delay)
+          if self.stop_event.isSet():
+            break
+      offset = self._next_block(rng) * size
+      write = writes_only or (mixed and rng.random() < self.write_ratio)
+      start = monotonic()
+      if write:
+        _check(_pwrite(fd, address, size, offset))
+        counters.writes += 1
+        counters.write_bytes += size
+        if self.fsync_every and counters.writes % self.fsync_every == 0:
+          os.fdatasync(fd)
+          counters.syncs += 1
+      else:
+        _check(_pread(fd, address, size, offset))
+        counters.reads += 1
+        counters.read_bytes += size
+      counters.busy += monotonic() - start
+
+
+def main():
+  parser = OptionParser(usage="%prog [options] DIR")
+  parser.add_option("-p", "--pattern", dest="pattern", default="randread",
+                    help="one of " + ", ".join(PATTERNS))
+  parser.add_option("-s", "--seconds", dest="seconds", type="float", default=10)
+  parser.add_option("-b", "--block-size", dest="block_size", type="int", default=ALIGNMENT)
+  parser.add_option("--iops", dest="iops", type="float")
+  parser.add_option("--bps", dest="bps", type="float")
+  parser.add_option("--size-mb", dest="size_mb", type="int", default=256)
+  parser.add_option("-t", "--threads", dest="threads", type="int", default=4)
+  parser.add_option("--fsync-every", dest="fsync_every", type="int", default=0)
+  parser.add_option("--buffered", dest="direct", action="store_false", default=True)
+  (options, args) = parser.parse_args()
+  if len(args) != 1:
+    parser.error("Expected a directory")
+  logging.basicConfig(level=logging.INFO)
+  load = DiskLoad(args[0], pattern=options.pattern, block_size=options.block_size,
+                  iops=options.iops, bps=options.bps, file_size=options.size_mb << 20,
+                  threads=options.threads, fsync_every=options.fsync_every,
+                  direct=options.direct)
+  load.start()
+  try:
+    time.sleep(options.seconds)
+  finally:
+    result = load.stop()
+    load.remove()
+  for key in sorted(result):
+    print "%-16s %s" % (key, result[key])
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A structured, append-only journal of what gremlins did and when.
+
+Events are written one JSON object per line. Every event carries an
+"event" type plus "wall" (seconds since the epoch) and "mono" (the
+monotonic clock) timestamps, so it can be lined up both with other
+hosts' logs and with other events from the same run.
+
+The fault runtime writes two events per fault firing:
+
+  inject  - once the fault has taken effect
+  revert  - once it has been undone, with the full record: per-phase
+            durations (discover, inject, hold, revert), the trigger
+            path that picked the fault, and details such as pids,
+            ports and chain names
+
+The inject phase includes discover, the time spent resolving pids and
+ports.
+
+To summarize a journal:
+
+  $ python -m gremlins.events FILE [FILE ...]
+"""
+import json
+import sys
+import threading
+import time
+
+from gremlins.clock import monotonic
+
+class EventLog(object):
+  """Appends events to a file, one JSON object per line."""
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.f = open(path, "a")
+
+  def emit(self, event, **fields):
+    fields["event"] = event
+    fields.setdefault("wall", time.time())
+    fields.setdefault("mono", monotonic())
+    line = json.dumps(fields, separators=(",", ":"), default=repr)
+    with self.lock:
+      self.f.write(line + "\n")
+      self.f.flush()
+
+  def close(self):
+    with self.lock:
+      self.f.close()
+
+
+_log = None
+
+def install(log):
+  """Send events to the given EventLog (or nowhere, if None)."""
+  global _log
+  _log = log
+
+def emit(event, **fields):
+  """Record an event, if an event log is installed."""
+  log = _log
+  if log is not None:
+    log.emit(event, **fields)
+
+
+def iter_events(path):
+  """Yield the events in a journal one at a time."""
+  f = open(path)
+  try:
+    for line in f:
+      line = line.strip()
+      if line:
+        yield json.loads(line)
+  finally:
+    f.close()
+
+
+class RunningStats(object):
+  """Count, mean, min and max of a stream of numbers in constant space."""
+  __slots__ = ["count", "total", "min", "max"]
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def add(self, value):
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def mean(self):
+    if not self.count:
+      return 0.0
+    return self.total / self.count
+
+
+class Summary(object):
+  """Aggregates a stream of events without holding on to them."""
+  def __init__(self):
+    self.first = None
+    self.last = None
+    self.events = 0
+    self.errors = 0
+    # fault -> phase -> RunningStats
+    self.phases = {}
+    # trigger path -> count
+    self.paths = {}
+
+  def add(self, event):
+    self.events += 1
+    wall = event.get("wall")
+    if wall is not None:
+      if self.first is None or wall < self.first:
+        self.first = wall
+      if self.last is None or wall > self.last:
+        self.last = wall
+    if event.get("event") != "revert":
+      return
+    if event.get("error"):
+      self.errors += 1
+    phases = self.phases.setdefault(event.get("fault"), {})
+    for phase, seconds in event.get("timings", {}).iteritems():
+      phases.setdefault(phase, RunningStats()).add(seconds)
+    path = " > ".join(event.get("path", [])) or "(direct)"
+    self.paths[path] = self.paths.get(path, 0) + 1
+
+  def report(self, out=sys.stdout):
+    if self.first is None:
+      print >>out, "No events"
+      return
+    print >>out, "%d events from %s to %s (%.1f hours), %d errors" % (
+      self.events,
+      time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.first)),
+      time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.last)),
+      (self.last - self.first) / 3600.0, self.errors)
+    print >>out
+    print >>out, "%-50s %-8s %8s %10s %10s %10s" % ("fault", "phase", "count", "mean", "min", "max")
+    for fault in sorted(self.phases):
+      for phase in ("discover", "inject", "hold", "revert"):
+        stats = self.phases[fault].get(phase)
+        if stats:
+          print >>out, "%-50s %-8s %8d %9.3fs %9.3fs %9.3fs" % (
+            fault[:50], phase, stats.count, stats.mean(), stats.min, stats.max)
+    print >>out
+    print >>out, "%8s  %s" % ("count", "trigger path")
+    for path, count in sorted(self.paths.items(), key=lambda item: -item[1]):
+      print >>out, "%8d  %s" % (count, path)
+
+
+def summarize(paths):
+  """Return a Summary of the given journal files, streaming through them."""
+  summary = Summary()
+  for path in paths:
+    for event in iter_events(path):
+      summary.add(event)
+  return summary
+
+def main():
+  if len(sys.argv) < 2:
+    print >>sys.stderr, "usage: %s FILE [FILE ...]" % sys.argv[0]
+    sys.exit(1)
+  summarize(sys.argv[1:]).report()
+
+if __name__ == "__main__":
+  main()
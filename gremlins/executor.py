@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A long-lived helper process that runs commands for gremlins.
+
+Forking gremlins itself for every iptables, jps or lsof call costs more
+the more memory gremlins maps, and each sudo in START_COMMANDS pays for
+a PAM session besides. Instead, a helper is started once (through sudo,
+if it should run as another user) and is sent batches of commands over
+a pipe. The helper is a small process, so its forks are cheap, and the
+commands of a batch run in order with no further round trips. Results
+stream back as each command finishes; a batch stops at its first
+failing command, as a sequence of procutils.run calls would.
+
+Batches run concurrently with one another, each on its own thread in
+the helper, so a slow daemon start does not hold up other faults.
+
+This module uses only the standard library, so that the helper can be
+run as a plain script by a user who cannot import gremlins:
+
+  $ python gremlins/executor.py
+"""
+import errno
+import fcntl
+import itertools
+import marshal
+import os
+import struct
+import subprocess
+import sys
+import threading
+
+_HEADER = struct.Struct("!I")
+
+class ExecutorError(Exception):
+  """The helper died, or could not be started."""
+  pass
+
+def _read_exactly(f, n):
+  data = f.read(n)
+  if len(data) < n:
+    return None
+  return data
+
+def read_frame(f):
+  """Read one message from f, or return None at end of file."""
+  header = _read_exactly(f, _HEADER.size)
+  if header is None:
+    return None
+  body = _read_exactly(f, _HEADER.unpack(header)[0])
+  if body is None:
+    return None
+  return marshal.loads(body)
+
+def write_frame(f, message):
+  body = marshal.dumps(message)
+  f.write(_HEADER.pack(len(body)) + body)
+  f.flush()
+
+def _set_cloexec(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+# The helper side
+
+class _Helper(object):
+  def __init__(self, rfile, wfile):
+    self.rfile = rfile
+    self.wfile = wfile
+    self.write_lock = threading.Lock()
+    # Held while forking, and until the parent's ends of the new child's
+    # pipes are marked close-on-exec, so no child inherits another's pipes
+    self.spawn_lock = threading.Lock()
+    self.devnull = os.open(os.devnull, os.O_RDONLY)
+    _set_cloexec(self.devnull)
+
+  def serve(self):
+    threads = []
+    while True:
+      message = read_frame(self.rfile)
+      if message is None:
+        break
+      batch_id, commands = message
+      thread = threading.Thread(target=self._run_batch, args=(batch_id, commands))
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join()
+
+  def _reply(self, *message):
+    with self.write_lock:
+      write_frame(self.wfile, message)
+
+  def _spawn(self, cmdv, input, capture):
+    stdin = self.devnull
+    if input is not None:
+      stdin = subprocess.PIPE
+    # Output that isn't captured goes where gremlins' own output goes,
+    # never down the pipe back to it
+    stdout = 2
+    if capture:
+      stdout = subprocess.PIPE
+    with self.spawn_lock:
+      proc = subprocess.Popen(cmdv, stdin=stdin, stdout=stdout)
+      for f in (proc.stdin, proc.stdout):
+        if f is not None:
+          _set_cloexec(f.fileno())
+    return proc
+
+  def _run_batch(self, batch_id, commands):
+    for index, (cmdv, input, capture) in enumerate(commands):
+      try:
+        proc = self._spawn(cmdv, input, capture)
+        out, _ = proc.communicate(input)
+      except OSError, e:
+        self._reply(batch_id, index, None, "", (e.errno, e.strerror))
+        return
+      self._reply(batch_id, index, proc.returncode, out or "", None)
+      if proc.returncode != 0:
+        return
+
+
+def main():
+  # Talk over duplicates of stdin and stdout, and point the originals
+  # elsewhere, so nothing else can write into the protocol stream
+  rfile = os.fdopen(os.dup(0), "rb")
+  wfile = os.fdopen(os.dup(1), "wb")
+  _set_cloexec(rfile.fileno())
+  _set_cloexec(wfile.fileno())
+  devnull = os.open(os.devnull, os.O_RDWR)
+  os.dup2(devnull, 0)
+  os.dup2(2, 1)
+  os.close(devnull)
+  _Helper(rfile, wfile).serve()
+
+
+# The gremlins side
+
+def _script():
+  path = os.path.abspath(__file__)
+  if path.endswith((".pyc", ".pyo")):
+    path = path[:-1]
+  return path
+
+
+class _Batch(object):
+  __slots__ = ["size", "results", "done"]
+
+  def __init__(self, size):
+    self.size = size
+    self.results = []
+    self.done = threading.Event()
+
+
+class Executor(object):
+  """
+  A connection to a helper process, started on first use and restarted
+  if it dies.
+
+  @param prefix: argv to start the helper through, eg
+                 ["sudo", "-n", "-u", "accumulo", "-i"]
+  """
+  def __init__(self, prefix=()):
+    self.prefix = list(prefix)
+    self.lock = threading.Lock()
+    self.write_lock = threading.Lock()
+    self.proc = None
+    self.reader = None
+    self.pending = {}
+    self.batch_ids = itertools.count()
+
+  def _start(self):
+    # Called with self.lock held. The helper gets its own process group,
+    # so that a ^C meant for gremlins leaves it alive to run the reverts.
+    self.proc = subprocess.Popen(self.prefix + [sys.executable, _script()],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 close_fds=True, preexec_fn=os.setpgrp)
+    self.reader = threading.Thread(target=self._read, args=(self.proc,), name="gremlin-executor")
+    self.reader.setDaemon(True)
+    self.reader.start()
+
+  def _read(self, proc):
+    while True:
+      message = read_frame(proc.stdout)
+      if message is None:
+        break
+      batch_id, index, returncode, output, error = message
+      with self.lock:
+        batch = self.pending.get(batch_id)
+      if batch is None:
+        continue
+      batch.results.append((returncode, output, error))
+      if returncode != 0 or len(batch.results) == batch.size:
+        batch.done.set()
+    proc.wait()
+    with self.lock:
+      if self.proc is proc:
+        self.proc = None
+      orphans, self.pending = self.pending.values(), {}
+    for batch in orphans:
+      batch.done.set()
+
+  def submit(self, commands):
+    """
+    Run a batch of commands in the helper, in order, stopping at the
+    first that fails.
+
+    @param commands: a list of (cmdv, input, capture), where input is
+                     a string for stdin or None, and capture says whether
+                     to collect stdout or pass it through to ours
+    @returns a list of (returncode, output, error) for each command run;
+             error is (errno, strerror) if it could not be started
+    """
+    batch = _Batch(len(commands))
+    if not commands:
+      return []
+    with self.lock:
+      if self.proc is None:
+        self._start()
+      proc = self.proc
+      batch_id = self.batch_ids.next()
+      self.pending[batch_id] = batch
+    try:
+      with self.write_lock:
+        write_frame(proc.stdin, (batch_id, [(list(cmdv), input, capture)
+                                            for cmdv, input, capture in commands]))
+    except IOError, e:
+      if e.errno != errno.EPIPE:
+        raise
+    batch.done.wait()
+    with self.lock:
+      self.pending.pop(batch_id, None)
+    results = batch.results
+    if len(results) < batch.size and (not results or results[-1][0] == 0):
+      raise ExecutorError("Command helper %s exited with status %s" %
+                          (repr(self.prefix + [_script()]), proc.returncode))
+    return results
+
+  def close(self):
+    """Let the helper finish its batches and exit, and wait for it."""
+    with self.lock:
+      proc, reader = self.proc, self.reader
+    if proc is not None:
+      proc.stdin.close()
+      # The reader reaps the helper
+      reader.join()
+
+
+if __name__ == "__main__":
+  main()
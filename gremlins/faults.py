@@ -16,38 +16,196 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from gremlins import procutils, iptables
+from gremlins import procutils, iptables, ipsets, probes, cgroups, netem, undolog, diskload, balloon
+from gremlins.clock import monotonic
+from gremlins.runtime import Fault, resolve
 import signal
+import errno
 import os
-import subprocess
+import socket
+import struct
 import logging
-import time
+import threading
 
-def kill_daemons(daemons, signal, restart_after):
+def _daemon_ports(daemons):
+  """Return a dict of daemon -> ports it is listening on, for probing restarts."""
+  result = {}
+  for daemon in daemons:
+    ports = set()
+    for pid_ports in procutils.get_listening_ports_many(probes.find_daemon(daemon)).values():
+      ports.update(pid_ports)
+    result[daemon] = sorted(ports)
+  return result
+
+def _find_ports(daemons):
+  """Return the pids of the given daemons, and the ports they listen on."""
+  all_pids = []
+  all_ports = []
+  for daemon in daemons:
+    pids = procutils.find_jvms(daemon)
+    if not pids:
+      logging.warn("Daemon %s not running!" % daemon)
+      continue
+    all_pids.extend(pids)
+    for pid, ports in sorted(procutils.get_listening_ports_many(pids).items()):
+      logging.info("%s pid %d is listening on ports: %s" % (daemon, pid, repr(ports)))
+      all_ports.extend(ports)
+  return all_pids, all_ports
+
+def _restart_and_probe(daemon, activation):
+  """
+  Restart a daemon, and watch how long it takes to recover.
+
+  @returns the monotonic time the restart was issued
+  """
+  started = monotonic()
+  procutils.start_daemon(daemon)
+  ports = activation.details.get("daemon_ports", {}).get(daemon)
+  probes.watch_recovery(daemon, ports, started, activation)
+  return started
+
+def _restart_daemons(daemons, activation):
+  """
+  Restart the given daemons, all at once, so each is back after the
+  fault's duration rather than waiting behind the others' start scripts.
+  Raises the first error once every restart has finished.
+  """
+  errors = []
+  threads = []
+  for daemon in daemons:
+    thread = threading.Thread(target=_restart, args=(daemon, activation, errors),
+                              name="gremlin-restart-%s" % daemon)
+    thread.setDaemon(True)
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+
+def _restart(daemon, activation, errors):
+  logging.info("Restarting %s" % daemon)
+  try:
+    started = _restart_and_probe(daemon, activation)
+  except Exception, e:
+    logging.exception("Failed to restart %s" % daemon)
+    errors.append(e)
+    return
+  down_since = activation.details.get("down_since", {}).get(daemon)
+  if down_since is not None:
+    activation.details.setdefault("down", {})[daemon] = round(started - down_since, 3)
+
+# How long kill_daemons waits for the signalled daemons to exit
+EXIT_TIMEOUT = 60
+
+class KillDaemons(Fault):
+  def __init__(self, daemons, signal, restart_after, exit_timeout=EXIT_TIMEOUT):
+    self.daemons = daemons
+    self.signal = signal
+    self.duration = restart_after
+    self.exit_timeout = exit_timeout
+
+  def __repr__(self):
+    return "kill_daemons(%r, %d, %d)" % (self.daemons, self.signal, self.duration)
+
+  def inject(self, activation):
+    with activation.timed("discover"):
+      targets = []
+      for daemon in self.daemons:
+        pids = procutils.find_jvms(daemon)
+        if not pids:
+          logging.info("There was no %s running!" % daemon)
+        targets.extend((daemon, pid) for pid in pids)
+      activation.details["daemon_ports"] = _daemon_ports(self.daemons)
+    activation.details["pids"] = [pid for daemon, pid in targets]
+
+    for daemon in self.daemons:
+      undolog.record(activation, "restart", daemon=daemon)
+    # Watch before signalling, so a new process reusing a pid can never
+    # be mistaken for the daemon
+    watcher = procutils.watch_exits([pid for daemon, pid in targets])
+    try:
+      signalled = monotonic()
+      for daemon, pid in targets:
+        logging.info("Killing %s pid %d with signal %d" % (daemon, pid, self.signal))
+        try:
+          procutils.kill(pid, self.signal)
+        except OSError, e:
+          if e.errno != errno.ESRCH:
+            raise
+          logging.info("%s pid %d had already exited" % (daemon, pid))
+      exited = watcher.wait(self.exit_timeout)
+      survivors = watcher.running()
+    finally:
+      watcher.close()
+
+    activation.details["exited_after"] = dict(
+      (pid, round(when - signalled, 3)) for pid, when in exited.items())
+    # A daemon is down from the moment its last process exits
+    down_since = activation.details.setdefault("down_since", {})
+    for daemon, pid in targets:
+      if pid in exited:
+        down_since[daemon] = max(down_since.get(daemon, 0), exited[pid])
+    if survivors:
+      activation.details["survivors"] = survivors
+      logging.warn("Pids %s still running %d seconds after signal %d" %
+                   (repr(survivors), self.exit_timeout, self.signal))
+    logging.info("Restarting in %d seconds" % self.duration)
+
+  def revert(self, activation):
+    _restart_daemons(self.daemons, activation)
+
+def kill_daemons(daemons, signal, restart_after, exit_timeout=EXIT_TIMEOUT):
   """Kill the given daemons with the given signal, then
   restart them after the given number of seconds.
 
+  All the daemons are signalled together, and the wait before restarting
+  starts once they have actually exited. They are then all restarted at
+  once. How long each was really down is recorded in the fault's details.
+
   @param daemons: the names of the daemon (eg HRegionServer)
   @param signal: signal to kill with
-  @param restart_after: number of seconds to sleep before restarting
-  """
-  def do():
-    # First kill
-    for daemon in daemons:
-      pid = procutils.find_jvm(daemon)
-      if pid:
-        logging.info("Killing %s pid %d with signal %d" % (daemon, pid, signal))
-        os.kill(pid, signal)
-      else:
-        logging.info("There was no %s running!" % daemon)
+  @param restart_after: number of seconds to keep them down before restarting
+  @param exit_timeout: how long to wait for them to exit before starting
+                       the clock anyway
+  """
+  return KillDaemons(daemons, signal, restart_after, exit_timeout)
+
+class PauseDaemons(Fault):
+  def __init__(self, jvm_names, seconds):
+    self.jvm_names = jvm_names
+    self.duration = seconds
+
+  def __repr__(self):
+    return "pause_daemons(%r, %d)" % (self.jvm_names, self.duration)
 
-    logging.info("Sleeping for %d seconds" % restart_after)
-    time.sleep(restart_after)
+  def inject(self, activation):
+    # Look up every pid first so the daemons stop as close together as possible
+    with activation.timed("discover"):
+      targets = []
+      for jvm_name in self.jvm_names:
+        pids = procutils.find_jvms(jvm_name)
+        if not pids:
+          logging.warn("No pid found for %s" % jvm_name)
+        targets.extend((jvm_name, pid) for pid in pids)
+    activation.details["pids"] = [pid for jvm_name, pid in targets]
 
-    for daemon in daemons:
-      logging.info("Restarting %s" % daemon);
-      procutils.start_daemon(daemon)
-  return do
+    # Record each pid before stopping it, so revert resumes exactly
+    # what we stopped even if we fail part way through
+    stopped = activation.details.setdefault("stopped", [])
+    for jvm_name, pid in targets:
+      logging.warn("Suspending %s pid %d for %d seconds" % (jvm_name, pid, self.duration))
+      stopped.append((jvm_name, pid))
+      undolog.record_stop(activation, pid)
+      procutils.kill(pid, signal.SIGSTOP)
+
+  def revert(self, activation):
+    for jvm_name, pid in activation.details.get("stopped", []):
+      logging.warn("Resuming %s pid %d" % (jvm_name, pid))
+      try:
+        procutils.kill(pid, signal.SIGCONT)
+      except OSError, e:
+        logging.warn("Could not resume %s pid %d: %s" % (jvm_name, pid, e))
 
 def pause_daemons(jvm_names, seconds):
   """
@@ -56,103 +214,688 @@ def pause_daemons(jvm_names, seconds):
   @param jvm_names: the names of the class to pause: eg ["DataNode"]
   @param seconds: the number of seconds to pause for
   """
-  def do():
-    # Stop all daemons, record their pids
-    for jvm_name in jvm_names:
-      pid = procutils.find_jvm(jvm_name)
-      if not pid:
-        logging.warn("No pid found for %s" % jvm_name)
-        continue
-      logging.warn("Suspending %s pid %d for %d seconds" % (jvm_name, pid, seconds))
-      os.kill(pid, signal.SIGSTOP)
-
-    # Pause for prescribed amount of time
-    time.sleep(seconds)
-
-    # Resume them
-    for jvm_name in jvm_names:
-      pid = procutils.find_jvm(jvm_name)
-      if pid:
-        logging.warn("Resuming %s pid %d" % (jvm_name, pid))
-        os.kill(pid, signal.SIGCONT)
-  return do
-
-def drop_packets_to_daemons(daemons, seconds):
+  return PauseDaemons(jvm_names, seconds)
+
+class DropPacketsToDaemons(Fault):
+  def __init__(self, daemons, seconds, bidirectional=False):
+    self.daemons = daemons
+    self.duration = seconds
+    self.bidirectional = bidirectional
+    self.staged = []
+    self.staged_lock = threading.Lock()
+
+  def __repr__(self):
+    return "drop_packets_to_daemons(%r, %d)" % (self.daemons, self.duration)
+
+  def prepare(self):
+    staged = self._build(hook=False)
+    if staged:
+      logging.info("Staged gremlin chains %s for ports %s" % (repr(staged["chains"]), repr(staged["ports"])))
+      with self.staged_lock:
+        self.staged.append(staged)
+
+  def unprepare(self):
+    with self.staged_lock:
+      staged, self.staged = self.staged, []
+    for built in staged:
+      iptables.delete_user_chains(built["chains"])
+      ipsets.destroy(built["sets"])
+      undolog.undone(built["effects"])
+
+  def inject(self, activation):
+    logging.info("Going to drop packets from %s for %d seconds..." %
+                 (repr(self.daemons), self.duration))
+
+    with self.staged_lock:
+      staged = self.staged and self.staged.pop(0)
+    if staged:
+      # Already built by prepare(); just hook it in
+      activation.effects.extend(staged.pop("effects"))
+      activation.details.update(staged)
+      txn = iptables.Transaction()
+      iptables.hook_chains(txn, staged["chains"])
+      txn.commit()
+    else:
+      with activation.timed("discover"):
+        built = self._build(hook=True, activation=activation)
+      if not built:
+        logging.warn("No ports found for daemons: %s. Skipping fault." % repr(self.daemons))
+        return
+    logging.info("Gremlin chains %s installed for %d seconds" %
+                 (repr(activation.details["chains"]), self.duration))
+
+  def _build(self, hook, activation=None):
+    """
+    Fill ipsets with the daemons' ports (and, if bidirectional, the
+    servers they are connected to), and create chains dropping them.
+    """
+    pids, all_ports = self._find_ports()
+    if not all_ports:
+      return None
+    connections = []
+    uids = []
+    if self.bidirectional:
+      # Peers on loopback are other daemons on this host, which stay up
+      connections = [(local_port, ip, port)
+                     for local_port, ip, port in procutils.get_peer_connections(pids)
+                     if not ip.startswith("127.")]
+      uids = sorted(set(procutils.get_process_uids(pids).values()))
+    peers = sorted(set((ip, port) for local_port, ip, port in connections))
+    prefix = iptables.new_chain_name()
+    port_set = prefix + "_p"
+    sets = [port_set]
+    commands = ipsets.create_commands(port_set, ipsets.PORTS,
+                                      [ipsets.port_entry(port) for port in sorted(set(all_ports))])
+    peer_set = None
+    local_port_set = None
+    if peers:
+      peer_set = prefix + "_c"
+      local_port_set = prefix + "_l"
+      sets += [peer_set, local_port_set]
+      commands += ipsets.create_commands(peer_set, ipsets.IP_PORTS,
+                                         [ipsets.ip_port_entry(ip, port) for ip, port in peers])
+      local_ports = sorted(set(local_port for local_port, ip, port in connections))
+      commands += ipsets.create_commands(local_port_set, ipsets.PORTS,
+                                         [ipsets.port_entry(port) for port in local_ports])
+    chains = [prefix + "_INPUT"]
+    if self.bidirectional:
+      chains.append(prefix + "_OUTPUT")
+    built = {"pids": pids, "ports": all_ports, "peers": peers, "uids": uids, "sets": sets,
+             "chains": chains}
+    effects = []
+    if activation is not None:
+      effects = activation.effects
+      # Record the sets before creating them, so revert destroys them
+      # even if we fail part way through
+      activation.details.update(built)
+    undolog.record(effects, "ipsets", sets=sets)
+    ipsets.restore(commands)
+    undolog.record(effects, "chains", chains=chains)
+    try:
+      if hook:
+        install = iptables.install_gremlin_set_chains
+      else:
+        install = iptables.create_gremlin_set_chains
+      install(port_set, peer_set, inbound_only=not self.bidirectional, chain_prefix=prefix,
+              local_port_set=local_port_set, owner_uids=uids)
+    except Exception:
+      if activation is None:
+        ipsets.destroy(sets)
+        undolog.undone(effects)
+      else:
+        # The transaction failed as a whole, so there are no chains to remove
+        activation.details["chains"] = []
+      raise
+    if activation is None:
+      built["effects"] = effects
+    return built
+
+  def _find_ports(self):
+    return _find_ports(self.daemons)
+
+  def revert(self, activation):
+    chains = activation.details.get("chains")
+    if chains:
+      logging.info("Removing gremlin chains %s" % repr(chains))
+      iptables.unhook_chains(chains)
+      logging.info("Removed gremlin chains %s" % repr(chains))
+    sets = activation.details.get("sets")
+    if sets:
+      ipsets.destroy(sets)
+
+def drop_packets_to_daemons(daemons, seconds, bidirectional=False):
   """
   Determines which TCP ports the given daemons are listening on, and sets up
-  an iptables firewall rule to drop all packets to any of those ports
-  for a period of time.
+  iptables firewall rules to drop all packets to any of those ports for a
+  period of time.
+
+  If bidirectional is set, the daemons are cut off in both directions:
+  packets from their ports are dropped too, and so are packets between
+  the daemons and the servers they are connected to (eg ZooKeeper). Only
+  the daemons' own connections are cut, by their local ports, along with
+  new connections to those servers from sockets owned by the daemons'
+  users. Servers on loopback are left out, since they are other daemons
+  on this host.
+
+  The ports and servers are kept in ipsets, so each direction costs one
+  set lookup per packet however many there are.
 
   @param daemons: the JVM class names of the daemons
   @param seconds: how many seconds to drop packets for
+  @param bidirectional: also drop the daemons' outbound packets, and
+                        cut their connections to other servers
   """
-  def do():
-    logging.info("Going to drop packets from %s for %d seconds..." %
-                 (repr(daemons), seconds))
-
-    # Figure out what ports the daemons are listening on
-    all_ports = []
-    for daemon in daemons:
-      pid = procutils.find_jvm(daemon)
-      if not pid:
-        logging.warn("Daemon %s not running!" % daemon)
-        continue
-      ports = procutils.get_listening_ports(pid)
-      logging.info("%s is listening on ports: %s" % (daemon, repr(ports)))
-      all_ports.extend(ports)
+  return DropPacketsToDaemons(daemons, seconds, bidirectional)
 
-    if not all_ports:
-      logging.warn("No ports found for daemons: %s. Skipping fault." % repr(daemons))
+class PartitionHosts(Fault):
+  def __init__(self, groups, seconds):
+    self.groups = [list(group) for group in groups]
+    self.duration = seconds
+    # Check networks now, rather than when the fault first fires
+    for group in self.groups:
+      for host in group:
+        if "/" in host:
+          _parse_net(host)
+
+  def __repr__(self):
+    return "partition_hosts(%r, %d)" % (self.groups, self.duration)
+
+  def _others(self, local):
+    """Return the hosts in every group but the one this host belongs to."""
+    if len(self.groups) == 1:
+      return self.groups[0]
+    mine = [group for group in self.groups
+            if any(_is_local(_resolve(host), local) for host in group)]
+    if not mine:
+      logging.warn("This host (%s) is in none of the groups %r" % (", ".join(sorted(local)), self.groups))
+      return []
+    return [host for group in self.groups if group is not mine[0] for host in group]
+
+  def inject(self, activation):
+    with activation.timed("discover"):
+      local = _local_addresses()
+      hosts = set()
+      for host in self._others(local):
+        net = _resolve(host)
+        if not _is_local(net, local):
+          hosts.add(net)
+        elif "/" in net:
+          # Dropping it would cut this host off from itself, and from
+          # the loopback traffic health probes use
+          raise ValueError("Can't partition from %s, which holds this host's address" % host)
+        else:
+          logging.info("Not partitioning from %s, which is this host" % host)
+      hosts = sorted(hosts)
+    activation.details["hosts"] = hosts
+    if not hosts:
+      logging.warn("No hosts to partition from. Skipping fault.")
       return
+    prefix = iptables.new_chain_name()
+    host_set = prefix + "_h"
+    activation.details["sets"] = [host_set]
+    undolog.record(activation, "ipsets", sets=[host_set])
+    ipsets.create(host_set, ipsets.NETS, hosts)
+    undolog.record(activation, "chains", chains=[prefix + "_INPUT", prefix + "_OUTPUT"])
+    chains = iptables.install_gremlin_set_chains(host_set=host_set, chain_prefix=prefix)
+    activation.details["chains"] = chains
+    logging.info("Partitioned from %s for %d seconds" % (", ".join(hosts), self.duration))
+
+  def revert(self, activation):
+    chains = activation.details.get("chains")
+    if chains:
+      iptables.unhook_chains(chains)
+    sets = activation.details.get("sets")
+    if sets:
+      ipsets.destroy(sets)
+    logging.info("Healed partition from %s" % ", ".join(activation.details.get("hosts", [])))
+
+LOOPBACK_NET = "127.0.0.0/8"
+
+def _parse_net(spec):
+  """
+  Return the (address, prefix length) of an ipv4 address or CIDR
+  network, as integers, with the address masked to the network.
+  """
+  address, _, length = spec.partition("/")
+  try:
+    packed = socket.inet_pton(socket.AF_INET, address)
+    length = int(length) if length else 32
+  except (socket.error, ValueError):
+    raise ValueError("Bad address or network %r" % spec)
+  if not 0 <= length <= 32:
+    raise ValueError("Bad prefix length in %r" % spec)
+  mask = (0xffffffff << (32 - length)) & 0xffffffff
+  return struct.unpack("!I", packed)[0] & mask, length
 
-    # Set up a chain to drop the packets
-    chain = iptables.create_gremlin_chain(all_ports)
-    logging.info("Created iptables chain: %s" % chain)
-    iptables.add_user_chain_to_input_chain(chain)
+def _resolve(host):
+  """Return the address of a host, or a CIDR network in canonical form."""
+  if "/" in host:
+    address, length = _parse_net(host)
+    return "%s/%d" % (socket.inet_ntoa(struct.pack("!I", address)), length)
+  return socket.gethostbyname(host)
 
-    logging.info("Gremlin chain %s installed, sleeping %d seconds" % (chain, seconds))
-    time.sleep(seconds)
+def _overlaps(a, b):
+  (a_address, a_length), (b_address, b_length) = _parse_net(a), _parse_net(b)
+  mask = (0xffffffff << (32 - min(a_length, b_length))) & 0xffffffff
+  return a_address & mask == b_address & mask
 
-    logging.info("Removing gremlin chain %s" % chain)
-    iptables.remove_user_chain_from_input_chain(chain)
-    iptables.delete_user_chain(chain)
-    logging.info("Removed gremlin chain %s" % chain)
-  return do
+def _is_local(net, local):
+  """Return whether an address or network holds any of the local addresses."""
+  return any(_overlaps(net, address) for address in [LOOPBACK_NET] + sorted(local))
+
+def _local_addresses():
+  addresses = set(["127.0.0.1"])
+  try:
+    addresses.update(socket.gethostbyname_ex(socket.gethostname())[2])
+  except socket.error:
+    pass
+  return addresses
+
+def partition_hosts(groups, seconds):
+  """
+  Splits the cluster into groups of hosts that can't reach each other.
+
+  Fire it on every host (eg through a coordinator): each host drops all
+  traffic to and from the hosts in the other groups. With a single
+  group, this host is cut off from every host in it.
+
+  @param groups: lists of hostnames, ips or CIDR networks, eg
+                 [["rs1", "rs2"], ["rs3", "10.0.1.0/24"]]. This host's own
+                 addresses are never partitioned from, and a network
+                 holding one of them is refused
+  @param seconds: how long the partition lasts
+  """
+  return PartitionHosts(groups, seconds)
+
+class FailNetwork(Fault):
+  def __init__(self, bastion_host, seconds, restart_daemons=None, use_flush=False):
+    self.bastion_host = bastion_host
+    self.duration = seconds
+    self.restart_daemons = restart_daemons
+    self.use_flush = use_flush
+    self.staged = []
+    self.staged_lock = threading.Lock()
+
+  def __repr__(self):
+    return "fail_network(%r, %d)" % (self.bastion_host, self.duration)
+
+  def prepare(self):
+    chains = iptables.create_gremlin_network_failure(resolve(self.bastion_host))
+    logging.info("Staged gremlin chains %s" % repr(chains))
+    with self.staged_lock:
+      self.staged.append(chains)
+
+  def unprepare(self):
+    with self.staged_lock:
+      staged, self.staged = self.staged, []
+    if staged:
+      iptables.delete_user_chains(sum(staged, []))
+
+  def inject(self, activation):
+    bastion_host = resolve(self.bastion_host)
+    logging.info("Going to drop all networking (save ssh with %s) for %d seconds..." %
+                 (bastion_host, self.duration))
+    with self.staged_lock:
+      chains = self.staged and self.staged.pop(0)
+    if chains:
+      # Already built by prepare(); just hook them in
+      undolog.record(activation, "chains", chains=chains)
+      txn = iptables.Transaction()
+      txn.jump("INPUT", chains[0])
+      txn.jump("OUTPUT", chains[1])
+      txn.commit()
+    else:
+      # TODO check connectivity, or atleast DNS resolution, for bastion_host
+      # Name the chains up front, so the undo log can say which they are
+      prefix = iptables.new_chain_name()
+      undolog.record(activation, "chains", chains=[prefix + "_INPUT", prefix + "_OUTPUT"])
+      chains = iptables.install_gremlin_network_failure(bastion_host, chain_prefix=prefix)
+    activation.details["chains"] = chains
+    if self.restart_daemons:
+      activation.details["daemon_ports"] = _daemon_ports(self.restart_daemons)
+    logging.info("Gremlin chains %s installed for %d seconds" % (repr(chains), self.duration))
+
+  def revert(self, activation):
+    chains = activation.details.get("chains")
+    if chains:
+      if self.use_flush:
+        logging.info("Using flush to remove gremlin chains")
+        iptables.flush()
+        iptables.delete_user_chains(chains)
+      else:
+        logging.info("Removing gremlin chains %s" % repr(chains))
+        iptables.uninstall_gremlin_chains(input_chains=[chains[0]],
+                                          output_chains=[chains[1]])
+      logging.info("Removed gremlin chains %s" % repr(chains))
+    if self.restart_daemons:
+      logging.info("Restarting daemons: %s", repr(self.restart_daemons))
+      _restart_daemons(self.restart_daemons, activation)
 
 def fail_network(bastion_host, seconds, restart_daemons=None, use_flush=False):
   """
   Cuts off all network traffic for this host, save ssh to/from a given bastion host,
   for a period of time.
 
-  @param bastion_host: a host or ip to allow ssh with, just in case
+  @param bastion_host: a host or ip to allow ssh with, just in case; may be
+                       a runtime.Lazy, resolved when the fault first fires
   @param seconds: how many seconds to drop packets for
   @param restart_daemons: optional list of daemon processes to restart after network is restored
   @param use_flush: optional param to issue an iptables flush rather than manually remove chains from INPUT/OUTPUT
   """
-  def do():
-    logging.info("Going to drop all networking (save ssh with %s) for %d seconds..." %
-                 (bastion_host, seconds))
-    # TODO check connectivity, or atleast DNS resolution, for bastion_host
-    chains = iptables.create_gremlin_network_failure(bastion_host)
-    logging.info("Created iptables chains: %s" % repr(chains))
-    iptables.add_user_chain_to_input_chain(chains[0])
-    iptables.add_user_chain_to_output_chain(chains[1])
-
-    logging.info("Gremlin chains %s installed, sleeping %d seconds" % (repr(chains), seconds))
-    time.sleep(seconds)
-
-    if use_flush:
-      logging.info("Using flush to remove gremlin chains")
-      iptables.flush()
-    else:
-      logging.info("Removing gremlin chains %s" % repr(chains))
-      iptables.remove_user_chain_from_input_chain(chains[0])
-      iptables.remove_user_chain_from_output_chain(chains[1])
-    iptables.delete_user_chain(chains[0])
-    iptables.delete_user_chain(chains[1])
-    logging.info("Removed gremlin chains %s" % repr(chains))
-    if restart_daemons:
-      logging.info("Restarting daemons: %s", repr(restart_daemons))
-      for daemon in restart_daemons:
-        procutils.start_daemon(daemon)
-  return do
+  return FailNetwork(bastion_host, seconds, restart_daemons, use_flush)
+
+class CgroupLimitDaemons(Fault):
+  def __init__(self, daemons, settings, seconds, name):
+    self.daemons = daemons
+    self.settings = settings
+    self.duration = seconds
+    self.name = name
+
+  def __repr__(self):
+    return "%s(%r, %r, %d)" % (self.name, self.daemons, self.settings, self.duration)
+
+  def _settings(self, activation):
+    """Return the limits to create the cgroup with, for this activation."""
+    return self.settings
+
+  def inject(self, activation):
+    with activation.timed("discover"):
+      pids = []
+      for daemon in self.daemons:
+        daemon_pids = procutils.find_jvms(daemon)
+        if not daemon_pids:
+          logging.warn("No pid found for %s" % daemon)
+        pids.extend(daemon_pids)
+      # Take the children too, so eg a daemon's wrapper scripts and
+      # forked helpers are starved alongside it
+      tree = procutils.process_tree(pids)
+      origins = []
+      for pid in tree:
+        try:
+          origins.append((pid, cgroups.cgroup_of(pid)))
+        except (IOError, OSError):
+          # Exited since the scan
+          continue
+    activation.details["pids"] = tree
+    if not origins:
+      logging.warn("No processes found for %s. Skipping fault." % repr(self.daemons))
+      return
+
+    settings = self._settings(activation)
+    name = cgroups.new_name()
+    cgroup = "/%s/%s" % (cgroups.PARENT, name)
+    activation.details["cgroup"] = cgroup
+    undolog.record(activation, "cgroup", cgroup=cgroup, moves=origins)
+    cgroups.create(name, settings)
+    # Record each pid before moving it, so revert moves back exactly
+    # what we moved even if we fail part way through
+    moved = activation.details.setdefault("moved", [])
+    for pid, origin in origins:
+      moved.append((pid, origin))
+      cgroups.move(pid, cgroup)
+    logging.warn("Moved %s pids %s into %s with %r for %d seconds" %
+                 (repr(self.daemons), repr([pid for pid, origin in moved]), cgroup,
+                  settings, self.duration))
+
+  def revert(self, activation):
+    cgroup = activation.details.get("cgroup")
+    if not cgroup:
+      return
+    if self.settings.get("cgroup.freeze"):
+      cgroups.write(cgroup, "cgroup.freeze", 0)
+    moved = activation.details.get("moved", [])
+    for pid, origin in moved:
+      self._move_back(pid, origin)
+    # Anything the daemons forked while throttled goes back with them
+    if moved:
+      for pid in cgroups.procs(cgroup):
+        self._move_back(pid, moved[0][1])
+    try:
+      cgroups.remove(cgroup)
+    except OSError, e:
+      logging.warn("Could not remove %s: %s" % (cgroup, e))
+    logging.warn("Restored %s pids %s to their original cgroups" %
+                 (repr(self.daemons), repr([pid for pid, origin in moved])))
+
+  def _move_back(self, pid, origin):
+    try:
+      cgroups.move(pid, origin)
+    except (IOError, OSError), e:
+      if e.errno != errno.ESRCH:
+        logging.warn("Could not move pid %d back to %s: %s" % (pid, origin, e))
+
+def throttle_cpu(daemons, cpus, seconds, period_us=100000):
+  """
+  Limit the given daemons, and everything they have forked, to a share
+  of CPU time using the cgroup v2 cpu.max limit.
+
+  @param daemons: the JVM class names of the daemons
+  @param cpus: how many CPUs worth of time to allow, eg 0.1
+  @param seconds: how long to throttle for
+  @param period_us: the cpu.max accounting period, in microseconds
+  """
+  quota = max(1000, int(cpus * period_us))
+  return CgroupLimitDaemons(daemons, {"cpu.max": "%d %d" % (quota, period_us)},
+                            seconds, "throttle_cpu")
+
+def freeze_daemons(daemons, seconds):
+  """
+  Freeze the given daemons and their whole process tree with the
+  cgroup v2 freezer, then thaw them.
+
+  @param daemons: the JVM class names of the daemons
+  @param seconds: how long to freeze for
+  """
+  return CgroupLimitDaemons(daemons, {"cgroup.freeze": 1}, seconds, "freeze_daemons")
+
+def limit_memory(daemons, high_bytes, seconds):
+  """
+  Put the given daemons under memory pressure with the cgroup v2
+  memory.high limit: above it they are throttled and reclaimed from
+  rather than killed.
+
+  Note that cgroup v2 does not move already-charged memory between
+  cgroups, so only memory the daemons touch during the fault counts
+  against the limit.
+
+  @param daemons: the JVM class names of the daemons
+  @param high_bytes: the memory.high limit, in bytes
+  @param seconds: how long to apply the limit for
+  """
+  return CgroupLimitDaemons(daemons, {"memory.high": int(high_bytes)}, seconds, "limit_memory")
+
+class ThrottleIO(CgroupLimitDaemons):
+  def __init__(self, daemons, device, limits, seconds):
+    CgroupLimitDaemons.__init__(self, daemons, {}, seconds, "throttle_io")
+    self.device = device
+    self.limits = limits
+
+  def __repr__(self):
+    return "throttle_io(%r, %r, %r, %d)" % (self.daemons, self.device, self.limits, self.duration)
+
+  def _settings(self, activation):
+    # Looked up as the fault fires, as the disk may not be mounted (or
+    # the path not exist) when a profile is loaded
+    number = cgroups.device_number(self.device)
+    activation.details["device"] = number
+    return {"io.max": " ".join([number] + self.limits)}
+
+def throttle_io(daemons, device, seconds, rbps=None, wbps=None, riops=None, wiops=None):
+  """
+  Limit the given daemons' bandwidth and IOPS on a disk using the
+  cgroup v2 io.max limit.
+
+  @param daemons: the JVM class names of the daemons
+  @param device: the disk, as a "MAJOR:MINOR" number, a block device,
+                 or any path stored on it (eg the DataNode data dir)
+  @param seconds: how long to throttle for
+  @param rbps, wbps: read and write bytes per second
+  @param riops, wiops: read and write operations per second
+  """
+  limits = []
+  for key, value in (("rbps", rbps), ("wbps", wbps), ("riops", riops), ("wiops", wiops)):
+    if value is not None:
+      limits.append("%s=%d" % (key, value))
+  return ThrottleIO(daemons, device, limits, seconds)
+
+class DegradeNetworkToDaemons(Fault):
+  def __init__(self, daemons, seconds, netem_args, devices=None):
+    self.daemons = daemons
+    self.duration = seconds
+    self.netem_args = netem_args
+    self.devices = devices
+
+  def __repr__(self):
+    return "degrade_network_to_daemons(%r, %d, %r)" % (
+      self.daemons, self.duration, " ".join(self.netem_args))
+
+  def inject(self, activation):
+    with activation.timed("discover"):
+      pids, all_ports = _find_ports(self.daemons)
+      devices = self.devices or netem.default_devices()
+    activation.details["pids"] = pids
+    activation.details["ports"] = all_ports
+    if not all_ports:
+      logging.warn("No ports found for daemons: %s. Skipping fault." % repr(self.daemons))
+      return
+    activation.details["netem"] = netem.install(devices, sorted(set(all_ports)), self.netem_args)
+    logging.info("Degrading traffic on ports %s via %s (%s) for %d seconds" %
+                 (repr(all_ports), ", ".join(devices), " ".join(self.netem_args), self.duration))
+
+  def revert(self, activation):
+    slots = activation.details.get("netem")
+    if not slots:
+      return
+    netem.uninstall(slots)
+    logging.info("Restored traffic on ports %s" % repr(activation.details["ports"]))
+
+def degrade_network_to_daemons(daemons, seconds, delay_ms=0, jitter_ms=0, loss=0,
+                               rate=None, reorder=0, correlation=0, devices=None):
+  """
+  Degrades, rather than drops, traffic to and from the TCP ports the
+  given daemons listen on, using tc netem.
+
+  @param daemons: the JVM class names of the daemons
+  @param seconds: how many seconds to degrade traffic for
+  @param delay_ms: latency to add to each packet
+  @param jitter_ms: random variation of the added latency
+  @param loss: percent of packets to drop, eg 5
+  @param rate: bandwidth cap, eg "1mbit"
+  @param reorder: percent of packets to send out of order (needs a delay)
+  @param correlation: percent correlation between successive packets
+  @param devices: network devices to shape; defaults to the one with the
+                  default route, and lo
+  """
+  args = netem.netem_args(delay_ms=delay_ms, jitter_ms=jitter_ms, correlation=correlation,
+                          loss=loss, rate=rate, reorder=reorder)
+  return DegradeNetworkToDaemons(daemons, seconds, args, devices)
+
+def delay_packets_to_daemons(daemons, delay_ms, seconds, jitter_ms=0, devices=None):
+  """Add delay_ms (plus or minus jitter_ms) of latency to the daemons' traffic."""
+  return degrade_network_to_daemons(daemons, seconds, delay_ms=delay_ms,
+                                    jitter_ms=jitter_ms, devices=devices)
+
+def lose_packets_to_daemons(daemons, percent, seconds, devices=None):
+  """Drop the given percentage of the daemons' packets."""
+  return degrade_network_to_daemons(daemons, seconds, loss=percent, devices=devices)
+
+def limit_bandwidth_to_daemons(daemons, rate, seconds, devices=None):
+  """Cap the daemons' traffic at the given rate, eg "10mbit"."""
+  return degrade_network_to_daemons(daemons, seconds, rate=rate, devices=devices)
+
+def reorder_packets_to_daemons(daemons, percent, seconds, delay_ms=10, devices=None):
+  """Send the given percentage of the daemons' packets ahead of the rest, which are delayed."""
+  return degrade_network_to_daemons(daemons, seconds, delay_ms=delay_ms,
+                                    reorder=percent, devices=devices)
+
+class LoadDisk(Fault):
+  def __init__(self, directory, seconds, options):
+    self.directory = directory
+    self.duration = seconds
+    self.options = options
+    self.lock = threading.Lock()
+    # activation id -> DiskLoad
+    self.loads = {}
+
+  def __repr__(self):
+    return "load_disk(%r, %d, %r)" % (self.directory, self.duration, self.options)
+
+  def inject(self, activation):
+    load = diskload.DiskLoad(self.directory, **self.options)
+    activation.details["file"] = load.path
+    with self.lock:
+      self.loads[activation.id] = load
+    undolog.record(activation, "file", path=load.path)
+    load.start()
+    logging.warn("Generating %s load on %s (%s iops, direct=%s) for %d seconds" %
+                 (load.pattern, self.directory, load.iops or "max", load.direct, self.duration))
+
+  def revert(self, activation):
+    with self.lock:
+      load = self.loads.pop(activation.id, None)
+    if load is None:
+      return
+    try:
+      activation.details["throughput"] = load.stop()
+    finally:
+      load.remove()
+    logging.warn("Stopped load on %s: %r" % (self.directory, activation.details["throughput"]))
+
+def load_disk(directory, seconds, pattern="randwrite", block_size=4096, iops=None, bps=None,
+              file_size=256 << 20, threads=4, fsync_every=0, direct=True):
+  """
+  Contend for a volume's IOPS and bandwidth by generating disk load on
+  it. The achieved throughput is recorded in the fault's details.
+
+  @param directory: a directory on the volume, eg an HDFS data dir
+  @param seconds: how long to generate load for
+  @param pattern: seqread, randread, seqwrite, randwrite or randrw
+  @param block_size: bytes per operation, a multiple of 4096
+  @param iops: target operations per second; None for as many as the disk allows
+  @param bps: target bytes per second, instead of iops
+  @param file_size: size of the scratch file the load runs against
+  @param threads: how many operations to keep in flight
+  @param fsync_every: fdatasync after every this many writes (0 for never)
+  @param direct: bypass the page cache with O_DIRECT, where supported
+  """
+  return LoadDisk(directory, seconds,
+                  dict(pattern=pattern, block_size=block_size, iops=iops, bps=bps,
+                       file_size=file_size, threads=threads, fsync_every=fsync_every,
+                       direct=direct))
+
+def fsync_storm(directory, seconds, syncs_per_second=None, block_size=4096):
+  """
+  Compete with WAL syncs on a volume: small sequential writes, each
+  followed by an fdatasync.
+
+  @param syncs_per_second: target rate; None for as many as the disk allows
+  """
+  return load_disk(directory, seconds, pattern="seqwrite", block_size=block_size,
+                   iops=syncs_per_second, threads=1, fsync_every=1,
+                   file_size=64 << 20)
+
+class InflateBalloon(Fault):
+  def __init__(self, size, seconds, options):
+    self.size = size
+    self.duration = seconds
+    self.options = options
+    self.lock = threading.Lock()
+    # activation id -> Balloon
+    self.balloons = {}
+
+  def __repr__(self):
+    return "inflate_balloon(%d, %d, %r)" % (self.size, self.duration, self.options)
+
+  def inject(self, activation):
+    memory = balloon.Balloon(self.size, **self.options)
+    with self.lock:
+      self.balloons[activation.id] = memory
+    memory.start()
+    logging.warn("Inflating a %dMB memory balloon (floor %dMB) for %d seconds" %
+                 (self.size >> 20, memory.floor >> 20, self.duration))
+
+  def revert(self, activation):
+    with self.lock:
+      memory = self.balloons.pop(activation.id, None)
+    if memory is None:
+      return
+    activation.details["balloon"] = memory.stop()
+    logging.warn("Deflated memory balloon: %r" % activation.details["balloon"])
+
+def inflate_balloon(size, seconds, ramp_rate=None, lock=False, floor=None, chunk_size=64 << 20):
+  """
+  Take memory away from the host with a balloon of anonymous memory, to
+  squeeze the page cache or, with lock=True, push daemons into swap.
+  What the balloon actually reached is recorded in the fault's details.
+
+  @param size: bytes to take
+  @param seconds: how long to hold the balloon, including the ramp
+  @param ramp_rate: bytes per second to inflate at; None for all at once
+  @param lock: mlock the balloon so it stays resident (needs root, or a
+               high enough RLIMIT_MEMLOCK)
+  @param floor: bytes of MemAvailable the balloon always leaves the host;
+                by default 5% of MemTotal, and at least 256MB
+  @param chunk_size: bytes allocated (and locked) at a time
+  """
+  return InflateBalloon(int(size), seconds,
+                        dict(ramp_rate=ramp_rate, lock=lock, floor=floor, chunk_size=chunk_size))
@@ -18,7 +18,9 @@
 
 import random
 import time
-from gremlins import faults, profiles
+# Only what every run needs, plus what fault expressions refer to; the
+# rest is imported by the modes that use it, to keep startup quick
+from gremlins import events, faults, probes, procutils, profiles, runtime, triggers, undolog
 import signal
 import logging
 from optparse import OptionParser
@@ -27,18 +29,146 @@ import sys
 LOG_FORMAT='%(asctime)s %(module)-12s %(levelname)-8s %(message)s'
 logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
-def run_profile(profile):
+def _interrupt(signum, frame):
+  raise KeyboardInterrupt()
+
+def choose_seed(seed):
+  if seed is None:
+    seed = random.SystemRandom().getrandbits(32)
+  logging.info("Using seed %d; rerun with --seed %d to repeat this run's choices" % (seed, seed))
+  return seed
+
+def run_profile(profile, seed=None):
+  fault_runtime = runtime.Runtime()
+  runtime.install(fault_runtime)
+  signal.signal(signal.SIGTERM, _interrupt)
+
+  triggers.seed_triggers(profile, choose_seed(seed))
   for trigger in profile:
     trigger.start()
 
   logging.info("Started profile")
-  while True:
-    time.sleep(1)
+  try:
+    while True:
+      signal.pause()
+  except KeyboardInterrupt:
+    logging.info("Interrupted, stopping profile")
 
   for trigger in profile:
     trigger.stop()
+
+  active = fault_runtime.active()
+  logging.info("Reverting %d active faults" % len(active))
+  fault_runtime.shutdown()
+
+  for trigger in profile:
     trigger.join()
 
+  probes.report()
+
+def install_fake_backend():
+  """Replace the host with a fake one running each startable daemon."""
+  from gremlins import backends
+  backend = backends.FakeBackend()
+  for i, daemon in enumerate(sorted(procutils.START_COMMANDS)):
+    backend.add_daemon(daemon, ports=[50000 + 10 * i, 50001 + 10 * i])
+  procutils.set_backend(backend)
+  logging.info("Using a fake host with daemons %s" % ", ".join(sorted(procutils.START_COMMANDS)))
+
+def install_undo_log(path):
+  leftover = undolog.pending(path)
+  if leftover:
+    logging.warn("%s lists %d side effects an earlier gremlin never undid; "
+                 "run with --recover to undo them" % (path, len(leftover)))
+  try:
+    undolog.install(undolog.UndoLog(path))
+  except OSError, e:
+    logging.warn("Not keeping an undo log, cannot open %s: %s" % (path, e))
+
+def run_agent(port, namespace, registry=None, host=None, secret=None):
+  from gremlins import agent
+  fault_runtime = runtime.Runtime()
+  runtime.install(fault_runtime)
+  signal.signal(signal.SIGTERM, _interrupt)
+
+  # With a declarative profile, the agent fires its faults by name and
+  # evaluates nothing
+  if registry is not None:
+    namespace = None
+  gremlin_agent = agent.Agent(port, namespace, host=host or agent.DEFAULT_HOST,
+                              registry=registry, secret=secret)
+  gremlin_agent.start()
+  try:
+    while True:
+      signal.pause()
+  except KeyboardInterrupt:
+    logging.info("Interrupted, stopping agent")
+  gremlin_agent.stop()
+
+def run_simulation(profile, seconds, seed, names, timeline_path=None):
+  from gremlins import simulator
+  timeline = simulator.simulate(profile, seconds, choose_seed(seed), names)
+  logging.info("Simulated %d faults in %.0f seconds of profile" % (len(timeline), seconds))
+  if timeline_path:
+    with open(timeline_path, "w") as out:
+      simulator.write_timeline(timeline, out)
+  else:
+    simulator.write_timeline(timeline, sys.stdout)
+
+def run_replay(timeline_path, lookup, speed):
+  from gremlins import simulator
+  fault_runtime = runtime.Runtime()
+  runtime.install(fault_runtime)
+  signal.signal(signal.SIGTERM, _interrupt)
+
+  timeline = simulator.read_timeline(timeline_path)
+  logging.info("Replaying %d faults from %s" % (len(timeline), timeline_path))
+  try:
+    simulator.replay(timeline, lookup, speed)
+    while fault_runtime.active():
+      time.sleep(1)
+  except KeyboardInterrupt:
+    logging.info("Interrupted, stopping replay")
+  fault_runtime.shutdown()
+  probes.report()
+
+def run_coordinated(agents, fault_names, secret=None):
+  from gremlins import coordinator
+  coord = coordinator.Coordinator(agents, secret=secret)
+  try:
+    coord.sync_clocks()
+    for fault_name in fault_names:
+      try:
+        results = coord.fire_all(fault_name)
+      except coordinator.FireError, e:
+        logging.error(str(e))
+        results = e.results
+      for client, response, error in results:
+        if error:
+          logging.error("%s: %s" % (client.address, error))
+        else:
+          logging.info("%s: fired %s at %.3f" % (client.address, fault_name, response["fired_at"]))
+  finally:
+    coord.close()
+
+class LazyModules(object):
+  """
+  The -m modules, by the last part of their names, each imported the
+  first time an expression refers to it: a profile that guesses hosts or
+  stages chains at import costs nothing unless it is used.
+  """
+  def __init__(self, modules):
+    self.paths = dict((m.split(".")[-1], m) for m in modules)
+    self.imported = {}
+
+  def __getitem__(self, name):
+    if name not in self.imported:
+      path = self.paths[name]
+      self.imported[name] = __import__(path, {}, {}, name)
+    return self.imported[name]
+
+  def load_all(self):
+    return dict((name, self[name]) for name in self.paths)
 
 def main():
   parser = OptionParser()
@@ -46,39 +176,176 @@ def main():
     help="module to import", metavar="MODULE", action="append")
   parser.add_option("-p", "--profile", dest="profile",
     help="fault profile to run", metavar='PROFILE')
+  parser.add_option("-d", "--profile-file", dest="profile_file",
+    help="compile a declarative (JSON or YAML) profile: -f, --replay and the agent "
+         "then find faults by its names, and on its own its triggers are run", metavar='FILE')
   parser.add_option("-f", "--fault", dest="faults", action="append",
     help="faults to run", metavar='FAULT')
+  parser.add_option("-e", "--events", dest="events",
+    help="append a structured journal of fault events to FILE", metavar='FILE')
+  parser.add_option("--fake", dest="fake", action="store_true",
+    help="run against an in-memory fake host instead of this one")
+  parser.add_option("-a", "--agent", dest="agent_port", type="int",
+    help="run as an agent, taking commands on the given port", metavar='PORT')
+  parser.add_option("-c", "--coordinate", dest="agents", action="append",
+    help="fire the -f faults simultaneously on the given agent", metavar='HOST:PORT')
+  parser.add_option("--agent-host", dest="agent_host",
+    help="address for the agent to listen on (default 127.0.0.1; any other needs a secret)",
+    metavar='ADDRESS')
+  parser.add_option("--agent-secret-file", dest="agent_secret_file",
+    help="authenticate agent connections with the shared secret in FILE", metavar='FILE')
+  parser.add_option("--seed", dest="seed", type="int",
+    help="seed the profile's random choices, to repeat an earlier run", metavar='SEED')
+  parser.add_option("--simulate", dest="simulate", type="float",
+    help="instead of running the profile, print the faults it would fire "
+         "in its first SECONDS", metavar='SECONDS')
+  parser.add_option("--timeline", dest="timeline",
+    help="write the --simulate timeline to FILE rather than stdout", metavar='FILE')
+  parser.add_option("--replay", dest="replay",
+    help="fire the faults of a --simulate timeline at their recorded times", metavar='FILE')
+  parser.add_option("--speed", dest="speed", type="float", default=1.0,
+    help="replay this many times faster than recorded")
+  parser.add_option("-u", "--undo-log", dest="undo_log",
+    help="record side effects in FILE before applying them (default %s, "
+         "or none with --fake)" % undolog.DEFAULT_PATH, metavar='FILE')
+  parser.add_option("--recover", dest="recover", action="store_true",
+    help="undo whatever a gremlin that died mid-fault left behind, and exit")
+  parser.add_option("-x", "--executor", dest="executor", action="store_true",
+    help="run commands in a long-lived helper process instead of forking for each")
+  parser.add_option("--executor-user", dest="executor_users", action="append",
+    help="with -x, also keep a helper running as USER, for start commands that sudo to it",
+    metavar='USER')
+  parser.add_option("--probe", dest="probe_endpoints", action="append",
+    help="while running, probe the latency of HOST:PORT and report it per fault at the end",
+    metavar='HOST:PORT')
+  parser.add_option("--probe-rate", dest="probe_rate", type="float", default=10.0,
+    help="probes per second to each --probe endpoint")
+  parser.add_option("--probe-mode", dest="probe_mode", default="connect",
+    help="connect: time TCP connects; echo: time a round trip over an open connection")
+  parser.add_option("--metrics-port", dest="metrics_port", type="int",
+    help="serve Prometheus metrics about gremlins itself on PORT", metavar='PORT')
+  parser.add_option("--profiler", dest="profiler", action="store_true",
+    help="toggle a sampling profiler of gremlins itself on SIGUSR2")
 
   (options, args) = parser.parse_args()
 
+  # A profile file on its own is a profile to run
+  run_profile_file = options.profile_file and not (options.profile or options.faults or
+                                                  options.agent_port or options.replay or
+                                                  options.recover)
+
   things_to_do = 0
-  if options.profile: things_to_do += 1
+  if options.profile or run_profile_file: things_to_do += 1
   if options.faults: things_to_do += 1
+  if options.agent_port: things_to_do += 1
+  if options.replay: things_to_do += 1
+  if options.recover: things_to_do += 1
 
-  if len(args) > 0 or things_to_do != 1:
+  if len(args) > 0 or things_to_do != 1 or (options.agents and not options.faults) \
+      or (options.simulate and not (options.profile or run_profile_file)):
     parser.print_help(sys.stderr)
     sys.exit(1)
 
-  print repr(options)
-  imported_modules = {}
-  for m in options.modules:
-    name = m.split(".")[-1]
-    imported = __import__(m, {}, {}, name)
-    imported_modules[name] = imported
+  logging.debug("Options: %s" % repr(options))
+  if options.events:
+    events.install(events.EventLog(options.events))
+  if options.fake:
+    install_fake_backend()
+  elif options.executor:
+    procutils.set_backend(procutils.ExecutorBackend(options.executor_users or []))
+  if options.profiler:
+    from gremlins import profiler
+    profiler.install()
+  if options.metrics_port:
+    from gremlins import metrics
+    metrics.MetricsServer(options.metrics_port).start()
+
+  undo_log_path = options.undo_log
+  if undo_log_path is None and not options.fake:
+    undo_log_path = undolog.DEFAULT_PATH
+  if options.recover:
+    undolog.recover(undo_log_path or undolog.DEFAULT_PATH)
+    return
+  if undo_log_path and not options.agents and not options.simulate:
+    install_undo_log(undo_log_path)
+
+  agent_secret = None
+  if options.agent_secret_file:
+    from gremlins import agent
+    try:
+      agent_secret = agent.read_secret(options.agent_secret_file)
+    except (IOError, ValueError), e:
+      parser.error("Cannot read agent secret: %s" % e)
+
+  if options.agents:
+    run_coordinated(options.agents, options.faults, agent_secret)
+    return
+
+  modules = LazyModules(options.modules or [])
 
   def eval_arg(arg):
-    eval_globals = dict(globals())
-    eval_globals.update(imported_modules)
-    return eval(arg, eval_globals)
+    # Names not found among the modules fall through to the globals
+    return eval(arg, dict(globals()), modules)
+
+  def full_namespace():
+    namespace = dict(globals())
+    namespace.update(modules.load_all())
+    return namespace
+
+  compiled = None
+  registry = None
+  if options.profile_file:
+    from gremlins import declarative
+    try:
+      compiled = declarative.compile_file(options.profile_file)
+    except declarative.ProfileError, e:
+      logging.error("Invalid profile: %s" % e)
+      sys.exit(1)
+    registry = compiled.faults
+
+  def lookup(arg):
+    """Find a fault by name in the profile file, or else evaluate it."""
+    if registry is not None and arg in registry:
+      return registry[arg]
+    return eval_arg(arg)
 
   if options.profile:
-    run_profile(eval_arg(options.profile))
-  elif options.faults:
-    for fault_arg in options.faults:
-      fault = eval_arg(fault_arg)
-      fault()
+    profile = eval_arg(options.profile)
+  elif run_profile_file:
+    profile = compiled.triggers()
 
-if __name__ == "__main__":
-  main()
+  probe = None
+  if options.probe_endpoints:
+    from gremlins import latency
+    try:
+      endpoints = [latency.parse_endpoint(spec) for spec in options.probe_endpoints]
+      probe = latency.LatencyProbe(endpoints, rate=options.probe_rate, mode=options.probe_mode)
+    except ValueError, e:
+      parser.error(str(e))
+    probe.start()
 
+  try:
+    if options.agent_port:
+      run_agent(options.agent_port, full_namespace(), registry, options.agent_host,
+                agent_secret)
+    elif options.simulate:
+      from gremlins import simulator
+      names = simulator.fault_names(full_namespace())
+      if compiled is not None:
+        names.update(compiled.names)
+      run_simulation(profile, options.simulate, options.seed, names, options.timeline)
+    elif options.profile or run_profile_file:
+      run_profile(profile, options.seed)
+    elif options.replay:
+      run_replay(options.replay, lookup, options.speed)
+    elif options.faults:
+      for fault_arg in options.faults:
+        fault = lookup(fault_arg)
+        fault()
+  finally:
+    if probe is not None:
+      probe.stop()
+      probe.report()
 
+if __name__ == "__main__":
+  main()
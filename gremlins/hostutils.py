@@ -16,10 +16,62 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""
+Guessing things about the operator's host.
+
+Logins are read straight out of wtmp, newest first, rather than by
+running last(1), which reads the whole file (hundreds of MB on a
+long-lived host) before printing anything.
+"""
 import os
-from gremlins import procutils, iptables
+import struct
+
+WTMP = os.getenv("GREMLINS_WTMP", "/var/log/wtmp")
+
+# struct utmp, as laid out on Linux (the same on 32 and 64 bit): type,
+# pid, line, id, user, host, exit status, session, time, address, unused
+UTMP_FORMAT = "<hxxi32s4s32s256shhi2i4i20x"
+UTMP_SIZE = struct.calcsize(UTMP_FORMAT)
+
+USER_PROCESS = 7
+
+# Records read per seek when scanning backwards
+RECORDS_PER_READ = 256
+
+def _cstring(field):
+  return field.split("\0", 1)[0]
 
-LASTCMD = "/usr/bin/last"
+def iter_records_backward(path=WTMP):
+  """
+  Yield (type, user, host) for each login record in a wtmp or utmp
+  file, newest first, reading it from the end in blocks.
+  """
+  f = open(path, "rb")
+  try:
+    f.seek(0, os.SEEK_END)
+    # Ignore a record torn by a crash mid-write
+    end = f.tell() // UTMP_SIZE * UTMP_SIZE
+    block = RECORDS_PER_READ * UTMP_SIZE
+    while end > 0:
+      start = max(0, end - block)
+      f.seek(start)
+      data = f.read(end - start)
+      for offset in xrange(len(data) - UTMP_SIZE, -1, -UTMP_SIZE):
+        fields = struct.unpack_from(UTMP_FORMAT, data, offset)
+        yield fields[0], _cstring(fields[4]), _cstring(fields[5])
+      end = start
+  finally:
+    f.close()
+
+def last_login_host(user, path=WTMP):
+  """
+  Return the host the given user most recently logged in from, or None
+  if wtmp has no remote login for them.
+  """
+  for record_type, record_user, host in iter_records_backward(path):
+    if record_type == USER_PROCESS and record_user == user and host:
+      return host
+  return None
 
 def guess_remote_host():
   """
@@ -30,7 +82,9 @@ def guess_remote_host():
   if sudo_user:
     user = sudo_user
   if user:
-    last = procutils.run([LASTCMD, "-a", user, "-n", "1"]).splitlines()[0]
-    return last.rpartition(' ')[2]
+    try:
+      return last_login_host(user)
+    except IOError:
+      return None
   else:
     return None
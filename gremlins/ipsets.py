@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers for ipset, which lets a single iptables rule match a whole set
+of ports, hosts or host:port pairs with one hash (or bitmap) lookup per
+packet, however many members the set has.
+
+Sets can be changed with add() and remove() while rules reference them,
+without touching the rules. A set can only be destroyed once no rule
+references it.
+
+Each change is a single ipset restore.
+"""
+import os
+
+from gremlins import procutils
+
+IPSET = os.getenv("IPSET", "/sbin/ipset")
+
+# ipset has no hash:port type; a bitmap over every port is as cheap
+PORTS = "bitmap:port range 0-65535"
+NETS = "hash:net"
+IP_PORTS = "hash:ip,port"
+
+def restore(commands, exist=False):
+  """
+  Apply the given ipset commands with a single ipset restore.
+
+  @param exist: ignore adding members already present, and removing
+                members already absent
+  """
+  if not commands:
+    return
+  cmdv = [IPSET]
+  if exist:
+    cmdv.append("-exist")
+  procutils.run(cmdv + ["restore"], input="\n".join(commands) + "\n")
+
+def port_entry(port):
+  return str(port)
+
+def ip_port_entry(ip, port, proto="tcp"):
+  return "%s,%s:%d" % (ip, proto, port)
+
+def create_commands(name, set_type, entries):
+  """Return the commands creating set name of the given type with the given entries."""
+  commands = ["create %s %s" % (name, set_type)]
+  for entry in entries:
+    commands.append("add %s %s" % (name, entry))
+  return commands
+
+def create(name, set_type, entries=()):
+  """
+  Create a set.
+
+  @param set_type: one of PORTS, NETS or IP_PORTS
+  @param entries: initial members, eg "60020", "10.0.0.0/24" or
+                  "10.0.0.5,tcp:2181"
+  """
+  restore(create_commands(name, set_type, entries))
+
+def add(name, entries):
+  """Add members to an existing set; members already present are fine."""
+  restore(["add %s %s" % (name, entry) for entry in entries], exist=True)
+
+def remove(name, entries):
+  """Remove members from an existing set; absent members are fine."""
+  restore(["del %s %s" % (name, entry) for entry in entries], exist=True)
+
+def destroy(names):
+  """Destroy the given sets, which must no longer be referenced by any rule."""
+  restore(["destroy %s" % name for name in names])
+
+def list_names():
+  """Return the names of every set on the host."""
+  return procutils.run([IPSET, "list", "-n"]).split()
@@ -17,9 +17,103 @@
 # limitations under the License.
 import re
 from gremlins import procutils
-import time
 
 IPTABLES="/sbin/iptables"
+IPTABLES_RESTORE="/sbin/iptables-restore"
+IPTABLES_SAVE="/sbin/iptables-save"
+
+# iptables rejects chain names longer than this
+MAX_CHAIN_NAME = 28
+
+def new_chain_name():
+  """
+  Return a fresh gremlin chain name (see procutils.new_name). There is
+  room left for an _INPUT/_OUTPUT suffix.
+  """
+  return procutils.new_name()
+
+class Transaction(object):
+  """
+  A batch of iptables changes applied atomically with a single
+  iptables-restore --noflush.
+
+  Usage:
+    txn = Transaction()
+    chain = txn.new_chain()
+    txn.append(chain, "-p", "tcp", "--dport", "80", "-j", "DROP")
+    txn.jump("INPUT", chain)
+    txn.commit()
+
+  Either every change in the transaction takes effect at once, or (if
+  iptables-restore rejects it) none of them do.
+  """
+  def __init__(self, table="filter"):
+    self.table = table
+    self.chains = []
+    self.rules = []
+
+  def new_chain(self, name=None):
+    """
+    Create a user chain as part of this transaction.
+
+    @param name: chain name; defaults to a fresh new_chain_name()
+    @returns the name of the chain
+    """
+    if name is None:
+      name = new_chain_name()
+    if len(name) > MAX_CHAIN_NAME:
+      raise Exception("Chain name too long: %s" % name)
+    self.chains.append(name)
+    return name
+
+  def append(self, chain, *rule):
+    """Append a rule (iptables arguments after -A <chain>) to a chain."""
+    self.rules.append(("-A", chain) + rule)
+
+  def delete(self, chain, *rule):
+    """Delete a rule (iptables arguments after -D <chain>) from a chain."""
+    self.rules.append(("-D", chain) + rule)
+
+  def jump(self, builtin, chain):
+    """Append a jump from a system chain (eg INPUT) to a user chain."""
+    self.append(builtin, "-j", chain)
+
+  def unjump(self, builtin, chain):
+    """Remove a jump from a system chain (eg INPUT) to a user chain."""
+    self.delete(builtin, "-j", chain)
+
+  def flush_chain(self, chain):
+    """Remove every rule from the given chain."""
+    self.rules.append(("-F", chain))
+
+  def delete_chain(self, chain):
+    """
+    Flush and delete a user chain.
+
+    Any jumps to it must be removed earlier in the same transaction
+    (or already be gone).
+    """
+    self.flush_chain(chain)
+    self.rules.append(("-X", chain))
+
+  def is_empty(self):
+    return not self.chains and not self.rules
+
+  def render(self):
+    """Return the iptables-restore input for this transaction."""
+    lines = ["*%s" % self.table]
+    for chain in self.chains:
+      lines.append(":%s - [0:0]" % chain)
+    for rule in self.rules:
+      lines.append(" ".join(rule))
+    lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+  def commit(self):
+    """Apply the transaction in one iptables-restore call."""
+    if self.is_empty():
+      return
+    procutils.run([IPTABLES_RESTORE, "--noflush"], input=self.render())
 
 def list_chains():
   """Return a list of the names of all iptables chains."""
@@ -27,6 +121,15 @@ def list_chains():
   chains = re.findall(r'^Chain (\S+)', ret, re.MULTILINE)
   return chains
 
+def _add_drop_chain(txn, ports_to_drop):
+  chain_id = txn.new_chain()
+  for port in ports_to_drop:
+    txn.append(chain_id,
+      "-p", "tcp",
+      "--dport", str(port),
+      "-j", "DROP")
+  return chain_id
+
 def create_gremlin_chain(ports_to_drop):
   """
   Create a new iptables chain that drops all packets
@@ -35,75 +138,205 @@ def create_gremlin_chain(ports_to_drop):
   @param ports_to_drop: list of int port numbers to drop packets to
   @returns the name of the new chain
   """
-  chain_id = "gremlin_%d" % int(time.time())
-  
-  # Create the chain
-  procutils.run([IPTABLES, "-N", chain_id])
+  txn = Transaction()
+  chain_id = _add_drop_chain(txn, ports_to_drop)
+  txn.commit()
+  return chain_id
 
-  # Add the drop rules
-  for port in ports_to_drop:
-    procutils.run([IPTABLES,
-      "-A", chain_id,
-      "-p", "tcp",
-      "--dport", str(port),
-      "-j", "DROP"])
+def install_gremlin_chain(ports_to_drop):
+  """
+  Create a chain dropping packets to the given ports and hook it into
+  INPUT, all in one transaction.
+
+  @param ports_to_drop: list of int port numbers to drop packets to
+  @returns the name of the new chain
+  """
+  txn = Transaction()
+  chain_id = _add_drop_chain(txn, ports_to_drop)
+  txn.jump("INPUT", chain_id)
+  txn.commit()
   return chain_id
 
-def create_gremlin_network_failure(bastion_host):
+def _add_set_drop_chains(txn, port_set=None, peer_set=None, host_set=None, inbound_only=False,
+                         chain_prefix=None, local_port_set=None, owner_uids=()):
+  chain_prefix = chain_prefix or new_chain_name()
+  chain_input = txn.new_chain("%s_INPUT" % chain_prefix)
+  chain_output = None
+  if not inbound_only:
+    chain_output = txn.new_chain("%s_OUTPUT" % chain_prefix)
+
+  # One rule per set and direction: the set does the lookup
+  if port_set:
+    txn.append(chain_input, "-p", "tcp", "-m", "set", "--match-set", port_set, "dst", "-j", "DROP")
+    if chain_output:
+      txn.append(chain_output, "-p", "tcp", "-m", "set", "--match-set", port_set, "src", "-j", "DROP")
+  if peer_set:
+    # Only the daemon's own connections to the peers: those it has, by
+    # their local ports, and any new ones, by the owner of the socket
+    txn.append(chain_input, "-p", "tcp", "-m", "set", "--match-set", peer_set, "src,src",
+               "-m", "set", "--match-set", local_port_set, "dst", "-j", "DROP")
+    if chain_output:
+      txn.append(chain_output, "-p", "tcp", "-m", "set", "--match-set", peer_set, "dst,dst",
+                 "-m", "set", "--match-set", local_port_set, "src", "-j", "DROP")
+      for uid in owner_uids:
+        txn.append(chain_output, "-p", "tcp", "--syn", "-m", "owner", "--uid-owner", str(uid),
+                   "-m", "set", "--match-set", peer_set, "dst,dst", "-j", "DROP")
+  if host_set:
+    txn.append(chain_input, "-m", "set", "--match-set", host_set, "src", "-j", "DROP")
+    if chain_output:
+      txn.append(chain_output, "-m", "set", "--match-set", host_set, "dst", "-j", "DROP")
+  return [chain for chain in (chain_input, chain_output) if chain]
+
+def create_gremlin_set_chains(port_set=None, peer_set=None, host_set=None, inbound_only=False,
+                              chain_prefix=None, local_port_set=None, owner_uids=()):
   """
-  Create a new iptables chain that isolates the host we're on
-  from all other hosts, save a single bastion.
+  Create chains that drop traffic matching the given ipsets (see
+  gremlins.ipsets), with a single rule per set and direction.
 
-  @param bastion_host: a hostname or ip to still allow ssh to/from
-  @returns an array containing the name of the new chains [input, output]
+  @param port_set: a PORTS set; drops tcp packets to or from those ports
+  @param peer_set: an IP_PORTS set; drops tcp packets between those
+                   ip:port pairs, eg the servers a daemon is connected
+                   to, and the ports in local_port_set
+  @param host_set: a NETS set; drops everything to or from those hosts
+  @param inbound_only: only create the INPUT chain
+  @param chain_prefix: name the chains <prefix>_INPUT and <prefix>_OUTPUT;
+                       defaults to a fresh new_chain_name()
+  @param local_port_set: a PORTS set of the local ends of the daemon's
+                         connections to peer_set; needed with peer_set
+  @param owner_uids: uids whose new connections to peer_set are dropped
+  @returns the names of the new chains, [input, output]
+  """
+  txn = Transaction()
+  chains = _add_set_drop_chains(txn, port_set, peer_set, host_set, inbound_only, chain_prefix,
+                                local_port_set, owner_uids)
+  txn.commit()
+  return chains
+
+def install_gremlin_set_chains(port_set=None, peer_set=None, host_set=None, inbound_only=False,
+                               chain_prefix=None, local_port_set=None, owner_uids=()):
   """
-  chain_prefix = "gremlin_%d" % int(time.time())
+  Like create_gremlin_set_chains, but also hooks the chains into INPUT
+  and OUTPUT in the same transaction.
+  """
+  txn = Transaction()
+  chains = _add_set_drop_chains(txn, port_set, peer_set, host_set, inbound_only, chain_prefix,
+                                local_port_set, owner_uids)
+  hook_chains(txn, chains)
+  txn.commit()
+  return chains
+
+def hook_chains(txn, chains):
+  """Jump from INPUT to chains[0] and, if present, from OUTPUT to chains[1]."""
+  txn.jump("INPUT", chains[0])
+  if len(chains) > 1:
+    txn.jump("OUTPUT", chains[1])
+
+def unhook_chains(chains):
+  """Unhook and delete chains hooked in by hook_chains, in one transaction."""
+  uninstall_gremlin_chains(input_chains=chains[:1], output_chains=chains[1:])
+
+def _add_network_failure_chains(txn, bastion_host, chain_prefix=None):
+  chain_prefix = chain_prefix or new_chain_name()
 
   # Create INPUT chain
-  chain_input = "%s_INPUT" % chain_prefix
-  procutils.run([IPTABLES, "-N", chain_input])
+  chain_input = txn.new_chain("%s_INPUT" % chain_prefix)
 
   # Add rules to allow ssh to/from bastion
-  procutils.run([IPTABLES, "-A", chain_input, "-p", "tcp",
+  txn.append(chain_input, "-p", "tcp",
     "--source", bastion_host, "--dport", "22",
     "-m", "state", "--state", "NEW,ESTABLISHED",
-    "-j", "ACCEPT"])
-  procutils.run([IPTABLES, "-A", chain_input, "-p", "tcp",
+    "-j", "ACCEPT")
+  txn.append(chain_input, "-p", "tcp",
     "--sport", "22",
     "-m", "state", "--state", "ESTABLISHED",
-    "-j", "ACCEPT"])
+    "-j", "ACCEPT")
 
   # Add rule to allow ICMP to/from bastion
-  procutils.run([IPTABLES, "-A", chain_input, "-p", "icmp",
+  txn.append(chain_input, "-p", "icmp",
     "--source", bastion_host,
-    "-j", "ACCEPT"])
+    "-j", "ACCEPT")
   # Drop everything else
-  procutils.run([IPTABLES, "-A", chain_input,
-    "-j", "DROP"])
+  txn.append(chain_input,
+    "-j", "DROP")
 
   # Create OUTPUT chain
-  chain_output = "%s_OUTPUT" % chain_prefix
-  procutils.run([IPTABLES, "-N", chain_output])
+  chain_output = txn.new_chain("%s_OUTPUT" % chain_prefix)
 
   # Add rules to allow ssh to/from bastion
-  procutils.run([IPTABLES, "-A", chain_output, "-p", "tcp",
+  txn.append(chain_output, "-p", "tcp",
     "--sport", "22",
     "-m", "state", "--state", "ESTABLISHED",
-    "-j", "ACCEPT"])
-  procutils.run([IPTABLES, "-A", chain_output, "-p", "tcp",
+    "-j", "ACCEPT")
+  txn.append(chain_output, "-p", "tcp",
     "--destination", bastion_host, "--dport", "22",
     "-m", "state", "--state", "NEW,ESTABLISHED",
-    "-j", "ACCEPT"])
+    "-j", "ACCEPT")
   # Add rule to allow ICMP to/from bastion
-  procutils.run([IPTABLES, "-A", chain_output, "-p", "icmp",
+  txn.append(chain_output, "-p", "icmp",
     "--destination", bastion_host,
-    "-j", "ACCEPT"])
+    "-j", "ACCEPT")
   # Drop everything else
-  procutils.run([IPTABLES, "-A", chain_output,
-    "-j", "DROP"])
+  txn.append(chain_output,
+    "-j", "DROP")
 
   return [chain_input, chain_output]
 
+def create_gremlin_network_failure(bastion_host, chain_prefix=None):
+  """
+  Create a new iptables chain that isolates the host we're on
+  from all other hosts, save a single bastion.
+
+  @param bastion_host: a hostname or ip to still allow ssh to/from
+  @param chain_prefix: name the chains <prefix>_INPUT and <prefix>_OUTPUT;
+                       defaults to a fresh new_chain_name()
+  @returns an array containing the name of the new chains [input, output]
+  """
+  txn = Transaction()
+  chains = _add_network_failure_chains(txn, bastion_host, chain_prefix)
+  txn.commit()
+  return chains
+
+def install_gremlin_network_failure(bastion_host, chain_prefix=None):
+  """
+  Create the network failure chains and hook them into INPUT and OUTPUT,
+  all in one transaction, so the host is cut off at a single instant.
+
+  @param bastion_host: a hostname or ip to still allow ssh to/from
+  @param chain_prefix: as for create_gremlin_network_failure
+  @returns an array containing the name of the new chains [input, output]
+  """
+  txn = Transaction()
+  chains = _add_network_failure_chains(txn, bastion_host, chain_prefix)
+  txn.jump("INPUT", chains[0])
+  txn.jump("OUTPUT", chains[1])
+  txn.commit()
+  return chains
+
+def uninstall_gremlin_chains(input_chains=(), output_chains=()):
+  """
+  Unhook the given chains from INPUT/OUTPUT and delete them, all in one
+  transaction.
+  """
+  txn = Transaction()
+  for chain in input_chains:
+    txn.unjump("INPUT", chain)
+  for chain in output_chains:
+    txn.unjump("OUTPUT", chain)
+  for chain in list(input_chains) + list(output_chains):
+    txn.delete_chain(chain)
+  txn.commit()
+
+def delete_user_chains(chain_ids):
+  """
+  Delete several user chains in one transaction.
+
+  You must remove them from the system chains before this will succeed.
+  """
+  txn = Transaction()
+  for chain_id in chain_ids:
+    txn.delete_chain(chain_id)
+  txn.commit()
+
 def add_user_chain_to_input_chain(chain_id):
   """Insert the given user chain into the system INPUT chain"""
   procutils.run([IPTABLES, "-A", "INPUT", "-j", chain_id])
@@ -137,20 +370,53 @@ def delete_user_chain(chain_id):
 
   You must remove it from the system chains before this will succeed.
   """
-  procutils.run([IPTABLES, "--flush", chain_id])
-  procutils.run([IPTABLES, "--delete-chain", chain_id])
+  txn = Transaction()
+  txn.delete_chain(chain_id)
+  txn.commit()
 
-def remove_gremlin_chains():
+def parse_save(text):
   """
-  Remove any gremlin chains that are found on the system.
+  Find the gremlin chains in iptables-save output.
+
+  @returns (chains, jumps): the gremlin chain names, and each rule in a
+           non-gremlin chain that jumps to one, as (chain, rule args)
   """
-  output_chains = map((lambda entry: entry.partition(" ")[0]), procutils.run([IPTABLES, "-L", "OUTPUT"]).splitlines()[2:])
+  chains = []
+  jumps = []
+  for line in text.splitlines():
+    if line.startswith(":gremlin_"):
+      chains.append(line[1:].split()[0])
+    elif line.startswith("-A "):
+      words = line.split()
+      if words[1].startswith("gremlin_") or "-j" not in words:
+        continue
+      if words[words.index("-j") + 1].startswith("gremlin_"):
+        jumps.append((words[1], words[2:]))
+  return chains, jumps
 
-  for chain in list_chains():
-    if chain.startswith("gremlin_"):
-      if chain in output_chains:
-        remove_user_chain_from_output_chain(chain)
-      else:
-        remove_user_chain_from_input_chain(chain)
-      delete_user_chain(chain)
+def remove_gremlin_chains(names=None):
+  """
+  Remove any gremlin chains that are found on the system, in one
+  transaction.
+
+  Reads the ruleset with iptables-save, which never does DNS lookups,
+  so this stays fast even with the network cut off, and which shows
+  exactly which chains (INPUT, OUTPUT or any other) jump to each one.
 
+  @param names: only remove these chains, if present
+  @returns the names of the chains removed
+  """
+  chains, jumps = parse_save(procutils.run([IPTABLES_SAVE, "-t", "filter"]))
+  if names is not None:
+    names = set(names)
+    chains = [chain for chain in chains if chain in names]
+    jumps = [(chain, rule) for chain, rule in jumps if rule[rule.index("-j") + 1] in names]
+  if not chains and not jumps:
+    return []
+  txn = Transaction()
+  for chain, rule in jumps:
+    txn.delete(chain, *rule)
+  for chain in chains:
+    txn.delete_chain(chain)
+  txn.commit()
+  return chains
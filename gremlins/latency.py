@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A client-side latency probe, to measure what faults do to the cluster.
+
+While a profile runs, a pool of connections probes TCP endpoints at a
+fixed rate, either by connecting (and hanging up) or by sending a
+payload and waiting for it to come back. Each probe's latency goes into
+a stats.Histogram for every fault in effect when it was due (or for
+"(no fault)"), so that at the end each fault type gets its own p50, p99,
+p999 and error rate, next to a baseline.
+
+Latency is measured from when a probe was due, not from when it was
+sent, so a stalled endpoint is charged for the probes queued up behind
+it rather than hiding them (coordinated omission).
+
+A local echo server stands in for a daemon when trying it out:
+
+  $ python -m gremlins.latency --echo 7777 &
+  $ python -m gremlins.latency -r 200 -s 10 --mode echo localhost:7777
+"""
+import logging
+import socket
+import threading
+import time
+from optparse import OptionParser
+
+from gremlins import runtime
+from gremlins.clock import monotonic
+from gremlins.diskload import Pacer
+from gremlins.stats import Histogram
+
+MODES = ("connect", "echo")
+
+NO_FAULT = "(no fault)"
+
+DEFAULT_PAYLOAD = "gremlins-probe\n"
+
+def parse_endpoint(spec):
+  """Parse "host:port" into (host, port)."""
+  host, _, port = spec.rpartition(":")
+  if not host or not port.isdigit():
+    raise ValueError("Bad endpoint %r, expected HOST:PORT" % spec)
+  return host, int(port)
+
+
+class _Result(object):
+  __slots__ = ["histogram", "errors"]
+
+  def __init__(self):
+    self.histogram = Histogram()
+    self.errors = 0
+
+
+class _Connection(object):
+  """One probing connection: a worker thread with its own socket."""
+  def __init__(self, probe, endpoint, pacer):
+    self.probe = probe
+    self.endpoint = endpoint
+    self.pacer = pacer
+    self.sock = None
+
+  def _connect(self):
+    return socket.create_connection(self.endpoint, self.probe.timeout)
+
+  def _close(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+
+  def _echo(self):
+    if self.sock is None:
+      self.sock = self._connect()
+      self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    payload = self.probe.payload
+    self.sock.sendall(payload)
+    received = 0
+    while received < len(payload):
+      data = self.sock.recv(len(payload) - received)
+      if not data:
+        raise socket.error("connection closed by %s:%d" % self.endpoint)
+      received += len(data)
+
+  def run(self):
+    stop = self.probe.stop_event
+    while not stop.isSet():
+      due = self.pacer.next_due()
+      delay = due - monotonic()
+      if delay > 0 and stop.wait(delay):
+        break
+      try:
+        if self.probe.mode == "echo":
+          self._echo()
+        else:
+          self._connect().close()
+        seconds = monotonic() - due
+      except (socket.error, socket.timeout), e:
+        self._close()
+        seconds = None
+        logging.debug("Probe of %s:%d failed: %s" % (self.endpoint + (e,)))
+      # Charged to the faults in effect when the probe was due, which a
+      # probe held up by a stall may only have been sent after
+      self.probe.record(runtime.faults_in_effect(due) or [NO_FAULT], seconds)
+    self._close()
+
+
+class LatencyProbe(object):
+  """
+  Probes endpoints at a fixed rate until stopped.
+
+  @param endpoints: list of (host, port)
+  @param rate: probes per second to each endpoint
+  @param mode: "connect" to time TCP connects, "echo" to time a round
+               trip of the payload over a kept-open connection
+  @param connections: connections per endpoint, ie how many probes of
+                      each may be in flight at once
+  @param timeout: seconds before a probe counts as an error
+  @param payload: what echo mode sends, and expects back
+  """
+  def __init__(self, endpoints, rate=10.0, mode="connect", connections=4, timeout=5.0,
+               payload=DEFAULT_PAYLOAD):
+    if mode not in MODES:
+      raise ValueError("Unknown mode %s, expected one of %s" % (mode, ", ".join(MODES)))
+    self.endpoints = list(endpoints)
+    self.rate = rate
+    self.mode = mode
+    self.connections = connections
+    self.timeout = timeout
+    self.payload = payload
+    self.stop_event = threading.Event()
+    self.threads = []
+    self.results = {}
+    self.results_lock = threading.Lock()
+
+  def start(self):
+    for endpoint in self.endpoints:
+      pacer = Pacer(self.rate)
+      for i in xrange(self.connections):
+        connection = _Connection(self, endpoint, pacer)
+        thread = threading.Thread(target=connection.run,
+                                  name="gremlin-probe-%s:%d-%d" % (endpoint + (i,)))
+        thread.setDaemon(True)
+        thread.start()
+        self.threads.append(thread)
+    logging.info("Probing %s at %g/s each (%s)" %
+                 (", ".join("%s:%d" % endpoint for endpoint in self.endpoints), self.rate,
+                  self.mode))
+
+  def stop(self):
+    self.stop_event.set()
+    for thread in self.threads:
+      thread.join()
+
+  def record(self, faults, seconds):
+    """Record a probe's latency (None for an error) against each fault."""
+    for fault in faults:
+      result = self.results.get(fault)
+      if result is None:
+        with self.results_lock:
+          result = self.results.setdefault(fault, _Result())
+      if seconds is None:
+        with self.results_lock:
+          result.errors += 1
+      else:
+        result.histogram.record(seconds)
+
+  def summary(self):
+    """
+    Return a list of dicts, one per fault type (and "(no fault)"), of the
+    probe count, error rate and latency percentiles in milliseconds.
+    """
+    with self.results_lock:
+      items = sorted(self.results.items())
+    rows = []
+    for fault, result in items:
+      histogram = result.histogram
+      total = histogram.count + result.errors
+      row = {"fault": fault, "probes": total, "errors": result.errors,
+             "error_rate": total and float(result.errors) / total or 0.0}
+      for name, pct in (("p50", 50), ("p99", 99), ("p999", 99.9)):
+        value = histogram.percentile(pct)
+        if value is not None:
+          value *= 1000
+        row[name] = value
+      rows.append(row)
+    return rows
+
+  def report(self):
+    """Log the summary, one line per fault type."""
+    def ms(value):
+      if value is None:
+        return "       -"
+      return "%8.2f" % value
+    logging.info("%-24s %8s %7s %8s %8s %8s" % ("fault", "probes", "errors", "p50 ms",
+                                                "p99 ms", "p999 ms"))
+    for row in self.summary():
+      logging.info("%-24s %8d %6.2f%% %s %s %s" % (row["fault"], row["probes"],
+                                                   row["error_rate"] * 100,
+                                                   ms(row["p50"]), ms(row["p99"]),
+                                                   ms(row["p999"])))
+
+
+class EchoServer(object):
+  """
+  A threaded TCP echo server on localhost, standing in for a daemon.
+
+  @param port: port to listen on (0 picks a free one; see self.port)
+  """
+  def __init__(self, port=0, host="127.0.0.1"):
+    import SocketServer
+
+    class Handler(SocketServer.BaseRequestHandler):
+      def handle(self):
+        while True:
+          data = self.request.recv(4096)
+          if not data:
+            break
+          self.request.sendall(data)
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+      daemon_threads = True
+      allow_reuse_address = True
+
+    self.server = Server((host, port), Handler)
+    self.port = self.server.server_address[1]
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.server.serve_forever, name="gremlin-echo")
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+def main():
+  parser = OptionParser(usage="%prog [options] HOST:PORT ... | --echo PORT")
+  parser.add_option("--echo", dest="echo", type="int",
+                    help="run a local echo server on PORT instead of probing", metavar="PORT")
+  parser.add_option("-r", "--rate", dest="rate", type="float", default=10.0)
+  parser.add_option("-s", "--seconds", dest="seconds", type="float", default=10)
+  parser.add_option("-m", "--mode", dest="mode", default="connect",
+                    help="one of " + ", ".join(MODES))
+  parser.add_option("-c", "--connections", dest="connections", type="int", default=4)
+  (options, args) = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  if options.echo is not None:
+    server = EchoServer(options.echo, host="0.0.0.0")
+    logging.info("Echoing on port %d" % server.port)
+    server.server.serve_forever()
+    return
+  if not args:
+    parser.error("Expected endpoints to probe")
+  probe = LatencyProbe([parse_endpoint(arg) for arg in args], rate=options.rate,
+                       mode=options.mode, connections=options.connections)
+  probe.start()
+  try:
+    time.sleep(options.seconds)
+  finally:
+    probe.stop()
+  probe.report()
+
+if __name__ == "__main__":
+  main()
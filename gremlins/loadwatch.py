@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Sampling how busy a set of daemons is, for triggers.LoadTrigger.
+
+Each sample reads a few counters straight from /proc and turns the
+change since the previous sample into rates:
+
+  cpu    cores used by the daemons (utime + stime, /proc/<pid>/stat)
+  disk   bytes/s the daemons read from and wrote to storage
+         (read_bytes + write_bytes, /proc/<pid>/io)
+  net    bytes/s through the non-loopback interfaces of the daemons'
+         network namespace (/proc/<pid>/net/dev)
+
+The rates go into fixed-size ring buffers, so a long-running trigger
+uses constant memory, and thresholds can be given either as absolute
+rates or as percentiles of the recent history in the ring.
+"""
+import array
+import errno
+import logging
+import math
+import os
+
+from gremlins import probes, procfs
+from gremlins.clock import monotonic
+
+METRICS = ("cpu", "disk", "net")
+
+# Percentile thresholds need at least this many samples of history
+MIN_HISTORY = 30
+
+# Seconds between looking the daemons' pids up again, to follow restarts
+REFRESH_INTERVAL = 30
+
+_CLOCK_TICKS = float(os.sysconf("SC_CLK_TCK"))
+
+
+class Ring(object):
+  """A fixed-size ring buffer of floats."""
+  def __init__(self, size):
+    self.values = array.array("d", [0.0] * size)
+    self.size = size
+    self.count = 0
+    self.next = 0
+
+  def append(self, value):
+    self.values[self.next] = value
+    self.next = (self.next + 1) % self.size
+    self.count = min(self.count + 1, self.size)
+
+  def __len__(self):
+    return self.count
+
+  def last(self):
+    if not self.count:
+      return None
+    return self.values[self.next - 1]
+
+  def items(self):
+    """Return the values held, oldest first."""
+    if self.count < self.size:
+      return self.values[:self.count].tolist()
+    return (self.values[self.next:] + self.values[:self.next]).tolist()
+
+  def percentile(self, pct):
+    """Return the value below which pct percent of those held fall, or None."""
+    if not self.count:
+      return None
+    values = sorted(self.values[:self.count])
+    return values[max(1, int(math.ceil(self.count * pct / 100.0))) - 1]
+
+
+def parse_threshold(metric, spec):
+  """
+  Parse a threshold: a number is an absolute rate, and a string "pNN"
+  (eg "p95") the NNth percentile of the metric's recent history.
+
+  @returns ("rate", value) or ("percentile", pct)
+  """
+  if metric not in METRICS:
+    raise ValueError("Unknown metric %s, expected one of %s" % (metric, ", ".join(METRICS)))
+  if isinstance(spec, basestring):
+    if spec.startswith("p"):
+      try:
+        pct = float(spec[1:])
+      except ValueError:
+        pct = None
+      if pct is not None and 0 < pct <= 100:
+        return ("percentile", pct)
+    raise ValueError("Bad threshold %r for %s: expected a number or pNN" % (spec, metric))
+  return ("rate", float(spec))
+
+
+class LoadSampler(object):
+  """
+  Samples the load of the given daemons into ring buffers.
+
+  @param daemons: daemons, as named in START_COMMANDS
+  @param history: samples kept per metric
+  """
+  def __init__(self, daemons, history=300):
+    self.daemons = list(daemons)
+    self.rings = dict((metric, Ring(history)) for metric in METRICS)
+    self.pids = []
+    self.pids_found = None
+    self.previous = None
+    self.io_readable = True
+
+  def _find_pids(self):
+    pids = []
+    for daemon in self.daemons:
+      pids.extend(probes.find_daemon(daemon, fresh=True))
+    self.pids = sorted(set(pids))
+    self.pids_found = monotonic()
+    self.previous = None
+
+  def _read_io(self, pid):
+    if not self.io_readable:
+      return 0
+    try:
+      io = procfs.read_io(pid)
+    except IOError, e:
+      if e.errno != errno.EACCES:
+        raise
+      logging.warn("Cannot read /proc/%d/io; disk load will not be sampled" % pid)
+      self.io_readable = False
+      return 0
+    return io.get("read_bytes", 0) + io.get("write_bytes", 0)
+
+  def _counters(self):
+    """Return (cpu ticks, disk bytes, net bytes) summed over the daemons."""
+    ticks = 0
+    disk = 0
+    for pid in self.pids:
+      fields = procfs.read_stat(pid)
+      ticks += int(fields[13]) + int(fields[14])
+      disk += self._read_io(pid)
+    net = 0
+    if self.pids:
+      for name, (rx, tx) in procfs.net_dev(self.pids[0]).iteritems():
+        if name != "lo":
+          net += rx + tx
+    return ticks, disk, net
+
+  def sample(self):
+    """
+    Take a sample, returning a dict of metric -> rate, or None if there
+    is no previous sample to take rates against (eg the daemons have
+    just been found, or have restarted).
+    """
+    now = monotonic()
+    if self.pids_found is None or now - self.pids_found > REFRESH_INTERVAL:
+      previous_pids = self.pids
+      self._find_pids()
+      if not self.pids:
+        return None
+      if self.pids != previous_pids:
+        logging.info("Watching load of %s: pids %s" % (", ".join(self.daemons), self.pids))
+    try:
+      counters = self._counters()
+    except (IOError, OSError, ValueError, IndexError):
+      # A daemon exited; look again next time
+      self.pids_found = None
+      return None
+    previous, self.previous = self.previous, (now, counters)
+    if previous is None:
+      return None
+    elapsed = now - previous[0]
+    if elapsed <= 0:
+      return None
+    ticks, disk, net = [new - old for new, old in zip(counters, previous[1])]
+    rates = {"cpu": ticks / _CLOCK_TICKS / elapsed,
+             "disk": disk / elapsed,
+             "net": net / elapsed}
+    for metric, rate in rates.iteritems():
+      self.rings[metric].append(rate)
+    return rates
+
+  def crossed(self, thresholds, rates):
+    """
+    Return descriptions of the thresholds the given rates cross, eg
+    "cpu 3.10 >= 2.00".
+
+    @param thresholds: dict of metric -> parse_threshold() result
+    """
+    crossed = []
+    for metric, (kind, value) in sorted(thresholds.iteritems()):
+      rate = rates[metric]
+      if kind == "percentile":
+        ring = self.rings[metric]
+        if len(ring) < MIN_HISTORY:
+          continue
+        limit = ring.percentile(value)
+        if rate >= limit and rate > 0:
+          crossed.append("%s %.2f >= p%g %.2f" % (metric, rate, value, limit))
+      elif rate >= value:
+        crossed.append("%s %.2f >= %.2f" % (metric, rate, value))
+    return crossed
@@ -15,28 +15,320 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+"""
+Faults that choose between, combine or pace other faults.
 
-import random
+Choices are drawn from the random stream of the trigger that fired
+them (see runtime.using_rng), so a seeded profile makes the same
+choices on every run.
+
+parallel and sequence run their children on the runtime's scheduler,
+so they can be simulated like any other fault. Each child gets its own
+random stream, drawn in order from the parent's, so a seeded profile
+stays repeatable however the children's threads interleave. Both return
+an Activation that finishes once every child has been reverted, so a
+trigger waits for the whole group as it would for a single fault.
+"""
+import functools
 import logging
+import random
+import threading
 
-def pick_fault(fault_weights):
-  def do():
+from gremlins import metrics, runtime, scheduler
+from gremlins.clock import monotonic
+
+def alias_table(weights):
+  """
+  Build a Vose alias table for the given weights, so that a weighted
+  choice costs two random numbers however many choices there are.
+
+  @returns (prob, alias) lists, for use with alias_pick
+  """
+  n = len(weights)
+  total = float(sum(weights))
+  if n == 0 or total <= 0:
+    raise ValueError("need at least one positive weight, got %r" % (weights,))
+  prob = [wt * n / total for wt in weights]
+  alias = range(n)
+  small = [i for i, p in enumerate(prob) if p < 1.0]
+  large = [i for i, p in enumerate(prob) if p >= 1.0]
+  while small and large:
+    s = small.pop()
+    l = large.pop()
+    alias[s] = l
+    prob[l] = prob[l] + prob[s] - 1.0
+    if prob[l] < 1.0:
+      small.append(l)
+    else:
+      large.append(l)
+  # Whatever is left over is 1 up to rounding error
+  for i in small + large:
+    prob[i] = 1.0
+  return prob, alias
+
+def alias_pick(prob, alias, rng):
+  """Return an index chosen from an alias table."""
+  i = int(rng.random() * len(prob))
+  if rng.random() < prob[i]:
+    return i
+  return alias[i]
+
+
+def _path():
+  return " > ".join(runtime.current_path()) or "(direct)"
+
+
+class PickFault(object):
+  """Runs one of several faults, chosen at random by weight."""
+  def __init__(self, fault_weights):
+    self.fault_weights = list(fault_weights)
+    self.faults = [fault for wt, fault in self.fault_weights]
+    self.prob, self.alias = alias_table([wt for wt, fault in self.fault_weights])
+
+  def __repr__(self):
+    return "pick_fault(%r)" % (self.fault_weights,)
+
+  def __call__(self):
     logging.info("pick_fault triggered")
-    total_weight = sum( wt for wt,fault in fault_weights )
-    pick = random.random() * total_weight
-    accrued = 0
-    for wt, fault in fault_weights:
-      accrued += wt
-      if pick <= accrued:
-        fault()
-        return
-    assert "should not get here, pick=" + pick
-  return do
+    i = alias_pick(self.prob, self.alias, runtime.current_rng())
+    metrics.branches.inc("pick_fault", _path(), str(i))
+    with runtime.trigger_path("pick_fault[%d]" % i):
+      return self.faults[i]()
 
-def maybe_fault(likelyhood, fault):
-  def do():
-    logging.info("maybe_fault triggered, %3.2f likelyhood" % likelyhood)
-    if random.random() <= likelyhood:
-      fault()
+def pick_fault(fault_weights):
+  return PickFault(fault_weights)
+
+
+class MaybeFault(object):
+  """Runs a fault with the given probability."""
+  def __init__(self, likelyhood, fault):
+    self.likelyhood = likelyhood
+    self.fault = fault
+
+  def __repr__(self):
+    return "maybe_fault(%3.2f, %r)" % (self.likelyhood, self.fault)
+
+  def __call__(self):
+    logging.info("maybe_fault triggered, %3.2f likelyhood" % self.likelyhood)
+    if runtime.current_rng().random() <= self.likelyhood:
+      metrics.branches.inc("maybe_fault", _path(), "fired")
+      with runtime.trigger_path("maybe_fault(%3.2f)" % self.likelyhood):
+        return self.fault()
+    metrics.branches.inc("maybe_fault", _path(), "skipped")
     return
-  return do
+
+def maybe_fault(likelyhood, fault):
+  return MaybeFault(likelyhood, fault)
+
+
+def _scheduler():
+  fault_runtime = runtime.current()
+  if fault_runtime is None:
+    return scheduler.get_default()
+  if fault_runtime.scheduler is None:
+    fault_runtime.scheduler = scheduler.get_default()
+  return fault_runtime.scheduler
+
+def _now():
+  # The runtime's clock (virtual under --simulate), without starting the
+  # default scheduler just to read the time
+  fault_runtime = runtime.current()
+  if fault_runtime is not None and fault_runtime.scheduler is not None:
+    return fault_runtime.scheduler.now()
+  return monotonic()
+
+
+class _Group(object):
+  """Runs child faults on the scheduler's workers and joins them."""
+  def __init__(self, parent, size):
+    self.activation = runtime.Activation(parent)
+    self.pending = size
+    self.lock = threading.Lock()
+    self.rng = runtime.current_rng()
+    # Timers of the children not started yet, by step
+    self.timers = {}
+    if not size:
+      self.activation._finish()
+
+  def track(self):
+    """
+    Have the runtime cancel this group's timers when it shuts down.
+
+    @returns False if it already has, and the group should not start
+    """
+    fault_runtime = runtime.current()
+    if fault_runtime is None:
+      return True
+    if not fault_runtime.track(self):
+      return False
+    self.activation.add_done_callback(lambda activation: fault_runtime.untrack(self))
+    return True
+
+  def call_at(self, sched, deadline, step, fault, context):
+    """Run a child on the scheduler's workers at the given time."""
+    with self.lock:
+      self.timers[step] = sched.call_at(
+        deadline, functools.partial(self._due, sched, step, fault, context))
+
+  def _due(self, sched, step, fault, context):
+    with self.lock:
+      if self.timers.pop(step, None) is None:
+        # Cancelled
+        return
+    sched.submit(functools.partial(self.run, fault, context))
+
+  def cancel(self):
+    """Cancel the children not started yet; those started run their course."""
+    with self.lock:
+      timers, self.timers = self.timers.values(), {}
+    for timer in timers:
+      timer.cancel()
+      self._child_done()
+
+  def context(self, step):
+    """Capture, in the calling thread, the context for one child."""
+    path, rng, caps = runtime.current_context()
+    child_rng = random.Random(self.rng.getrandbits(64))
+    return (path + (step,), child_rng, caps)
+
+  def run(self, fault, context):
+    try:
+      with runtime.using_context(context):
+        result = fault()
+    except Exception:
+      logging.exception("Failed to run %s" % repr(fault))
+      result = None
+    if isinstance(result, runtime.Activation):
+      result.add_done_callback(lambda activation: self._child_done())
+    else:
+      self._child_done()
+
+  def _child_done(self):
+    with self.lock:
+      self.pending -= 1
+      done = self.pending == 0
+    if done:
+      self.activation._finish()
+
+  def result(self):
+    # Without a runtime a fault blocks until it has been reverted, so a
+    # group does too
+    if runtime.current() is None:
+      self.activation.wait()
+    return self.activation
+
+
+class Parallel(object):
+  """Runs several faults at once."""
+  def __init__(self, faults):
+    self.faults = list(faults)
+
+  def __repr__(self):
+    return "parallel(%r)" % (self.faults,)
+
+  def __call__(self):
+    logging.info("parallel triggered, %d faults" % len(self.faults))
+    sched = _scheduler()
+    group = _Group(self, len(self.faults))
+    for i, fault in enumerate(self.faults):
+      sched.submit(functools.partial(group.run, fault, group.context("parallel[%d]" % i)))
+    return group.result()
+
+def parallel(faults):
+  return Parallel(faults)
+
+
+class Sequence(object):
+  """Runs faults at the given offsets, in seconds, from when it is fired."""
+  def __init__(self, steps):
+    self.steps = sorted(steps, key=lambda step: step[0])
+    for offset, fault in self.steps:
+      if offset < 0:
+        raise ValueError("offsets can't be negative, got %r" % (offset,))
+
+  def __repr__(self):
+    return "sequence(%r)" % (self.steps,)
+
+  def __call__(self):
+    logging.info("sequence triggered, %d faults over %gs" %
+                 (len(self.steps), self.steps and self.steps[-1][0] or 0))
+    sched = _scheduler()
+    group = _Group(self, len(self.steps))
+    if not group.track():
+      logging.info("Not starting %s: shutting down" % repr(self))
+      return None
+    start = sched.now()
+    for i, (offset, fault) in enumerate(self.steps):
+      group.call_at(sched, start + offset, i, fault,
+                    group.context("sequence[%d]+%gs" % (i, offset)))
+    return group.result()
+
+def sequence(steps):
+  return Sequence(steps)
+
+
+class AtMostNActive(object):
+  """
+  Runs a fault, but never while n or more faults are already active:
+  every fault it would fire is skipped instead. All faults count,
+  however they were fired, so this bounds the pressure on the cluster
+  as a whole.
+  """
+  def __init__(self, n, fault):
+    if n < 1:
+      raise ValueError("n must be at least 1, got %r" % (n,))
+    self.n = n
+    self.fault = fault
+
+  def __repr__(self):
+    return "at_most_n_active(%d, %r)" % (self.n, self.fault)
+
+  def __call__(self):
+    with runtime.trigger_path("at_most_n_active(%d)" % self.n):
+      with runtime.capped(self.n):
+        return self.fault()
+
+def at_most_n_active(n, fault):
+  return AtMostNActive(n, fault)
+
+
+class RateLimit(object):
+  """
+  Runs a fault at most rate times a second on average, with bursts of
+  up to burst, by token bucket; calls over the limit are skipped. One
+  bucket is shared by everything that fires the same RateLimit. Tokens
+  accrue on the monotonic clock, or the runtime scheduler's if it has
+  one (so --simulate paces faults in virtual time).
+  """
+  def __init__(self, rate, fault, burst=1):
+    if rate <= 0 or burst < 1:
+      raise ValueError("need a positive rate and a burst of at least 1")
+    self.rate = float(rate)
+    self.fault = fault
+    self.burst = burst
+    self.tokens = float(burst)
+    self.updated = None
+    self.lock = threading.Lock()
+
+  def __repr__(self):
+    return "rate_limit(%r, %r, burst=%r)" % (self.rate, self.fault, self.burst)
+
+  def __call__(self):
+    now = _now()
+    with self.lock:
+      if self.updated is not None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      allowed = self.tokens >= 1
+      if allowed:
+        self.tokens -= 1
+    if not allowed:
+      metrics.branches.inc("rate_limit", _path(), "skipped")
+      logging.info("rate_limit skipping %s, over %g/s" % (repr(self.fault), self.rate))
+      return
+    metrics.branches.inc("rate_limit", _path(), "fired")
+    with runtime.trigger_path("rate_limit(%g/s)" % self.rate):
+      return self.fault()
+
+def rate_limit(rate, fault, burst=1):
+  return RateLimit(rate, fault, burst)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Metrics about gremlins itself, exported in the Prometheus text format:
+
+  $ gremlins --metrics-port 9171 ...
+  $ curl localhost:9171/metrics
+
+Counters are sharded per thread: each thread only ever touches its own
+dict, so incrementing one takes no lock, and shards are summed when the
+metrics are scraped. Gauges are computed at scrape time by callbacks,
+so they cost nothing in between. Histograms are stats.Histograms.
+
+The standard metrics are:
+
+  gremlins_faults_fired_total{fault}          faults injected, by type
+  gremlins_fault_errors_total{fault}          faults that failed to inject or revert
+  gremlins_faults_capped_total{fault}         faults not fired under at_most_n_active
+  gremlins_branches_total{metafault,path,branch}
+                                              branches taken by pick_fault and maybe_fault
+  gremlins_active_faults                      faults injected and not yet reverted
+  gremlins_stopped_pids                       pids held SIGSTOPped by active faults
+  gremlins_installed_chains                   iptables chains installed by active faults
+  gremlins_exec_seconds{program}              latency of each command run
+  gremlins_pid_discovery_seconds              latency of each process table lookup
+  gremlins_fault_phase_seconds{fault,phase}   discover, inject, hold and revert times
+"""
+import logging
+import threading
+
+from gremlins.stats import Histogram
+
+# Upper bounds of the exported histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60, 300)
+
+def _escape(value):
+  return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=""):
+  pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  if not pairs:
+    return ""
+  return "{" + ",".join(pairs) + "}"
+
+def _number(value):
+  if value == float("inf"):
+    return "+Inf"
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
+
+
+class Counter(object):
+  """A counter with optional labels, incremented without locking."""
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.local = threading.local()
+    self.shards = []
+    self.shards_lock = threading.Lock()
+
+  def inc(self, *values):
+    """Add one to the count for the given label values."""
+    shard = getattr(self.local, "shard", None)
+    if shard is None:
+      shard = self.local.shard = {}
+      with self.shards_lock:
+        self.shards.append(shard)
+    shard[values] = shard.get(values, 0) + 1
+
+  def values(self):
+    """Return a dict of label values -> count, summed across threads."""
+    with self.shards_lock:
+      shards = list(self.shards)
+    totals = {}
+    for shard in shards:
+      # dict() copies in one step under the GIL, so this is safe while
+      # the owning thread keeps counting
+      for key, count in dict(shard).iteritems():
+        totals[key] = totals.get(key, 0) + count
+    return totals
+
+  def expose(self):
+    lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+    for key, count in sorted(self.values().iteritems()):
+      lines.append("%s%s %d" % (self.name, _labels(self.labels, key), count))
+    return lines
+
+
+class Gauge(object):
+  """A value computed by calling fn each time the metrics are scraped."""
+  def __init__(self, name, help, fn):
+    self.name = name
+    self.help = help
+    self.fn = fn
+
+  def expose(self):
+    try:
+      value = self.fn()
+    except Exception:
+      logging.exception("Could not compute %s" % self.name)
+      return []
+    return ["# HELP %s %s" % (self.name, self.help), "# TYPE %s gauge" % self.name,
+            "%s %s" % (self.name, _number(value))]
+
+
+class Timer(object):
+  """A family of latency histograms, one per set of label values."""
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.histograms = {}
+    self.lock = threading.Lock()
+
+  def histogram(self, *values):
+    histogram = self.histograms.get(values)
+    if histogram is None:
+      with self.lock:
+        histogram = self.histograms.setdefault(values, Histogram())
+    return histogram
+
+  def record(self, seconds, *values):
+    self.histogram(*values).record(seconds)
+
+  def expose(self):
+    lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+    with self.lock:
+      items = sorted(self.histograms.items())
+    for key, histogram in items:
+      for bound, count in zip(BUCKETS, histogram.cumulative(BUCKETS)):
+        lines.append("%s_bucket%s %d" % (self.name,
+                                         _labels(self.labels, key, 'le="%s"' % _number(bound)),
+                                         count))
+      lines.append("%s_bucket%s %d" % (self.name, _labels(self.labels, key, 'le="+Inf"'),
+                                       histogram.count))
+      lines.append("%s_sum%s %s" % (self.name, _labels(self.labels, key), repr(histogram.total)))
+      lines.append("%s_count%s %d" % (self.name, _labels(self.labels, key), histogram.count))
+    return lines
+
+
+_metrics = []
+_metrics_lock = threading.Lock()
+
+def register(metric):
+  """Export the given metric, returning it."""
+  with _metrics_lock:
+    _metrics.append(metric)
+  return metric
+
+def expose():
+  """Return every registered metric in the Prometheus text format."""
+  with _metrics_lock:
+    metrics = list(_metrics)
+  lines = []
+  for metric in metrics:
+    lines.extend(metric.expose())
+  return "\n".join(lines) + "\n"
+
+
+faults_fired = register(Counter("gremlins_faults_fired_total",
+                                "Faults injected, by type", ["fault"]))
+fault_errors = register(Counter("gremlins_fault_errors_total",
+                                "Faults that failed to inject or revert, by type", ["fault"]))
+faults_capped = register(Counter("gremlins_faults_capped_total",
+                                 "Faults not fired because too many were active, by type",
+                                 ["fault"]))
+branches = register(Counter("gremlins_branches_total",
+                            "Branches taken by metafaults, by the trigger path to the metafault",
+                            ["metafault", "path", "branch"]))
+exec_seconds = register(Timer("gremlins_exec_seconds",
+                              "Time taken by each command run, by program", ["program"]))
+pid_discovery_seconds = register(Timer("gremlins_pid_discovery_seconds",
+                                       "Time taken by each process table lookup"))
+fault_phase_seconds = register(Timer("gremlins_fault_phase_seconds",
+                                     "Time spent in each phase of a fault", ["fault", "phase"]))
+
+def fault_type(fault):
+  """The type of a fault, for labels: the factory name its repr starts with."""
+  return repr(fault).split("(", 1)[0]
+
+def _active_details(key):
+  from gremlins import runtime
+  fault_runtime = runtime.current()
+  if fault_runtime is None:
+    return 0
+  return sum(len(activation.details.get(key) or ())
+             for activation in fault_runtime.active())
+
+def _active_faults():
+  from gremlins import runtime
+  fault_runtime = runtime.current()
+  if fault_runtime is None:
+    return 0
+  return len(fault_runtime.active())
+
+register(Gauge("gremlins_active_faults", "Faults injected and not yet reverted", _active_faults))
+register(Gauge("gremlins_stopped_pids", "Pids held SIGSTOPped by active faults",
+               lambda: _active_details("stopped")))
+register(Gauge("gremlins_installed_chains", "iptables chains installed by active faults",
+               lambda: _active_details("chains")))
+
+
+def _make_server(host, port):
+  # Imported here so that gremlins only pays for the HTTP modules when
+  # metrics are being served
+  import BaseHTTPServer
+  import SocketServer
+
+  class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+  class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+      logging.debug("metrics: " + format % args)
+
+    def do_GET(self):
+      if self.path.split("?")[0].rstrip("/") not in ("", "/metrics"):
+        self.send_error(404)
+        return
+      data = expose()
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+  return Server((host, port), Handler)
+
+
+class MetricsServer(object):
+  """
+  Serves /metrics over HTTP.
+
+  @param port: port to listen on (0 picks a free one; see self.port)
+  @param host: address to bind; local only by default
+  """
+  def __init__(self, port, host="127.0.0.1"):
+    self.server = _make_server(host, port)
+    self.port = self.server.server_address[1]
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.server.serve_forever, name="gremlin-metrics")
+    self.thread.setDaemon(True)
+    self.thread.start()
+    logging.info("Serving metrics on port %d" % self.port)
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers for degrading, rather than cutting, network traffic with tc.
+
+Each device gets a prio root qdisc with 16 bands. Band 1 carries all
+ordinary traffic untouched; each active fault takes one of the other
+bands, hangs a netem qdisc off it, and adds u32 filters steering
+packets to or from the fault's ports into it. Several faults can be
+active on a device at once, and the root qdisc is removed (restoring the
+kernel default) when the last one is reverted.
+
+Removing a root qdisc brings back the kernel's default, not whatever
+was there before, so a device whose root qdisc was set up by someone
+else (a shaping tree, fq for pacing, ...) is left alone: install()
+refuses it. The kernel's own qdiscs have handle 0:. Each root gremlins
+adds is recorded in the undo log for as long as it is in place, so
+that --recover can remove it after a crash.
+
+Only egress traffic can be shaped, so filters match on both source and
+destination port: delaying a daemon's replies slows remote clients just
+as delaying their requests would. On the loopback device both
+directions are egress, so a single box sees the whole effect.
+
+All the tc commands for a change go through one tc -batch.
+"""
+import logging
+import os
+import threading
+
+from gremlins import procfs, procutils, undolog
+
+TC = os.getenv("TC", "/sbin/tc")
+
+ROOT_HANDLE = "7000"
+BANDS = 16
+
+# Packets a netem qdisc will queue; the default of 1000 overflows (and
+# so drops) at any real throughput once a rate or delay is applied
+NETEM_LIMIT = 100000
+
+# The handle of the root qdiscs the kernel attaches by default
+DEFAULT_HANDLE = "0:"
+
+_lock = threading.Lock()
+# device -> set of bands in use by active faults
+_bands = {}
+# device -> undo log effect ids of the root qdisc installed on it
+_roots = {}
+
+def default_devices():
+  """
+  Return the device of the default route (as listed in /proc/net/route)
+  plus the loopback device.
+  """
+  devices = []
+  try:
+    data = procfs._read("%s/net/route" % procfs.PROC)
+  except IOError:
+    data = ""
+  for line in data.splitlines()[1:]:
+    fields = line.split()
+    if len(fields) > 1 and fields[1] == "00000000" and fields[0] not in devices:
+      devices.append(fields[0])
+  devices.append("lo")
+  return devices
+
+def netem_args(delay_ms=0, jitter_ms=0, correlation=0, loss=0, rate=None, reorder=0):
+  """
+  Build the netem options for the given degradation.
+
+  @param delay_ms: delay added to each packet
+  @param jitter_ms: random variation of the delay, normally distributed
+  @param correlation: percent correlation between successive delays and losses
+  @param loss: percent of packets to drop
+  @param rate: bandwidth cap, in tc units, eg "1mbit"
+  @param reorder: percent of packets sent immediately, ahead of delayed
+                  ones; needs a delay
+  """
+  args = ["limit", str(NETEM_LIMIT)]
+  if delay_ms or jitter_ms or reorder:
+    args += ["delay", "%dms" % delay_ms]
+    if jitter_ms:
+      args += ["%dms" % jitter_ms, "%d%%" % correlation, "distribution", "normal"]
+  if loss:
+    args += ["loss", "%g%%" % loss]
+    if correlation:
+      args.append("%d%%" % correlation)
+  if reorder:
+    args += ["reorder", "%g%%" % reorder]
+    if correlation:
+      args.append("%d%%" % correlation)
+  if rate:
+    args += ["rate", str(rate)]
+  return args
+
+def _classid(band):
+  # tc reads the minor of a class id, like every part of a handle, as hex
+  return "%s:%x" % (ROOT_HANDLE, band)
+
+def _netem_handle(band):
+  return "%x:" % (int(ROOT_HANDLE, 16) + band)
+
+def _filter_prios(band):
+  # tc insists that filters sharing a priority share a protocol too
+  return 2 * band, 2 * band + 1
+
+def _filter_commands(device, band, ports):
+  ip_prio, ip6_prio = _filter_prios(band)
+  flowid = _classid(band)
+  commands = []
+  for port in ports:
+    for direction in ("sport", "dport"):
+      commands.append("filter add dev %s parent %s: protocol ip prio %d u32 match ip %s %d 0xffff flowid %s"
+                      % (device, ROOT_HANDLE, ip_prio, direction, port, flowid))
+      commands.append("filter add dev %s parent %s: protocol ipv6 prio %d u32 match ip6 %s %d 0xffff flowid %s"
+                      % (device, ROOT_HANDLE, ip6_prio, direction, port, flowid))
+  return commands
+
+def root_qdisc(device):
+  """
+  Return the kind and handle of the given device's root qdisc, eg
+  ("fq_codel", "0:"), or (None, None) if it has none.
+  """
+  for line in procutils.run([TC, "qdisc", "show", "dev", device, "root"]).splitlines():
+    fields = line.split()
+    if len(fields) >= 3 and fields[0] == "qdisc":
+      return fields[1], fields[2]
+  return None, None
+
+def batch(commands, force=False):
+  """
+  Run the given tc commands with a single tc -batch.
+
+  @param force: carry on past commands that fail
+  """
+  if not commands:
+    return
+  cmdv = [TC]
+  if force:
+    cmdv.append("-force")
+  procutils.run(cmdv + ["-batch", "-"], input="\n".join(commands) + "\n")
+
+def install(devices, ports, args):
+  """
+  Degrade traffic to and from the given ports on each device.
+
+  @param args: netem options, as built by netem_args()
+  @returns a list of [device, band] slots, for uninstall()
+  """
+  commands = []
+  slots = []
+  new_roots = []
+  with _lock:
+    for device in devices:
+      used = _bands.setdefault(device, set())
+      error = None
+      if not used:
+        kind, handle = root_qdisc(device)
+        if handle == ROOT_HANDLE + ":":
+          error = ("%s already has a gremlins root qdisc, left by another gremlin; "
+                   "run --recover if that one is dead" % device)
+        elif handle not in (None, DEFAULT_HANDLE):
+          error = ("%s has a %s root qdisc (handle %s) that gremlins would replace"
+                   % (device, kind, handle))
+      free = [band for band in xrange(2, BANDS + 1) if band not in used]
+      if not free:
+        error = "Too many network faults active on %s" % device
+      if error:
+        for taken_device, band in slots:
+          _bands[taken_device].discard(band)
+        for taken_device in new_roots:
+          undolog.undone(_roots.pop(taken_device))
+        raise Exception(error)
+      if not used:
+        priomap = " ".join(["0"] * 16)
+        _roots[device] = []
+        new_roots.append(device)
+        undolog.record(_roots[device], "netem", devices=[device])
+        commands.append("qdisc replace dev %s root handle %s: prio bands %d priomap %s"
+                        % (device, ROOT_HANDLE, BANDS, priomap))
+      band = free[0]
+      used.add(band)
+      slots.append([device, band])
+      commands.append("qdisc add dev %s parent %s handle %s netem %s"
+                      % (device, _classid(band), _netem_handle(band), " ".join(args)))
+      commands.extend(_filter_commands(device, band, ports))
+  try:
+    batch(commands)
+  except Exception:
+    try:
+      uninstall(slots)
+    except Exception:
+      logging.exception("Failed to clean up after tc on %s" % ", ".join(devices))
+    raise
+  return slots
+
+def uninstall(slots):
+  """Undo an install(), given the slots it returned."""
+  commands = []
+  removed = []
+  with _lock:
+    for device, band in slots:
+      used = _bands.get(device, set())
+      if band not in used:
+        continue
+      used.discard(band)
+      if not used:
+        # Deleting the root takes the filters and netem qdiscs with it
+        commands.append("qdisc del dev %s root" % device)
+        removed.extend(_roots.pop(device, []))
+        continue
+      for prio in _filter_prios(band):
+        commands.append("filter del dev %s parent %s: prio %d" % (device, ROOT_HANDLE, prio))
+      commands.append("qdisc del dev %s parent %s" % (device, _classid(band)))
+  # Keep going past errors, so one missing filter can't leave the rest behind
+  batch(commands, force=True)
+  undolog.undone(removed)
+
+def remove_leftovers(devices):
+  """
+  Remove the gremlins root qdisc from each of the given devices that
+  still has one, leaving any other root qdisc in place.
+
+  @returns the devices cleaned up
+  """
+  devices = [device for device in devices if root_qdisc(device)[1] == ROOT_HANDLE + ":"]
+  batch(["qdisc del dev %s root" % device for device in devices], force=True)
+  return devices
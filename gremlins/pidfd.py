@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Waiting for processes that are not our children to exit.
+
+On Linux 5.3 and later a pidfd (from pidfd_open, which python 2 has no
+wrapper for) becomes readable the moment its process exits, so one
+poll() wakes on each exit as it happens. A pidfd also pins its process's
+identity: opened before the process is signalled, it can never confuse
+the process with a later one that reuses the pid.
+
+Where pidfd_open is unavailable, exits are found by polling each pid's
+start time in /proc every POLL_INTERVAL.
+"""
+import ctypes
+import errno
+import os
+import select
+
+from gremlins import procfs
+from gremlins.clock import monotonic
+
+# The same on every architecture but alpha, since syscall numbers were
+# unified in Linux 5.1
+SYS_PIDFD_OPEN = 434
+
+POLL_INTERVAL = 0.01
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_syscall = _libc.syscall
+_syscall.restype = ctypes.c_long
+
+def pidfd_open(pid):
+  """Return a pidfd for the given pid. Raises OSError, eg ESRCH if it has gone."""
+  fd = _syscall(ctypes.c_long(SYS_PIDFD_OPEN), ctypes.c_int(pid), ctypes.c_uint(0))
+  if fd < 0:
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+  return fd
+
+def _start_time(pid):
+  """Return the pid's start time, or None if it has exited (or is a zombie)."""
+  try:
+    fields = procfs.read_stat(pid)
+  except (IOError, OSError, ValueError):
+    return None
+  if fields[2] == "Z":
+    return None
+  return int(fields[21])
+
+
+class ExitWatcher(object):
+  """
+  Watches a set of pids for exit. Create it before signalling them.
+
+  @param pids: the pids to watch
+  @param alive: optional function of a pid returning whether it is still
+                running; if given, it is polled instead of using pidfds
+  """
+  def __init__(self, pids, alive=None):
+    self.exited = {}
+    self.fds = {}
+    self.polled = {}
+    self.alive = alive
+    for pid in pids:
+      if alive is not None:
+        self.polled[pid] = None
+        continue
+      try:
+        self.fds[pidfd_open(pid)] = pid
+      except OSError, e:
+        if e.errno == errno.ESRCH:
+          self.exited[pid] = monotonic()
+        else:
+          # ENOSYS before 5.3, or EPERM under some seccomp filters
+          start = _start_time(pid)
+          if start is None:
+            self.exited[pid] = monotonic()
+          else:
+            self.polled[pid] = start
+
+  def _still_running(self, pid, start):
+    if self.alive is not None:
+      return self.alive(pid)
+    return _start_time(pid) == start
+
+  def _check_polled(self):
+    for pid, start in self.polled.items():
+      if not self._still_running(pid, start):
+        self.exited[pid] = monotonic()
+        del self.polled[pid]
+
+  def wait(self, timeout=None):
+    """
+    Wait until every pid has exited, or the timeout passes.
+
+    @returns a dict of pid -> monotonic time of exit, for those that exited
+    """
+    deadline = None
+    if timeout is not None:
+      deadline = monotonic() + timeout
+    poller = select.poll()
+    for fd in self.fds:
+      poller.register(fd, select.POLLIN)
+    self._check_polled()
+    while self.fds or self.polled:
+      wait_ms = -1
+      if self.polled:
+        wait_ms = POLL_INTERVAL * 1000
+      if deadline is not None:
+        remaining = max(0, (deadline - monotonic()) * 1000)
+        # An explicit test: a remaining of 0 must not fall through to -1,
+        # which would block forever
+        if wait_ms < 0:
+          wait_ms = remaining
+        else:
+          wait_ms = min(wait_ms, remaining)
+      try:
+        ready = poller.poll(int(wait_ms))
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      now = monotonic()
+      for fd, event in ready:
+        poller.unregister(fd)
+        os.close(fd)
+        self.exited[self.fds.pop(fd)] = now
+      self._check_polled()
+      if deadline is not None and monotonic() >= deadline:
+        break
+    return dict(self.exited)
+
+  def running(self):
+    """Return the pids not yet seen to exit."""
+    return sorted(self.fds.values() + self.polled.keys())
+
+  def close(self):
+    for fd in self.fds:
+      os.close(fd)
+    self.fds = {}
+    self.polled = {}
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Readiness probes, which measure how long a restarted daemon really
+takes to come back.
+
+After a fault restarts a daemon, watch_recovery() polls in the
+background, with backoff, through three stages:
+
+  process - a matching process exists
+  listen  - it is listening on every fixed port the old process
+            listened on
+  ready   - a TCP connect to each of those ports, at the address it is
+            bound to, succeeds (or, if configured, an HTTP GET returns
+            a non-error status)
+
+A port is fixed unless it lies in the kernel's ephemeral port range,
+where ports bound to port 0 (eg JMX's RMI server) come from and change
+on every start. Daemons whose configured ports lie in that range too
+(such as the 600x0 ports of older HBase) should be listed in
+FIXED_PORTS. A daemon with no fixed ports is taken to be listening once
+it listens on any port, and ready once any of them takes a connection.
+
+The time from the restart to each stage is recorded in a histogram per
+daemon and stage, and as a "recovery" event in the fault journal.
+"""
+import httplib
+import logging
+import socket
+import threading
+import urlparse
+
+from gremlins import events, procutils
+from gremlins.clock import monotonic
+from gremlins.stats import Histogram
+
+# How to find the processes started by a daemon name passed to
+# procutils.start_daemon, as keyword arguments to find_processes.
+# Daemons not listed here are found by main class.
+PROBE_TARGETS = {
+  'Accumulo-All': {'cmdline_regex': r'org\.apache\.accumulo\.start\.Main .*tserver'},
+}
+
+# Optional HTTP readiness checks, by daemon name, eg
+# {'HRegionServer': 'http://localhost:60030/'}
+HTTP_CHECKS = {}
+
+# The ports to wait for, by daemon name, where they cannot be told from
+# ephemeral ones, eg {'HRegionServer': [60020, 60030]}
+FIXED_PORTS = {}
+
+INITIAL_BACKOFF = 0.05
+MAX_BACKOFF = 2.0
+RECOVERY_TIMEOUT = 1800
+CONNECT_TIMEOUT = 1.0
+
+STAGES = ("process", "listen", "ready")
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+def histogram(daemon, stage):
+  """Return the time-to-stage histogram for the given daemon."""
+  with _histograms_lock:
+    key = (daemon, stage)
+    if key not in _histograms:
+      _histograms[key] = Histogram()
+    return _histograms[key]
+
+def find_daemon(daemon, fresh=False):
+  """Return the pids of the given daemon, as named in START_COMMANDS."""
+  target = PROBE_TARGETS.get(daemon, {'main_class': daemon})
+  return procutils.find_processes(fresh=fresh, **target)
+
+def fixed_ports(daemon, ports):
+  """Return the ports a restarted daemon should come back listening on."""
+  if daemon in FIXED_PORTS:
+    return sorted(FIXED_PORTS[daemon])
+  low, high = procutils.ephemeral_port_range()
+  return sorted(set(port for port in ports if not low <= port <= high))
+
+def _connect_host(address):
+  # A socket bound to the wildcard address takes connections on loopback
+  if address == "0.0.0.0":
+    return "127.0.0.1"
+  if address == "::":
+    return "::1"
+  return address
+
+def _http_ready(url):
+  parsed = urlparse.urlparse(url)
+  conn = httplib.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=CONNECT_TIMEOUT)
+  try:
+    conn.request("GET", parsed.path or "/")
+    return conn.getresponse().status < 400
+  except (socket.error, httplib.HTTPException):
+    return False
+  finally:
+    conn.close()
+
+class RecoveryProbe(object):
+  """
+  Polls one restarted daemon until it is ready or the timeout passes.
+
+  @param daemon: the daemon name, as passed to procutils.start_daemon
+  @param ports: the ports the old process listened on
+  @param started: monotonic time the restart was issued
+  @param activation: the fault activation that caused the restart
+  """
+  def __init__(self, daemon, ports, started, activation=None, timeout=RECOVERY_TIMEOUT):
+    self.daemon = daemon
+    self.ports = fixed_ports(daemon, ports or [])
+    self.started = started
+    self.activation = activation
+    self.timeout = timeout
+    self.times = {}
+    self.done = threading.Event()
+
+  def _check(self, stage, pids):
+    if stage == "process":
+      return bool(pids)
+    if stage == "listen":
+      listening = set()
+      for ports in procutils.get_listening_ports_many(pids).values():
+        listening.update(ports)
+      if not self.ports:
+        return bool(listening)
+      return listening.issuperset(self.ports)
+    url = HTTP_CHECKS.get(self.daemon)
+    if url:
+      return _http_ready(url)
+    bound = {}
+    for addresses in procutils.get_listening_addresses_many(pids).values():
+      for address, port in addresses:
+        bound.setdefault(port, []).append(address)
+
+    def reachable(port):
+      return any(procutils.can_connect((_connect_host(address), port), CONNECT_TIMEOUT)
+                 for address in bound.get(port, ()))
+    if not self.ports:
+      return any(reachable(port) for port in sorted(bound))
+    return all(reachable(port) for port in self.ports)
+
+  def run(self):
+    backoff = INITIAL_BACKOFF
+    stages = list(STAGES)
+    try:
+      while stages and monotonic() - self.started < self.timeout:
+        pids = find_daemon(self.daemon, fresh=True)
+        while stages and pids and self._check(stages[0], pids):
+          stage = stages.pop(0)
+          self.times[stage] = monotonic() - self.started
+          histogram(self.daemon, stage).record(self.times[stage])
+          logging.info("%s reached %s %.3fs after restart" %
+                       (self.daemon, stage, self.times[stage]))
+          backoff = INITIAL_BACKOFF
+        if stages:
+          self.done.wait(backoff)
+          backoff = min(backoff * 2, MAX_BACKOFF)
+      if stages:
+        logging.warn("%s did not reach %s within %d seconds of restart" %
+                     (self.daemon, stages[0], self.timeout))
+      fields = {"daemon": self.daemon, "ports": self.ports, "times": self.times,
+                "timed_out": stages and stages[0] or None}
+      if self.activation is not None:
+        fields["activation"] = self.activation.id
+        fields["fault"] = repr(self.activation.fault)
+      events.emit("recovery", **fields)
+    finally:
+      self.done.set()
+
+def watch_recovery(daemon, ports, started, activation=None):
+  """
+  Start probing a restarted daemon in the background.
+
+  @returns the RecoveryProbe; its done event is set when probing ends
+  """
+  probe = RecoveryProbe(daemon, ports, started, activation)
+  thread = threading.Thread(target=probe.run, name="gremlin-probe-%s" % daemon)
+  thread.setDaemon(True)
+  thread.start()
+  return probe
+
+def report():
+  """Log the time-to-recovery histograms collected so far."""
+  with _histograms_lock:
+    keys = sorted(_histograms)
+  for daemon, stage in keys:
+    logging.info("Time to %-7s %-16s %s" % (stage, daemon, histogram(daemon, stage).summary()))
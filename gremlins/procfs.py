@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers for reading process information straight out of /proc.
+
+These replace forking jps for every lookup: a scan of /proc/*/cmdline
+costs a few milliseconds even on a busy host, and a cached lookup costs
+a handful of stat reads.
+"""
+import os
+import re
+import socket
+import struct
+import threading
+import time
+
+PROC = os.getenv("GREMLINS_PROC", "/proc")
+
+# How long a process table snapshot is trusted before /proc is rescanned
+SNAPSHOT_TTL = 1.0
+
+# JVM options that consume the following argument
+_JAVA_OPTS_WITH_ARG = frozenset([
+  "-cp", "-classpath", "--class-path",
+  "-p", "--module-path", "--upgrade-module-path",
+  "--add-modules", "--add-opens", "--add-exports", "--add-reads",
+  "--limit-modules", "--patch-module",
+])
+
+def _read(path):
+  f = open(path, "rb")
+  try:
+    return f.read()
+  finally:
+    f.close()
+
+def list_pids():
+  """Return the pids of all processes currently in /proc."""
+  return [int(name) for name in os.listdir(PROC) if name.isdigit()]
+
+def read_stat(pid):
+  """
+  Return the fields of /proc/<pid>/stat as a list of strings.
+
+  The comm field may contain spaces and parentheses, so the line is
+  split around the last ')'. The returned list is indexed so that
+  fields[0] is the pid and fields[21] is the start time, matching the
+  1-based field numbers in proc(5) minus one.
+  """
+  data = _read("%s/%d/stat" % (PROC, pid))
+  lparen = data.index("(")
+  rparen = data.rindex(")")
+  return [data[:lparen].strip(), data[lparen + 1:rparen]] + data[rparen + 2:].split()
+
+def start_time(pid):
+  """Return the start time of the given pid in clock ticks since boot."""
+  return int(read_stat(pid)[21])
+
+def parent_pid(pid):
+  """Return the parent pid of the given pid."""
+  return int(read_stat(pid)[3])
+
+def process_tree(pids):
+  """
+  Return the given pids plus all their descendants, as a sorted list.
+  Processes that exit during the scan are left out.
+  """
+  children = {}
+  for pid in list_pids():
+    try:
+      children.setdefault(parent_pid(pid), []).append(pid)
+    except (IOError, OSError, ValueError):
+      continue
+  tree = set()
+  pending = list(pids)
+  while pending:
+    pid = pending.pop()
+    if pid in tree:
+      continue
+    tree.add(pid)
+    pending.extend(children.get(pid, ()))
+  return sorted(tree)
+
+def meminfo():
+  """Return /proc/meminfo as a dict of field -> bytes (or a count, for HugePages_*)."""
+  info = {}
+  for line in _read("%s/meminfo" % PROC).splitlines():
+    name, _, value = line.partition(":")
+    fields = value.split()
+    if not fields:
+      continue
+    amount = int(fields[0])
+    if len(fields) > 1 and fields[1] == "kB":
+      amount *= 1024
+    info[name] = amount
+  return info
+
+def read_io(pid):
+  """
+  Return /proc/<pid>/io as a dict of field -> count. Only readable by
+  the process's owner or root.
+  """
+  io = {}
+  for line in _read("%s/%d/io" % (PROC, pid)).splitlines():
+    name, _, value = line.partition(":")
+    io[name] = int(value)
+  return io
+
+def net_dev(pid=None):
+  """
+  Return the (rx_bytes, tx_bytes) of each network interface, from
+  /proc/net/dev, or that of the given pid's network namespace.
+  """
+  path = "%s/net/dev" % PROC
+  if pid is not None:
+    path = "%s/%d/net/dev" % (PROC, pid)
+  devices = {}
+  # Two header lines, then "iface: rx_bytes packets ... tx_bytes ..."
+  for line in _read(path).splitlines()[2:]:
+    name, _, counters = line.partition(":")
+    fields = counters.split()
+    devices[name.strip()] = (int(fields[0]), int(fields[8]))
+  return devices
+
+def read_cmdline(pid):
+  """Return the argv of the given pid as a list of strings."""
+  data = _read("%s/%d/cmdline" % (PROC, pid))
+  return data.split("\0")[:-1] if data.endswith("\0") else data.split("\0")
+
+def read_cgroups(pid):
+  """Return the list of cgroup paths the given pid belongs to."""
+  paths = []
+  for line in _read("%s/%d/cgroup" % (PROC, pid)).splitlines():
+    paths.append(line.split(":", 2)[2])
+  return paths
+
+def java_main_class(argv):
+  """
+  Return the name jps would report for the given java command line, or
+  None if argv is not a java invocation.
+
+  Like jps, this strips the package from the main class, and reports
+  the jar file name for -jar invocations.
+  """
+  if not argv or os.path.basename(argv[0]) != "java":
+    return None
+  args = iter(argv[1:])
+  for arg in args:
+    if arg in _JAVA_OPTS_WITH_ARG:
+      next(args, None)
+    elif arg == "-jar":
+      return os.path.basename(next(args, ""))
+    elif not arg.startswith("-"):
+      return arg.rpartition(".")[2]
+  return None
+
+
+class Process(object):
+  """A snapshot of a single running process."""
+  __slots__ = ["pid", "start_time", "argv", "main_class"]
+
+  def __init__(self, pid, start_time, argv):
+    self.pid = pid
+    self.start_time = start_time
+    self.argv = argv
+    self.main_class = java_main_class(argv)
+
+  def __repr__(self):
+    return "Process(%d, %r)" % (self.pid, self.main_class or self.argv[:1])
+
+
+class ProcessTable(object):
+  """
+  A cached view of the processes on this host.
+
+  The snapshot is rebuilt at most once per SNAPSHOT_TTL seconds. On a
+  rebuild, command lines are only re-read for pids whose start time has
+  changed, so pid reuse is detected without rereading every cmdline.
+  Lookups that hit a fresh snapshot still revalidate the start time of
+  each matching pid, so a pid that died or was reused is never returned.
+  """
+  def __init__(self, ttl=SNAPSHOT_TTL):
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.procs = {}
+    self.by_class = {}
+    self.taken_at = None
+
+  def invalidate(self):
+    """Force the next lookup to rescan /proc."""
+    with self.lock:
+      self.taken_at = None
+
+  def snapshot(self):
+    """Return a dict of pid -> Process, rescanning /proc if stale."""
+    return self._snapshot()[0]
+
+  def _snapshot(self):
+    with self.lock:
+      now = time.time()
+      if self.taken_at is None or now - self.taken_at > self.ttl:
+        self.procs = self._rescan(self.procs)
+        by_class = {}
+        for proc in self.procs.itervalues():
+          if proc.main_class:
+            by_class.setdefault(proc.main_class, []).append(proc)
+        self.by_class = by_class
+        self.taken_at = now
+      return self.procs, self.by_class
+
+  def _rescan(self, old):
+    procs = {}
+    for pid in list_pids():
+      try:
+        started = start_time(pid)
+        prev = old.get(pid)
+        if prev and prev.start_time == started:
+          procs[pid] = prev
+        else:
+          procs[pid] = Process(pid, started, read_cmdline(pid))
+      except (IOError, OSError):
+        # Process went away while we were looking at it
+        continue
+    return procs
+
+  def _alive(self, proc):
+    try:
+      return start_time(proc.pid) == proc.start_time
+    except (IOError, OSError):
+      return False
+
+  def find(self, main_class=None, cmdline_regex=None, cgroup=None):
+    """
+    Return the sorted pids of every process matching all of the given
+    criteria.
+
+    @param main_class: the jps-style short main class name, eg DataNode
+    @param cmdline_regex: a regex searched for in the space-joined argv
+    @param cgroup: a regex searched for in each of the process's cgroup paths
+    """
+    if cmdline_regex is not None and not hasattr(cmdline_regex, "search"):
+      cmdline_regex = re.compile(cmdline_regex)
+    if cgroup is not None and not hasattr(cgroup, "search"):
+      cgroup = re.compile(cgroup)
+
+    procs, by_class = self._snapshot()
+    if main_class is not None:
+      candidates = by_class.get(main_class, [])
+    else:
+      candidates = procs.values()
+    matches = []
+    for proc in candidates:
+      if main_class is not None and proc.main_class != main_class:
+        continue
+      if cmdline_regex is not None and not cmdline_regex.search(" ".join(proc.argv)):
+        continue
+      if cgroup is not None:
+        try:
+          if not any(cgroup.search(path) for path in read_cgroups(proc.pid)):
+            continue
+        except (IOError, OSError):
+          continue
+      if self._alive(proc):
+        matches.append(proc.pid)
+    matches.sort()
+    return matches
+
+
+# TCP state codes in /proc/net/tcp
+_TCP_LISTEN = "0A"
+_TCP_ESTABLISHED = "01"
+
+# Where the kernel picks ports for binds to port 0, if unreadable
+DEFAULT_EPHEMERAL_PORTS = (32768, 60999)
+
+def ephemeral_port_range():
+  """Return the (low, high) range the kernel picks ephemeral ports from."""
+  try:
+    low, high = _read("%s/sys/net/ipv4/ip_local_port_range" % PROC).split()
+    return int(low), int(high)
+  except (IOError, OSError, ValueError):
+    return DEFAULT_EPHEMERAL_PORTS
+
+def _address(hexaddr):
+  """Decode an IPv4 or IPv6 address from /proc/net/tcp{,6}."""
+  if len(hexaddr) == 8:
+    return socket.inet_ntoa(struct.pack("<I", int(hexaddr, 16)))
+  # Four host-order words
+  words = [int(hexaddr[i:i + 8], 16) for i in xrange(0, 32, 8)]
+  return socket.inet_ntop(socket.AF_INET6, struct.pack("<4I", *words))
+
+def _parse_tcp_table(path, index):
+  f = open(path, "rb")
+  try:
+    f.readline()  # header
+    for line in f:
+      fields = line.split()
+      if fields[3] != _TCP_LISTEN:
+        continue
+      address, _, port = fields[1].rpartition(":")
+      index[int(fields[9])] = (address, int(port, 16))
+  finally:
+    f.close()
+
+def listening_socket_index(pid=None):
+  """
+  Return a dict mapping socket inode -> (address, port) for every
+  listening TCP socket, from both tcp and tcp6. Addresses are left in
+  /proc's hex form; see _address.
+
+  @param pid: if given, read the tables for that pid's network namespace
+  """
+  if pid is None:
+    base = "%s/net" % PROC
+  else:
+    base = "%s/%d/net" % (PROC, pid)
+  index = {}
+  for table in ("tcp", "tcp6"):
+    try:
+      _parse_tcp_table("%s/%s" % (base, table), index)
+    except (IOError, OSError):
+      # eg no ipv6 support
+      continue
+  return index
+
+def socket_inodes(pid):
+  """Return the set of socket inodes held open by the given pid."""
+  fd_dir = "%s/%d/fd" % (PROC, pid)
+  inodes = set()
+  for fd in os.listdir(fd_dir):
+    try:
+      target = os.readlink("%s/%s" % (fd_dir, fd))
+    except OSError:
+      # fd closed under us
+      continue
+    if target.startswith("socket:["):
+      inodes.add(int(target[8:-1]))
+  return inodes
+
+def _netns(pid):
+  try:
+    return os.readlink("%s/%d/ns/net" % (PROC, pid))
+  except OSError:
+    return None
+
+def _listening(pids):
+  """Return a dict of pid -> set of (hex address, port) it listens on."""
+  indexes = {}
+  result = {}
+  for pid in pids:
+    try:
+      inodes = socket_inodes(pid)
+    except (IOError, OSError):
+      result[pid] = set()
+      continue
+    ns = _netns(pid)
+    if ns not in indexes:
+      indexes[ns] = listening_socket_index(pid)
+    index = indexes[ns]
+    result[pid] = set(index[inode] for inode in inodes if inode in index)
+  return result
+
+def listening_ports(pids):
+  """
+  Return a dict mapping each pid to the sorted list of TCP ports it is
+  listening on.
+
+  The socket tables are read once per network namespace, no matter how
+  many pids are asked about. Pids that have exited map to an empty list.
+  """
+  return dict((pid, sorted(set(port for address, port in sockets)))
+              for pid, sockets in _listening(pids).iteritems())
+
+def listening_addresses(pids):
+  """
+  Return a dict mapping each pid to the sorted list of (address, port)
+  its listening TCP sockets are bound to, eg ("10.0.0.5", 16020) or
+  ("::", 16030).
+  """
+  return dict((pid, sorted((_address(address), port) for address, port in sockets))
+              for pid, sockets in _listening(pids).iteritems())
+
+def _ipv4_address(hexaddr):
+  """Decode an address from /proc/net/tcp{,6}, or None if it is not IPv4."""
+  if len(hexaddr) == 32 and hexaddr.startswith("0000000000000000FFFF0000"):
+    # IPv4-mapped IPv6
+    hexaddr = hexaddr[24:]
+  if len(hexaddr) != 8:
+    return None
+  return socket.inet_ntoa(struct.pack("<I", int(hexaddr, 16)))
+
+def _parse_established(path, index):
+  f = open(path, "rb")
+  try:
+    f.readline()  # header
+    for line in f:
+      fields = line.split()
+      if fields[3] != _TCP_ESTABLISHED:
+        continue
+      local_port = int(fields[1].rpartition(":")[2], 16)
+      remote, _, remote_port = fields[2].rpartition(":")
+      index[int(fields[9])] = (local_port, _ipv4_address(remote), int(remote_port, 16))
+  finally:
+    f.close()
+
+def read_uid(pid):
+  """Return the effective uid of the given pid."""
+  for line in _read("%s/%d/status" % (PROC, pid)).splitlines():
+    if line.startswith("Uid:"):
+      return int(line.split()[2])
+  raise ValueError("No Uid in /proc/%d/status" % pid)
+
+def peer_connections(pids):
+  """
+  Return the sorted (local port, ip, port) of the TCP connections the
+  given pids made to other servers (eg a RegionServer's ZooKeeper
+  session), as opposed to connections accepted on their listening ports.
+  Only IPv4 peers are reported.
+  """
+  connections = set()
+  listening = listening_ports(pids)
+  indexes = {}
+  for pid in pids:
+    try:
+      inodes = socket_inodes(pid)
+    except (IOError, OSError):
+      continue
+    ns = _netns(pid)
+    if ns not in indexes:
+      base = "%s/%d/net" % (PROC, pid)
+      indexes[ns] = {}
+      for table in ("tcp", "tcp6"):
+        try:
+          _parse_established("%s/%s" % (base, table), indexes[ns])
+        except (IOError, OSError):
+          continue
+    index = indexes[ns]
+    for inode in inodes:
+      entry = index.get(inode)
+      if entry is None:
+        continue
+      local_port, ip, port = entry
+      if ip is not None and local_port not in listening[pid]:
+        connections.add(entry)
+  return sorted(connections)
+
+def connected_peers(pids):
+  """Return the sorted (ip, port) servers the given pids are connected to."""
+  return sorted(set((ip, port) for local_port, ip, port in peer_connections(pids)))
@@ -15,11 +15,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import binascii
 import re
 import signal
 import os
+import socket
 import subprocess
 import logging
+import threading
+
+from gremlins import backends, executor, metrics, pidfd, procfs
+from gremlins.clock import monotonic
 
 HBASE_HOME=os.getenv("HBASE_HOME", "/home/todd/monster-cluster/hbase")
 HADOOP_HOME=os.getenv("HADOOP_HOME", "/home/todd/monster-cluster/hadoop-0.20.1+169.66")
@@ -36,17 +42,246 @@ START_COMMANDS = {
 }
 
 
-def run(cmdv):
+class SubprocessBackend(backends.Backend):
+  """
+  The real backend: forks commands, signals real processes, and reads
+  /proc (falling back to jps and lsof where /proc is missing).
+  """
+  def __init__(self):
+    backends.Backend.__init__(self)
+    self.process_table = procfs.ProcessTable()
+
+  def run(self, cmdv, input=None):
+    self.count_exec(cmdv)
+    stdin = None
+    if input is not None:
+      stdin = subprocess.PIPE
+    proc = subprocess.Popen(args=cmdv, stdin=stdin, stdout=subprocess.PIPE)
+    (out, err) = proc.communicate(input)
+    if proc.returncode != 0:
+      raise Exception("Bad status code: %d" % proc.returncode)
+    return out
+
+  def call(self, cmdv):
+    self.count_exec(cmdv)
+    return subprocess.call(cmdv)
+
+  def kill(self, pid, sig):
+    os.kill(pid, sig)
+
+  def find_processes(self, main_class=None, cmdline_regex=None, cgroup=None, fresh=False):
+    if not os.path.isdir(procfs.PROC) and main_class and not (cmdline_regex or cgroup):
+      return _find_jvms_jps(main_class)
+    if fresh:
+      self.process_table.invalidate()
+    return self.process_table.find(main_class=main_class,
+                                   cmdline_regex=cmdline_regex,
+                                   cgroup=cgroup)
+
+  def can_connect(self, address, timeout):
+    try:
+      sock = socket.create_connection(address, timeout)
+    except socket.error:
+      return False
+    sock.close()
+    return True
+
+  def listening_ports(self, pids):
+    if os.path.isdir(procfs.PROC):
+      return procfs.listening_ports(pids)
+    return dict((pid, sorted(set(port for address, port in addresses)))
+                for pid, addresses in self._listening_addresses_lsof(pids).iteritems())
+
+  def listening_addresses(self, pids):
+    if os.path.isdir(procfs.PROC):
+      return procfs.listening_addresses(pids)
+    return self._listening_addresses_lsof(pids)
+
+  def _listening_addresses_lsof(self, pids):
+    pids = list(pids)
+    outputs = self.run_batch([(_lsof_cmdv(pid), None) for pid in pids])
+    return dict((pid, _parse_lsof_addresses(output)) for pid, output in zip(pids, outputs))
+
+  def ephemeral_port_range(self):
+    return procfs.ephemeral_port_range()
+
+  def peer_connections(self, pids):
+    if os.path.isdir(procfs.PROC):
+      return procfs.peer_connections(pids)
+    return []
+
+  def process_uids(self, pids):
+    uids = {}
+    for pid in pids:
+      try:
+        uids[pid] = procfs.read_uid(pid)
+      except (IOError, OSError):
+        continue
+    return uids
+
+  def start_time(self, pid):
+    try:
+      return procfs.start_time(pid)
+    except IOError, e:
+      raise OSError(e.errno, e.strerror)
+
+  def process_tree(self, pids):
+    return procfs.process_tree(pids)
+
+  def watch_exits(self, pids):
+    return pidfd.ExitWatcher(pids)
+
+  def read_file(self, path):
+    f = open(path)
+    try:
+      return f.read()
+    finally:
+      f.close()
+
+  def write_file(self, path, data):
+    # Control files take one write per value, so skip python's buffering
+    fd = os.open(path, os.O_WRONLY)
+    try:
+      os.write(fd, data)
+    finally:
+      os.close(fd)
+
+  def make_dir(self, path):
+    os.mkdir(path)
+
+  def remove_dir(self, path):
+    os.rmdir(path)
+
+
+class ExecutorBackend(SubprocessBackend):
+  """
+  Like SubprocessBackend, but runs commands in long-lived helper
+  processes (see gremlins.executor) rather than forking gremlins for
+  each one.
+
+  @param users: users to keep a helper running as, through sudo.
+                START_COMMANDS that sudo to one of them go to its helper
+                without running sudo again.
+  """
+  def __init__(self, users=()):
+    SubprocessBackend.__init__(self)
+    self.executors = {None: executor.Executor()}
+    for user in users:
+      self.executors[user] = executor.Executor([SUDO, "-n", "-u", user, "-i"])
+
+  def _route(self, cmdv):
+    """Return the executor for a command, and the command it should run."""
+    if len(cmdv) > 5 and cmdv[0] == SUDO and cmdv[1:3] == ["-n", "-u"] and \
+        cmdv[4] == "-i" and cmdv[3] in self.executors:
+      return self.executors[cmdv[3]], cmdv[5:]
+    return self.executors[None], cmdv
+
+  def _submit(self, executor, commands):
+    results = executor.submit(commands)
+    for returncode, output, error in results:
+      if error is not None:
+        raise OSError(*error)
+    return results
+
+  def run(self, cmdv, input=None):
+    return self.run_batch([(cmdv, input)])[0]
+
+  def run_batch(self, commands):
+    # Consecutive commands for the same helper go in one round trip
+    outputs = []
+    i = 0
+    while i < len(commands):
+      executor, _ = self._route(commands[i][0])
+      batch = []
+      while i < len(commands) and self._route(commands[i][0])[0] is executor:
+        cmdv, input = commands[i]
+        self.count_exec(cmdv)
+        batch.append((self._route(cmdv)[1], input, True))
+        i += 1
+      for returncode, output, error in self._submit(executor, batch):
+        if returncode != 0:
+          raise Exception("Bad status code: %d" % returncode)
+        outputs.append(output)
+    return outputs
+
+  def call(self, cmdv):
+    self.count_exec(cmdv)
+    executor, argv = self._route(cmdv)
+    return self._submit(executor, [(argv, None, False)])[0][0]
+
+  def close(self):
+    for executor in self.executors.values():
+      executor.close()
+
+
+_backend = SubprocessBackend()
+
+_issued_names = set()
+_issued_names_lock = threading.Lock()
+
+def new_name():
+  """
+  Return a fresh name for something gremlins creates on the host, such
+  as an iptables chain, ipset or cgroup.
+
+  Names carry 40 random bits rather than a timestamp, so faults fired in
+  the same second, or by separate gremlin processes, never collide.
+  """
+  with _issued_names_lock:
+    while True:
+      name = "gremlin_%s" % binascii.hexlify(os.urandom(5))
+      if name not in _issued_names:
+        _issued_names.add(name)
+        return name
+
+def set_backend(backend):
+  """
+  Replace the backend that runs commands and inspects processes, eg with
+  a gremlins.backends.FakeBackend. Returns the previous backend.
+  """
+  global _backend
+  previous, _backend = _backend, backend
+  return previous
+
+def get_backend():
+  """Return the current backend."""
+  return _backend
+
+def run(cmdv, input=None):
   """Run a command.
 
   Throws an exception if it has a nonzero exit code.
   Returns the output of the command.
+
+  @param input: optional string to feed to the command's stdin
   """
-  proc = subprocess.Popen(args=cmdv, stdout=subprocess.PIPE)
-  (out, err) = proc.communicate()
-  if proc.returncode != 0:
-    raise Exception("Bad status code: %d" % proc.returncode)
-  return out
+  start = monotonic()
+  try:
+    return _backend.run(cmdv, input)
+  finally:
+    metrics.exec_seconds.record(monotonic() - start, os.path.basename(cmdv[0]))
+
+def run_batch(commands):
+  """
+  Run several commands in order, as one round trip where the backend
+  allows, stopping at the first that fails.
+
+  Throws an exception if one has a nonzero exit code.
+  Returns the output of each command.
+
+  @param commands: a list of (cmdv, input) pairs, input being a string
+                   for the command's stdin, or None
+  """
+  start = monotonic()
+  try:
+    return _backend.run_batch(commands)
+  finally:
+    programs = sorted(set(os.path.basename(cmdv[0]) for cmdv, input in commands))
+    metrics.exec_seconds.record(monotonic() - start, "+".join(programs))
+
+def kill(pid, sig):
+  """Send a signal to a process."""
+  _backend.kill(pid, sig)
 
 
 def start_daemon(daemon):
@@ -55,35 +290,149 @@ def start_daemon(daemon):
     raise Exception("Don't know how to start a %s" % daemon)
   cmd = START_COMMANDS[daemon]
   logging.info("Starting %s: %s" % (daemon, repr(cmd)))
-  ret = subprocess.call(cmd)
+  start = monotonic()
+  ret = _backend.call(cmd)
+  metrics.exec_seconds.record(monotonic() - start, os.path.basename(cmd[0]))
   if ret != 0:
     logging.warn("Ret code %d starting %s" % (ret, daemon))
 
-def find_jvm(java_command):
+def find_processes(main_class=None, cmdline_regex=None, cgroup=None, fresh=False):
   """
-  Find the jvm for the given java class by running jps
+  Find every running process matching the given criteria by scanning /proc.
 
-  Returns the pid of this JVM, or None if it is not running.
+  @param main_class: jps-style java class name, eg HRegionServer
+  @param cmdline_regex: regex to search for in the process command line
+  @param cgroup: regex to search for in the process's cgroup paths
+  @param fresh: rescan /proc rather than trusting a recent snapshot, to
+                notice processes started in the last moment
+  @returns a sorted list of pids, empty if nothing matches
+  """
+  start = monotonic()
+  try:
+    return _backend.find_processes(main_class=main_class,
+                                   cmdline_regex=cmdline_regex,
+                                   cgroup=cgroup, fresh=fresh)
+  finally:
+    metrics.pid_discovery_seconds.record(monotonic() - start)
+
+def find_jvms(java_command):
   """
-  ret = run([JPS]).split("\n")
-  for line in ret:
+  Find all jvms running the given java class.
+
+  Falls back to running jps if /proc is not available.
+
+  Returns a list of pids, empty if none are running.
+  """
+  pids = find_processes(main_class=java_command)
+  if pids:
+    logging.info("Found %s: pids %s" % (java_command, repr(pids)))
+  else:
+    logging.info("Found no running %s" % java_command)
+  return pids
+
+def _find_jvms_jps(java_command):
+  pids = []
+  for line in run([JPS]).split("\n"):
     if not line: continue
     pid, command = line.split(' ', 1)
     if command == java_command:
-      logging.info("Found %s: pid %s" % (java_command, pid))
-      return int(pid)
-  logging.info("Found no running %s" % java_command)
+      pids.append(int(pid))
+  return sorted(pids)
+
+def find_jvm(java_command):
+  """
+  Find the jvm for the given java class.
+
+  Returns the pid of this JVM, or None if it is not running.
+  If several are running, returns the lowest pid.
+  """
+  pids = find_jvms(java_command)
+  if pids:
+    return pids[0]
   return None
 
+def can_connect(address, timeout):
+  """Return True if a TCP connection to the given (host, port) succeeds."""
+  return _backend.can_connect(address, timeout)
+
+def ephemeral_port_range():
+  """Return the (low, high) range the kernel picks ephemeral ports from."""
+  return _backend.ephemeral_port_range()
+
+def get_connected_peers(pids):
+  """
+  Return the sorted (ip, port) pairs of the servers the given pids have
+  connected to, eg a RegionServer's ZooKeeper and DataNodes.
+  """
+  return sorted(set((ip, port) for local_port, ip, port in _backend.peer_connections(pids)))
+
+def get_peer_connections(pids):
+  """
+  Return the sorted (local port, ip, port) of the connections the given
+  pids made to other servers.
+  """
+  return _backend.peer_connections(pids)
+
+def get_process_uids(pids):
+  """Return a dict of pid -> effective uid, leaving out pids that have exited."""
+  return _backend.process_uids(pids)
+
+def get_start_time(pid):
+  """Return the start time of the given pid; raise OSError if it has exited."""
+  return _backend.start_time(pid)
+
+def process_tree(pids):
+  """Return the given pids plus all their descendants, as a sorted list."""
+  return _backend.process_tree(pids)
+
+def watch_exits(pids):
+  """
+  Start watching the given pids for exit; see pidfd.ExitWatcher. Call
+  this before signalling them, then wait() on the result.
+  """
+  return _backend.watch_exits(pids)
+
 def get_listening_ports(pid):
   """Given a pid, return a list of TCP ports it is listening on."""
-  ports = []
-  lsof_data = run([LSOF, "-p%d" % pid, "-n", "-a", "-itcp", "-P"]).split("\n")
+  return get_listening_ports_many([pid])[pid]
+
+def get_listening_ports_many(pids):
+  """
+  Given a list of pids, return a dict mapping each pid to the list of
+  TCP ports it is listening on.
+
+  Reads /proc directly, building the socket index once for all pids.
+  Falls back to running lsof per pid if /proc is not available.
+  """
+  return _backend.listening_ports(pids)
+
+def get_listening_addresses_many(pids):
+  """
+  Given a list of pids, return a dict mapping each pid to the sorted
+  (address, port) pairs its listening TCP sockets are bound to.
+  """
+  return _backend.listening_addresses(pids)
+
+def _get_listening_ports_lsof(pid):
+  return _parse_lsof_listening(run(_lsof_cmdv(pid)))
+
+def _lsof_cmdv(pid):
+  return [LSOF, "-p%d" % pid, "-n", "-a", "-itcp", "-P"]
+
+def _parse_lsof_listening(output):
+  return [port for address, port in _parse_lsof_addresses(output)]
+
+def _parse_lsof_addresses(output):
+  addresses = []
+  lsof_data = output.split("\n")
   # first line is a header
   del lsof_data[0]
-  # Parse out the LISTEN rows
+  # Parse out the LISTEN rows, eg "TCP *:60020 (LISTEN)" or "TCP [::1]:8080 (LISTEN)"
   for record in lsof_data:
-    m = re.search(r'TCP\s*.+?:(\d+)\s*\(LISTEN\)', record)
+    m = re.search(r'TCP\s*(\S+):(\d+)\s*\(LISTEN\)', record)
     if m:
-      ports.append( int(m.group(1)) )
-  return ports
+      address = m.group(1).strip("[]")
+      if address == "*":
+        address = "0.0.0.0"
+      addresses.append((address, int(m.group(2))))
+  return sorted(addresses)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A sampling profiler for a running gremlin, switched on and off by a signal
+once installed (gremlins --profiler):
+
+  $ kill -USR2 <pid>     # start sampling
+  $ kill -USR2 <pid>     # stop, and write the profile
+
+While on, a thread samples the stack of every other thread every
+INTERVAL seconds. Nothing is traced, so a profiled gremlin runs at
+close to full speed. The profile is written in the collapsed-stack
+format that flamegraph.pl and speedscope read: one line per distinct
+stack, frames separated by semicolons, followed by its sample count.
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+INTERVAL = 0.01
+
+# Profiles are written here, or to GREMLINS_PROFILE_DIR if set
+DEFAULT_DIR = "/tmp"
+
+def _frame_name(frame):
+  code = frame.f_code
+  return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+def _collapse(frame):
+  names = []
+  while frame is not None:
+    names.append(_frame_name(frame))
+    frame = frame.f_back
+  names.reverse()
+  return ";".join(names)
+
+
+class Sampler(object):
+  """
+  Samples every thread's stack until stopped.
+
+  @param interval: seconds between samples
+  """
+  def __init__(self, interval=INTERVAL):
+    self.interval = interval
+    self.stacks = {}
+    self.samples = 0
+    self.stop_event = threading.Event()
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self._run, name="gremlin-profiler")
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def _run(self):
+    me = threading.currentThread().ident
+    while not self.stop_event.wait(self.interval):
+      names = dict((t.ident, t.getName()) for t in threading.enumerate())
+      for ident, frame in sys._current_frames().items():
+        if ident == me:
+          continue
+        stack = names.get(ident, "thread-%d" % ident) + ";" + _collapse(frame)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+      self.samples += 1
+
+  def stop(self):
+    self.stop_event.set()
+    if self.thread is not None:
+      self.thread.join()
+
+  def write(self, path):
+    with open(path, "w") as f:
+      for stack, count in sorted(self.stacks.iteritems()):
+        f.write("%s %d\n" % (stack, count))
+
+
+_sampler = None
+_lock = threading.Lock()
+
+def profile_path():
+  directory = os.environ.get("GREMLINS_PROFILE_DIR", DEFAULT_DIR)
+  return os.path.join(directory, "gremlins-profile-%d-%d.txt" % (os.getpid(), int(time.time())))
+
+def toggle():
+  """Start sampling, or stop and write the profile, returning its path."""
+  global _sampler
+  with _lock:
+    if _sampler is None:
+      _sampler = Sampler()
+      _sampler.start()
+      logging.info("Profiling started")
+      return None
+    sampler, _sampler = _sampler, None
+  sampler.stop()
+  path = profile_path()
+  sampler.write(path)
+  logging.info("Profiling stopped after %d samples: wrote %s" % (sampler.samples, path))
+  return path
+
+def _handle(signum, frame):
+  # Stopping joins the sampler thread and writes a file, which should not
+  # happen inside the handler itself
+  thread = threading.Thread(target=toggle, name="gremlin-profiler-toggle")
+  thread.setDaemon(True)
+  thread.start()
+
+def install(signum=signal.SIGUSR2):
+  """Toggle profiling whenever the given signal arrives."""
+  signal.signal(signum, _handle)
@@ -19,14 +19,18 @@
 import logging
 import os
 
-from gremlins import faults, metafaults, triggers, hostutils
-
-bastion = os.getenv("GREMLINS_BASTION_HOST", hostutils.guess_remote_host())
-
-if not bastion:
-  raise Exception("GREMLINS_BASTION_HOST not set, and I couldn't guess your remote host.")
-
-logging.info("Using %s as bastion host for network failures. You should be able to ssh from that host at all times." % bastion)
+from gremlins import faults, metafaults, triggers, hostutils, runtime
+
+def find_bastion():
+  bastion = os.getenv("GREMLINS_BASTION_HOST") or hostutils.guess_remote_host()
+  if not bastion:
+    raise Exception("GREMLINS_BASTION_HOST not set, and I couldn't guess your remote host.")
+  logging.info("Using %s as bastion host for network failures. You should be able to ssh from that host at all times." % bastion)
+  return bastion
+
+# Found when a network fault first fires, so that importing this profile
+# (eg just to list or simulate it) never reads wtmp
+bastion = runtime.Lazy(find_bastion)
 
 fail_node_long = faults.fail_network(bastion_host=bastion, seconds=300, restart_daemons=["Accumulo-All"], use_flush=True)
 # XXX make sure this is greater than ZK heartbeats
@@ -29,8 +29,11 @@ dn_kill_short = faults.kill_daemons(["DataNode"], signal.SIGKILL, 3)
 rs_pause = faults.pause_daemons(["HRegionServer"], 62)
 dn_pause = faults.pause_daemons(["DataNode"], 20)
 
-# This fault isn't that useful yet, since it only drops inbound packets
-# but outbound packets (eg, the ZK pings) keep going.
+# Drops packets both ways between the RegionServer and everything it
+# talks to, including its ZK session, so it really is cut off.
+rs_drop_packets = faults.drop_packets_to_daemons(["HRegionServer"], 64, bidirectional=True)
+# Only drops packets arriving at the RegionServer's ports; outbound
+# packets (eg, the ZK pings) keep going.
 rs_drop_inbound_packets = faults.drop_packets_to_daemons(["HRegionServer"], 64)
 
 profile = [
@@ -50,7 +53,7 @@ profile = [
 
     # drop packets (simulate network outage)
       #(1, faults.drop_packets_to_daemons(["DataNode"], 20)),
-      #(1, rs_drop_inbound_packets),
+      #(1, rs_drop_packets),
 
       ])),
 #  triggers.WebServerTrigger(12321)
@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+The fault lifecycle: inject, hold, revert.
+
+A Fault splits its work into inject() and revert(). Each firing gets an
+Activation, which records whatever inject() did (pids stopped, chains
+installed, ...) so that revert() can undo exactly that, and so that the
+same fault can be active several times at once.
+
+When a Runtime is installed (as run_profile does), calling a fault
+injects it and returns immediately; the hold is just an entry on the
+scheduler's timer heap, so thousands of faults can be active without a
+thread each, and every active fault can be reverted at once on
+shutdown. Without a Runtime, calling a fault blocks for the hold as it
+always has, and still reverts if interrupted.
+"""
+import collections
+import contextlib
+import itertools
+import logging
+import random
+import threading
+import time
+
+from gremlins import events, metrics, scheduler, undolog
+from gremlins.clock import monotonic
+
+_local = threading.local()
+
+@contextlib.contextmanager
+def trigger_path(step):
+  """
+  Note, for any fault fired within this block, that it was reached
+  through the given step (eg a trigger or a branch of a metafault).
+  """
+  path = getattr(_local, "path", ())
+  _local.path = path + (step,)
+  try:
+    yield
+  finally:
+    _local.path = path
+
+def current_path():
+  """Return the trigger path of the calling thread as a tuple."""
+  return getattr(_local, "path", ())
+
+@contextlib.contextmanager
+def using_rng(rng):
+  """
+  Make rng the random stream for any metafault run within this block,
+  so that a seeded trigger makes the same choices every time.
+  """
+  previous = getattr(_local, "rng", None)
+  _local.rng = rng
+  try:
+    yield
+  finally:
+    _local.rng = previous
+
+def current_rng():
+  """Return the calling thread's random stream, or the global one."""
+  return getattr(_local, "rng", None) or random
+
+@contextlib.contextmanager
+def capped(limit):
+  """
+  Fire no fault within this block while limit or more faults are
+  already active, counting all of them, however they were fired.
+  """
+  caps = getattr(_local, "caps", ())
+  _local.caps = caps + (limit,)
+  try:
+    yield
+  finally:
+    _local.caps = caps
+
+def current_context():
+  """
+  Return the calling thread's trigger path, random stream and caps, for
+  using_context to carry over to work done on another thread.
+  """
+  return (current_path(), getattr(_local, "rng", None), getattr(_local, "caps", ()))
+
+@contextlib.contextmanager
+def using_context(context):
+  """Run the block with a context taken by current_context."""
+  previous = current_context()
+  _local.path, _local.rng, _local.caps = context
+  try:
+    yield
+  finally:
+    _local.path, _local.rng, _local.caps = previous
+
+# Faults fired and not yet finished, counted against caps
+_active_count = 0
+_active_lock = threading.Lock()
+
+def active_count():
+  """Return the number of faults fired and not yet reverted."""
+  return _active_count
+
+def _admit(fault):
+  """
+  Count a fault about to fire, unless that would break a cap in force on
+  the calling thread. Returns whether it may fire.
+  """
+  global _active_count
+  caps = getattr(_local, "caps", ())
+  with _active_lock:
+    if caps and _active_count >= min(caps):
+      active = _active_count
+      admitted = False
+    else:
+      _active_count += 1
+      admitted = True
+  if not admitted:
+    logging.info("Not firing %s: %d faults active, at most %d allowed" %
+                 (repr(fault), active, min(caps)))
+    metrics.faults_capped.inc(metrics.fault_type(fault))
+  return admitted
+
+def _finished(activation):
+  global _active_count
+  with _active_lock:
+    _active_count -= 1
+
+class Lazy(object):
+  """
+  A value a profile needs but should not work out at import time, such
+  as a host to guess: fn is called the first time the value is needed,
+  and its result kept. Faults accepting one call resolve() on it.
+  """
+  _unset = object()
+
+  def __init__(self, fn):
+    self.fn = fn
+    self.lock = threading.Lock()
+    self.value = Lazy._unset
+
+  def get(self):
+    with self.lock:
+      if self.value is Lazy._unset:
+        self.value = self.fn()
+      return self.value
+
+  def __repr__(self):
+    if self.value is Lazy._unset:
+      return "lazy(%s)" % getattr(self.fn, "__name__", "?")
+    return repr(self.value)
+
+def resolve(value):
+  """Return value, or what it stands for if it is a Lazy."""
+  if isinstance(value, Lazy):
+    return value.get()
+  return value
+
+class Activation(object):
+  """
+  A single firing of a fault.
+
+  Faults stash whatever revert() will need in the details dict. By
+  convention the keys "pids", "ports" and "chains" hold what the fault
+  acted on; the whole dict ends up in the event journal.
+  """
+  _ids = itertools.count(1)
+
+  def __init__(self, fault):
+    self.id = next(Activation._ids)
+    self.fault = fault
+    self.details = {}
+    # Ids of the side effects recorded in the undo log
+    self.effects = []
+    self.path = current_path()
+    self.wall = time.time()
+    self.mono = monotonic()
+    self.timings = {}
+    self.error = None
+    self.injected_mono = None
+    self.timer = None
+    self.lock = threading.Lock()
+    self.injected = False
+    self.cancelled = False
+    self.reverted = False
+    self.done = threading.Event()
+    self.callbacks = []
+
+  def add_done_callback(self, fn):
+    """Call fn with this activation once it has been reverted (or failed)."""
+    with self.lock:
+      if not self.done.isSet():
+        self.callbacks.append(fn)
+        return
+    fn(self)
+
+  @contextlib.contextmanager
+  def timed(self, phase):
+    """Add the time spent in this block to the given phase's timing."""
+    start = monotonic()
+    try:
+      yield
+    finally:
+      self.timings[phase] = self.timings.get(phase, 0) + monotonic() - start
+
+  def record(self):
+    """Return the journal fields describing this activation."""
+    return {"id": self.id, "fault": repr(self.fault), "path": list(self.path),
+            "start_wall": self.wall, "start_mono": self.mono,
+            "timings": self.timings, "details": self.details,
+            "error": self.error}
+
+  def wait(self, timeout=None):
+    """Wait for the activation to finish. Returns True if it did."""
+    self.done.wait(timeout)
+    return self.done.isSet()
+
+  def _finish(self):
+    with self.lock:
+      self.done.set()
+      callbacks, self.callbacks = self.callbacks, []
+    for fn in callbacks:
+      try:
+        fn(self)
+      except Exception:
+        logging.exception("Uncaught exception in done callback for %s" % repr(self))
+
+  def __repr__(self):
+    return "<Activation %d of %s>" % (self.id, repr(self.fault))
+
+
+class Fault(object):
+  """
+  Base class for faults with separate inject and revert phases.
+
+  Subclasses set self.duration (the hold, in seconds) and implement
+  inject(activation) and, if there is anything to undo, revert(activation).
+  revert() must be safe to call even if inject() only got part way.
+  """
+  duration = 0
+
+  def prepare(self):
+    """
+    Optionally do the expensive parts of inject() ahead of time, such as
+    resolving pids or staging firewall chains, so that a later inject()
+    takes effect as quickly as possible.
+    """
+    pass
+
+  def unprepare(self):
+    """Discard anything staged by prepare() that was never injected."""
+    pass
+
+  def inject(self, activation):
+    raise NotImplementedError()
+
+  def revert(self, activation):
+    pass
+
+  def __call__(self):
+    return fire(self)
+
+
+# Threads reverting faults whose hold has expired
+REVERT_WORKERS = 16
+
+class Runtime(object):
+  """
+  Tracks active faults and reverts them when their hold expires.
+
+  Reverts run on a pool of their own, so that an expired hold is undone
+  straight away rather than queueing behind faults that are busy
+  injecting on the scheduler's workers (a kill can wait a minute for a
+  daemon to exit).
+
+  Once shutdown() has started, no new fault fires.
+  """
+  def __init__(self, scheduler=None):
+    self.scheduler = scheduler
+    self.lock = threading.Lock()
+    self.activations = {}
+    self.revert_pool = None
+    # Metafault groups with children still to start (see metafaults)
+    self.groups = set()
+    self.stopping = False
+
+  def fire(self, fault):
+    """
+    Inject the fault in the calling thread and schedule its revert.
+
+    @returns the Activation, which finishes once the fault is reverted,
+             or None if a cap (see capped) kept it from firing, or the
+             runtime is shutting down
+    """
+    if self.scheduler is None:
+      self.scheduler = scheduler.get_default()
+    if not _admit(fault):
+      return None
+    activation = Activation(fault)
+    activation.add_done_callback(_finished)
+    with self.lock:
+      # Checked under the same lock as the activation is added, so
+      # shutdown() either refuses it here or reverts it
+      stopping = self.stopping
+      if not stopping:
+        self.activations[activation.id] = activation
+        if self.revert_pool is None:
+          self.revert_pool = scheduler.WorkerPool(REVERT_WORKERS, name="gremlin-revert")
+    if stopping:
+      logging.info("Not firing %s: shutting down" % repr(fault))
+      activation._finish()
+      return None
+    try:
+      _inject(activation)
+    except Exception:
+      logging.exception("Failed to inject %s, reverting" % repr(fault))
+      self._revert(activation)
+      return activation
+
+    with activation.lock:
+      activation.injected = True
+      cancelled = activation.cancelled
+      if not cancelled:
+        activation.timer = self.scheduler.call_later(
+          fault.duration, lambda: self.revert_pool.submit(lambda: self._revert(activation)))
+    if cancelled:
+      self._revert(activation)
+    return activation
+
+  def cancel(self, activation):
+    """
+    Revert the given activation now, instead of when its hold expires.
+
+    If the fault is still being injected, it is reverted as soon as
+    inject() returns.
+    """
+    with activation.lock:
+      activation.cancelled = True
+      if not activation.injected:
+        return
+      if activation.timer:
+        activation.timer.cancel()
+    self._revert(activation)
+
+  def active(self):
+    """Return the list of activations that have not been reverted yet."""
+    with self.lock:
+      return sorted(self.activations.values(), key=lambda a: a.id)
+
+  def track(self, group):
+    """
+    Keep a metafault group whose children start on timers, so that
+    shutdown() can cancel those not started yet.
+
+    @returns False if shutdown has started, and the group should not start
+    """
+    with self.lock:
+      if self.stopping:
+        return False
+      self.groups.add(group)
+    return True
+
+  def untrack(self, group):
+    with self.lock:
+      self.groups.discard(group)
+
+  def shutdown(self, timeout=None):
+    """
+    Refuse any new fault, cancel the children metafaults have yet to
+    start, and revert every active fault, all in parallel, and wait for
+    them.
+
+    Reverts run on their own threads so they don't queue behind faults
+    that are busy injecting on the worker pool.
+    """
+    with self.lock:
+      self.stopping = True
+      groups, self.groups = list(self.groups), set()
+    for group in groups:
+      group.cancel()
+    threads = []
+    for activation in self.active():
+      thread = threading.Thread(target=self.cancel, args=(activation,),
+                                name="gremlin-revert-%d" % activation.id)
+      thread.setDaemon(True)
+      thread.start()
+      threads.append(thread)
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+    for thread in threads:
+      if deadline is None:
+        thread.join()
+      else:
+        thread.join(max(0, deadline - time.time()))
+
+  def _revert(self, activation):
+    with activation.lock:
+      if activation.reverted:
+        return
+      activation.reverted = True
+    try:
+      _revert(activation)
+    except Exception:
+      logging.exception("Failed to revert %s" % repr(activation.fault))
+    finally:
+      with self.lock:
+        self.activations.pop(activation.id, None)
+      activation._finish()
+
+
+_runtime = None
+
+def install(runtime):
+  """Make the given runtime the one faults fire through."""
+  global _runtime
+  _runtime = runtime
+
+def current():
+  """Return the installed runtime, or None."""
+  return _runtime
+
+def fire(fault):
+  """
+  Fire a fault through the installed runtime, or, if there is none,
+  inject it, block for its hold and revert it.
+  """
+  if _runtime is not None:
+    return _runtime.fire(fault)
+
+  if not _admit(fault):
+    return None
+  activation = Activation(fault)
+  activation.add_done_callback(_finished)
+  try:
+    _inject(activation)
+    activation.injected = True
+    time.sleep(fault.duration)
+  finally:
+    activation.reverted = True
+    try:
+      _revert(activation)
+    finally:
+      activation._finish()
+  return activation
+
+# Faults in effect right now, by type, however they were fired, and the
+# times the set last changed, so it can be asked about the recent past
+_in_effect = {}
+_in_effect_changes = collections.deque(maxlen=256)
+_in_effect_lock = threading.Lock()
+
+def _in_effect_changed(fault_type, delta):
+  # Called with _in_effect_lock held
+  _in_effect[fault_type] = _in_effect.get(fault_type, 0) + delta
+  in_effect = tuple(sorted(t for t, count in _in_effect.iteritems() if count))
+  _in_effect_changes.append((monotonic(), in_effect))
+
+def faults_in_effect(at=None):
+  """
+  Return the sorted types of the faults injected and not yet reverted,
+  or of those that were at the given (recent) monotonic time.
+  """
+  with _in_effect_lock:
+    for changed, in_effect in reversed(_in_effect_changes):
+      if at is None or changed <= at:
+        return list(in_effect)
+    return []
+
+def _inject(activation):
+  try:
+    with activation.timed("inject"):
+      activation.fault.inject(activation)
+  except Exception, e:
+    activation.error = repr(e)
+    metrics.fault_errors.inc(metrics.fault_type(activation.fault))
+    raise
+  fault_type = metrics.fault_type(activation.fault)
+  metrics.faults_fired.inc(fault_type)
+  with _in_effect_lock:
+    _in_effect_changed(fault_type, 1)
+  activation.injected_mono = monotonic()
+  fields = activation.record()
+  del fields["error"]
+  events.emit("inject", **fields)
+
+def _revert(activation):
+  if activation.injected_mono is not None:
+    activation.timings["hold"] = monotonic() - activation.injected_mono
+    with _in_effect_lock:
+      _in_effect_changed(metrics.fault_type(activation.fault), -1)
+  try:
+    with activation.timed("revert"):
+      activation.fault.revert(activation)
+  except Exception, e:
+    if activation.error is None:
+      activation.error = repr(e)
+    metrics.fault_errors.inc(metrics.fault_type(activation.fault))
+    raise
+  else:
+    # Anything revert() failed to undo stays in the log for --recover
+    undolog.undone(activation.effects)
+  finally:
+    fault_type = metrics.fault_type(activation.fault)
+    for phase, seconds in activation.timings.items():
+      metrics.fault_phase_seconds.record(seconds, fault_type, phase)
+    events.emit("revert", **activation.record())
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A single timer thread driving many triggers, plus a bounded pool of
+worker threads that actually run the faults.
+
+Timer callbacks run on the timer thread and must be quick; anything
+that can block (ie any fault) should be handed to the worker pool.
+"""
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import Queue
+import select
+import threading
+
+from gremlins.clock import monotonic
+
+DEFAULT_WORKERS = 16
+
+class WorkerPool(object):
+  """A fixed number of threads pulling callables off a shared queue."""
+  def __init__(self, size=DEFAULT_WORKERS, name="gremlin-worker"):
+    self.size = size
+    self.queue = Queue.Queue()
+    self.threads = []
+    for i in xrange(size):
+      thread = threading.Thread(target=self._thread_body, name="%s-%d" % (name, i))
+      thread.setDaemon(True)
+      thread.start()
+      self.threads.append(thread)
+
+  def submit(self, fn, callback=None):
+    """
+    Run fn on a worker thread.
+
+    @param callback: optional callable invoked with no arguments after fn
+                     finishes, whether or not it raised
+    """
+    self.queue.put((fn, callback))
+
+  def shutdown(self, wait=True):
+    """Stop the workers once the queued work has drained."""
+    for thread in self.threads:
+      self.queue.put(None)
+    if wait:
+      for thread in self.threads:
+        thread.join()
+
+  def _thread_body(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      fn, callback = item
+      try:
+        fn()
+      except Exception:
+        logging.exception("Uncaught exception running %s" % repr(fn))
+      if callback:
+        try:
+          callback()
+        except Exception:
+          logging.exception("Uncaught exception in callback for %s" % repr(fn))
+
+
+class Timer(object):
+  """Handle for a scheduled callback, which may be cancelled."""
+  __slots__ = ["deadline", "fn", "cancelled"]
+
+  def __init__(self, deadline, fn):
+    self.deadline = deadline
+    self.fn = fn
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+
+class Scheduler(object):
+  """
+  Runs callbacks at monotonic deadlines from a single heap-ordered
+  timer thread.
+
+  The timer thread sleeps in select() on a self-pipe rather than in
+  Condition.wait(), which in python 2 polls with up to 50ms of slop.
+  """
+  def __init__(self, workers=DEFAULT_WORKERS, clock=monotonic):
+    self.clock = clock
+    self.pool = WorkerPool(workers)
+    self.heap = []
+    self.seq = itertools.count()
+    self.lock = threading.Lock()
+    self.wakeup_r, self.wakeup_w = os.pipe()
+    fcntl.fcntl(self.wakeup_w, fcntl.F_SETFL, os.O_NONBLOCK)
+    self.should_stop = False
+    self.thread = threading.Thread(target=self._thread_body, name="gremlin-scheduler")
+    self.thread.setDaemon(True)
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.should_stop = True
+    self._wakeup()
+
+  def join(self):
+    self.thread.join()
+
+  def now(self):
+    return self.clock()
+
+  def call_at(self, deadline, fn):
+    """Run fn on the timer thread at the given monotonic time."""
+    timer = Timer(deadline, fn)
+    with self.lock:
+      heapq.heappush(self.heap, (deadline, next(self.seq), timer))
+      # Only wake the timer thread if we are the new earliest deadline
+      earliest = self.heap[0][2] is timer
+    if earliest:
+      self._wakeup()
+    return timer
+
+  def call_later(self, delay, fn):
+    """Run fn on the timer thread after delay seconds."""
+    return self.call_at(self.clock() + delay, fn)
+
+  def submit(self, fn, callback=None):
+    """Run fn on the worker pool as soon as a worker is free."""
+    self.pool.submit(fn, callback)
+
+  def _wakeup(self):
+    try:
+      os.write(self.wakeup_w, "x")
+    except OSError, e:
+      # A full pipe already guarantees a wakeup
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def _wait(self, timeout):
+    try:
+      readable, _, _ = select.select([self.wakeup_r], [], [], timeout)
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+      return
+    if readable:
+      os.read(self.wakeup_r, 4096)
+
+  def _next_due(self):
+    """Pop the next due timer, or return the seconds until one is due."""
+    with self.lock:
+      while self.heap:
+        deadline, seq, timer = self.heap[0]
+        if timer.cancelled:
+          heapq.heappop(self.heap)
+          continue
+        delay = deadline - self.clock()
+        if delay > 0:
+          return None, delay
+        heapq.heappop(self.heap)
+        return timer, 0
+      return None, None
+
+  def _thread_body(self):
+    while not self.should_stop:
+      timer, delay = self._next_due()
+      if timer is None:
+        self._wait(delay)
+        continue
+      try:
+        timer.fn()
+      except Exception:
+        logging.exception("Uncaught exception in timer %s" % repr(timer.fn))
+
+
+_default = None
+_default_lock = threading.Lock()
+
+def get_default():
+  """Return the process-wide scheduler, starting it on first use."""
+  global _default
+  with _default_lock:
+    if _default is None:
+      _default = Scheduler()
+      _default.start()
+    return _default
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Dry runs of fault profiles on a virtual clock, and replay of the
+resulting timelines.
+
+simulate() runs a profile's triggers against a VirtualScheduler, where
+time only moves when the next timer is due, and a SimulatedRuntime,
+which records each fault instead of injecting it and holds it for its
+duration in virtual time. Days of a profile take seconds. Given the
+same seed, the timeline is exactly what run_profile would fire.
+
+Timelines are written one JSON object per line:
+
+  {"t": 45.0, "fault": "hbase.rs_pause", "duration": 62, "path": [...]}
+
+where t is seconds from the start of the run. replay() fires the named
+faults of a timeline at the same offsets on a real cluster.
+
+Only runtime.Fault objects are simulated; any other callable in a
+profile is still called, though against a fake host (see
+gremlins.backends.FakeBackend), never this one.
+"""
+import heapq
+import itertools
+import json
+import logging
+import sys
+import time
+import types
+
+from gremlins import backends, procutils, runtime, scheduler, triggers
+from gremlins.clock import monotonic
+
+class VirtualScheduler(object):
+  """
+  A scheduler.Scheduler look-alike whose clock only advances as
+  run_until() works through the timers. Work submitted to it runs
+  inline, in no time at all.
+  """
+  def __init__(self, start=0.0):
+    self.time = start
+    self.heap = []
+    self.seq = itertools.count()
+
+  def now(self):
+    return self.time
+
+  def call_at(self, deadline, fn):
+    timer = scheduler.Timer(deadline, fn)
+    heapq.heappush(self.heap, (deadline, next(self.seq), timer))
+    return timer
+
+  def call_later(self, delay, fn):
+    return self.call_at(self.time + delay, fn)
+
+  def submit(self, fn, callback=None):
+    try:
+      fn()
+    except Exception:
+      logging.exception("Uncaught exception running %s" % repr(fn))
+    if callback:
+      callback()
+
+  def run_until(self, end):
+    """Run every timer due up to the given virtual time."""
+    while self.heap and self.heap[0][0] <= end:
+      deadline, seq, timer = heapq.heappop(self.heap)
+      if timer.cancelled:
+        continue
+      self.time = max(self.time, deadline)
+      try:
+        timer.fn()
+      except Exception:
+        logging.exception("Uncaught exception in timer %s" % repr(timer.fn))
+    self.time = max(self.time, end)
+
+
+class SimulatedRuntime(runtime.Runtime):
+  """
+  A runtime that records faults rather than injecting them.
+
+  @param names: dict of id(fault) -> name, as built by fault_names()
+  """
+  def __init__(self, scheduler, names=None):
+    runtime.Runtime.__init__(self, scheduler)
+    self.names = names or {}
+    self.start = scheduler.now()
+    self.timeline = []
+
+  def fire(self, fault):
+    if not runtime._admit(fault):
+      return None
+    activation = runtime.Activation(fault)
+    activation.add_done_callback(runtime._finished)
+    activation.injected = True
+    self.timeline.append({
+      "t": self.scheduler.now() - self.start,
+      "fault": self.names.get(id(fault), repr(fault)),
+      "named": id(fault) in self.names,
+      "duration": fault.duration,
+      "path": list(activation.path),
+    })
+    with self.lock:
+      self.activations[activation.id] = activation
+    activation.timer = self.scheduler.call_later(
+      fault.duration, lambda: self._revert_simulated(activation))
+    return activation
+
+  def cancel(self, activation):
+    if activation.timer:
+      activation.timer.cancel()
+    self._revert_simulated(activation)
+
+  def _revert_simulated(self, activation):
+    with activation.lock:
+      if activation.reverted:
+        return
+      activation.reverted = True
+    with self.lock:
+      self.activations.pop(activation.id, None)
+    activation._finish()
+
+
+def fault_names(namespace):
+  """
+  Name every fault reachable from the given namespace, either directly
+  or as an attribute of a module in it, eg "hbase.rs_pause".
+
+  @returns a dict of id(fault) -> name
+  """
+  names = {}
+  for key, value in sorted(namespace.items()):
+    if isinstance(value, types.ModuleType):
+      for attr, obj in sorted(vars(value).items()):
+        if isinstance(obj, runtime.Fault):
+          names.setdefault(id(obj), "%s.%s" % (key, attr))
+    elif isinstance(value, runtime.Fault):
+      names.setdefault(id(value), key)
+  return names
+
+def simulate(profile, seconds, seed, names=None):
+  """
+  Run a profile for the given number of virtual seconds.
+
+  @param profile: list of triggers, as passed to run_profile
+  @param seed: the seed run_profile would be given
+  @param names: dict of id(fault) -> name, as built by fault_names()
+  @returns the timeline, as a list of dicts
+  """
+  virtual = VirtualScheduler()
+  sim_runtime = SimulatedRuntime(virtual, names)
+  previous_runtime = runtime.current()
+  previous_backend = procutils.set_backend(backends.FakeBackend())
+  runtime.install(sim_runtime)
+  try:
+    triggers.seed_triggers(profile, seed)
+    for trigger in profile:
+      if not hasattr(trigger, "scheduler") or not getattr(trigger, "simulatable", True):
+        logging.warn("Cannot simulate %s, skipping it" % repr(trigger))
+        continue
+      trigger.scheduler = virtual
+      trigger.start()
+    virtual.run_until(seconds)
+    for trigger in profile:
+      if hasattr(trigger, "scheduler") and getattr(trigger, "simulatable", True):
+        trigger.stop()
+    # Faults still held at the end count against caps no longer
+    for activation in sim_runtime.active():
+      sim_runtime.cancel(activation)
+  finally:
+    runtime.install(previous_runtime)
+    procutils.set_backend(previous_backend)
+  return sim_runtime.timeline
+
+def write_timeline(timeline, out):
+  for entry in timeline:
+    out.write(json.dumps(entry, sort_keys=True) + "\n")
+
+def read_timeline(path):
+  timeline = []
+  with open(path) as f:
+    for line in f:
+      if line.strip():
+        timeline.append(json.loads(line))
+  return timeline
+
+def replay(timeline, lookup, speed=1.0, sched=None):
+  """
+  Fire the faults of a recorded timeline at their recorded offsets.
+
+  Faults are injected on the scheduler's worker pool, so a slow inject
+  doesn't hold up the ones after it. Entries whose fault had no name
+  when the timeline was recorded can't be looked up, and are skipped.
+
+  @param lookup: function from fault name to fault
+  @param speed: how many times faster than recorded to replay
+  @returns the number of faults fired
+  """
+  if sched is None:
+    sched = scheduler.get_default()
+  start = monotonic()
+  fired = 0
+  for entry in timeline:
+    if not entry.get("named", True):
+      logging.warn("Skipping unnamed fault %s at %.3f" % (entry["fault"], entry["t"]))
+      continue
+    fault = lookup(entry["fault"])
+    delay = start + entry["t"] / speed - monotonic()
+    if delay > 0:
+      time.sleep(delay)
+    logging.info("Replaying %s at %.3f" % (entry["fault"], entry["t"]))
+    sched.submit(_replay_one(fault, entry))
+    fired += 1
+  return fired
+
+def _replay_one(fault, entry):
+  def do():
+    with runtime.trigger_path("replay(%.3f)" % entry["t"]):
+      fault()
+  return do
+
+def main():
+  """Print a timeline: python -m gremlins.simulator MODULE.PROFILE SECONDS [SEED]"""
+  if len(sys.argv) not in (3, 4):
+    print >>sys.stderr, main.__doc__
+    sys.exit(1)
+  module_name, attr = sys.argv[1].rsplit(".", 1)
+  module = __import__(module_name, {}, {}, attr)
+  seed = len(sys.argv) == 4 and int(sys.argv[3]) or 0
+  names = fault_names({module_name.split(".")[-1]: module})
+  write_timeline(simulate(getattr(module, attr), float(sys.argv[2]), seed, names), sys.stdout)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Fixed-precision histograms for latencies and durations.
+"""
+import math
+import threading
+
+class Histogram(object):
+  """
+  A sparse log-bucketed histogram, in the spirit of HdrHistogram.
+
+  Each bucket is (1 + precision) times wider than the one before, so
+  any percentile is accurate to within the given relative precision no
+  matter the range of values, and memory grows only with the number of
+  distinct buckets hit. Values at or below lowest all land in bucket 0.
+
+  @param precision: relative bucket width, eg 0.01 for 1%
+  @param lowest: smallest value distinguished from zero
+  """
+  def __init__(self, precision=0.01, lowest=1e-6):
+    self.precision = precision
+    self.lowest = lowest
+    self.log_base = math.log(1 + precision)
+    self.lock = threading.Lock()
+    self.buckets = {}
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def _bucket(self, value):
+    if value <= self.lowest:
+      return 0
+    return int(math.log(value / self.lowest) / self.log_base) + 1
+
+  def _bucket_value(self, bucket):
+    """The upper bound of a bucket, which is what percentiles report."""
+    if bucket == 0:
+      return self.lowest
+    return self.lowest * math.exp(bucket * self.log_base)
+
+  def record(self, value):
+    bucket = self._bucket(value)
+    with self.lock:
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+      self.count += 1
+      self.total += value
+      if self.min is None or value < self.min:
+        self.min = value
+      if self.max is None or value > self.max:
+        self.max = value
+
+  def merge(self, other):
+    """Add every value recorded in other to this histogram."""
+    with other.lock:
+      buckets = dict(other.buckets)
+      count, total, lo, hi = other.count, other.total, other.min, other.max
+    with self.lock:
+      for bucket, n in buckets.iteritems():
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + n
+      self.count += count
+      self.total += total
+      if lo is not None and (self.min is None or lo < self.min):
+        self.min = lo
+      if hi is not None and (self.max is None or hi > self.max):
+        self.max = hi
+
+  def mean(self):
+    if not self.count:
+      return 0.0
+    return self.total / self.count
+
+  def percentile(self, pct):
+    """
+    Return the value below which pct percent of recorded values fall,
+    or None if nothing has been recorded.
+    """
+    with self.lock:
+      if not self.count:
+        return None
+      wanted = max(1, int(math.ceil(self.count * pct / 100.0)))
+      seen = 0
+      for bucket in sorted(self.buckets):
+        seen += self.buckets[bucket]
+        if seen >= wanted:
+          return min(self._bucket_value(bucket), self.max)
+      return self.max
+
+  def cumulative(self, bounds):
+    """
+    Return the number of recorded values at or below each of the given
+    sorted upper bounds, as a list.
+    """
+    with self.lock:
+      items = sorted(self.buckets.items())
+    counts = []
+    i = 0
+    seen = 0
+    for bound in bounds:
+      while i < len(items) and self._bucket_value(items[i][0]) <= bound:
+        seen += items[i][1]
+        i += 1
+      counts.append(seen)
+    return counts
+
+  def summary(self):
+    """A one-line description: count, mean and common percentiles."""
+    if not self.count:
+      return "count=0"
+    return "count=%d mean=%.3f p50=%.3f p99=%.3f p999=%.3f max=%.3f" % (
+      self.count, self.mean(), self.percentile(50), self.percentile(99),
+      self.percentile(99.9), self.max)
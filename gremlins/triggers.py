@@ -17,83 +17,304 @@
 # limitations under the License.
 
 import logging
+import random
 import threading
-import time
-from BaseHTTPServer import HTTPServer
-from SimpleHTTPServer import SimpleHTTPRequestHandler
-import cgi
 
-from gremlins import faults, metafaults
+from gremlins import faults, loadwatch, metafaults, runtime, scheduler
 
 class Trigger(object):
-  pass
+  """
+  Base class for triggers. Each trigger draws its random choices (its
+  own jitter, and those of the metafaults it fires) from its own stream,
+  so triggers don't perturb each other's schedules.
+  """
+  rng = None
+  # False for triggers whose firing depends on the live host, which
+  # --simulate can't reproduce
+  simulatable = True
+
+  def seed(self, seed):
+    """Restart this trigger's random stream from the given seed."""
+    self.rng = random.Random(seed)
+
+  # Triggers that fire self.fault on the scheduler's workers, one run at
+  # a time, call _init_run from __init__ and _start_run to fire it.
+
+  def _init_run(self):
+    self.running = False
+    self.idle = threading.Event()
+    self.idle.set()
+
+  def _start_run(self):
+    self.running = True
+    self.idle.clear()
+    self.scheduler.submit(self._run_fault)
+
+  def _trigger_path(self):
+    return repr(self)
+
+  def _run_fault(self):
+    logging.info("%s triggering fault %r" % (self.__class__.__name__, self.fault))
+    try:
+      with runtime.trigger_path(self._trigger_path()):
+        with runtime.using_rng(self.rng):
+          result = self.fault()
+    except:
+      self._finish_run(None)
+      raise
+    # Under a runtime the fault returns once injected; the run isn't
+    # over until it has been reverted.
+    if isinstance(result, runtime.Activation):
+      result.add_done_callback(self._finish_run)
+    else:
+      self._finish_run(None)
+
+  def _finish_run(self, activation):
+    self._run_done(activation)
+    self.running = False
+    self.idle.set()
+
+  def _run_done(self, activation):
+    """
+    Called as a run finishes, before the next can start: with its
+    Activation once that has been reverted, or with None if the fault
+    didn't fire (or raised).
+    """
+    pass
+
+def seed_triggers(triggers, seed):
+  """
+  Give each trigger of a profile its own stream, derived from one seed,
+  so that the whole profile makes the same choices whenever it is run
+  with that seed.
+  """
+  streams = random.Random(seed)
+  for trigger in triggers:
+    trigger.seed(streams.getrandbits(64))
 
 class Periodic(Trigger):
-  def __init__(self, period, fault):
+  """
+  Runs a fault over and over on a schedule.
+
+  All Periodic triggers share one timer thread and run their faults on
+  the scheduler's worker pool, so hundreds of triggers cost no more
+  threads than a handful.
+
+  With fixed_rate=False (the default) the next run is scheduled period
+  seconds after the previous fault finishes. With fixed_rate=True runs
+  are scheduled every period seconds regardless of how long the fault
+  takes; a run that comes due while the previous one is still going is
+  skipped rather than stacked up.
+
+  @param period: seconds between runs
+  @param fault: the fault to run
+  @param fixed_rate: see above
+  @param jitter: each interval is randomly lengthened or shortened by up
+                 to this many seconds
+  @param scheduler: the scheduler to run on; defaults to the shared one
+  """
+  def __init__(self, period, fault, fixed_rate=False, jitter=0, scheduler=None):
     self.period = period
     self.fault = fault
-    self.thread = threading.Thread(target=self._thread_body)
-    self.thread.setDaemon(True)
+    self.fixed_rate = fixed_rate
+    self.jitter = jitter
+    self.scheduler = scheduler
+    self.rng = random.Random()
     self.should_stop = False
+    self.timer = None
+    self.next_deadline = None
+    self._init_run()
 
   def start(self):
-    self.thread.start()
+    if self.scheduler is None:
+      self.scheduler = scheduler.get_default()
+    logging.info("Periodic trigger starting")
+    self.next_deadline = self.scheduler.now()
+    self.timer = self.scheduler.call_at(self.next_deadline, self._fire)
 
   def stop(self):
     self.should_stop = True
+    if self.timer:
+      self.timer.cancel()
 
   def join(self):
-    self.thread.join()
-
-  def _thread_body(self):
-    logging.info("Periodic trigger starting")
-    while not self.should_stop:
-      logging.info("Periodic triggering fault " + repr(self.fault))
-      self.fault()
-      time.sleep(self.period)
+    self.idle.wait()
     logging.info("Periodic trigger stopping")
 
+  def _interval(self):
+    if not self.jitter:
+      return self.period
+    return max(0, self.period + self.rng.uniform(-self.jitter, self.jitter))
+
+  def _fire(self):
+    if self.should_stop:
+      return
+    if self.fixed_rate:
+      # Schedule off the previous deadline, not the current time, so
+      # timer latency doesn't accumulate. If we fell more than a period
+      # behind, skip the missed runs instead of firing them all at once.
+      now = self.scheduler.now()
+      self.next_deadline += self._interval()
+      if self.next_deadline < now:
+        self.next_deadline = now + self._interval()
+      self.timer = self.scheduler.call_at(self.next_deadline, self._fire)
+      if self.running:
+        logging.warn("Periodic skipping %s, previous run still in progress" %
+                     repr(self.fault))
+        return
+    self._start_run()
+
+  def _trigger_path(self):
+    return "Periodic(%s)" % self.period
+
+  def _finish_run(self, activation):
+    Trigger._finish_run(self, activation)
+    if not self.fixed_rate and not self.should_stop:
+      self.timer = self.scheduler.call_later(self._interval(), self._fire)
+
+
+class LoadTrigger(Trigger):
+  """
+  Fires a fault when the target daemons are busiest, eg mid-compaction
+  or under heavy ingest, rather than on a timer.
+
+  Every interval seconds the daemons' cpu, disk and network rates are
+  sampled from /proc (see gremlins.loadwatch) into ring buffers of the
+  last history samples. When the thresholds are crossed for sustain
+  samples in a row, the fault fires; after it has been reverted, the
+  trigger waits cooldown seconds before it can fire again.
+
+    LoadTrigger(["HRegionServer"], rs_kill, {"cpu": 2.0, "disk": "p95"})
+
+  fires when the region server uses two cores, or does more disk I/O
+  than in 95% of the last five minutes.
+
+  @param daemons: daemons to watch, as named in START_COMMANDS
+  @param fault: the fault to run
+  @param thresholds: dict of metric ("cpu" in cores, "disk" or "net" in
+                     bytes/s) -> an absolute rate, or "pNN" for the NNth
+                     percentile of the metric's recent history
+  @param interval: seconds between samples
+  @param history: samples kept per metric, for percentiles
+  @param cooldown: seconds after a fault is reverted before firing again
+  @param sustain: consecutive samples the thresholds must be crossed for
+  @param mode: "any" to fire when any threshold is crossed, "all" when
+               all of them are
+  @param scheduler: the scheduler to run on; defaults to the shared one
+  """
+  simulatable = False
+
+  def __init__(self, daemons, fault, thresholds, interval=1.0, history=300, cooldown=300,
+               sustain=3, mode="any", scheduler=None):
+    if mode not in ("any", "all"):
+      raise ValueError("mode must be any or all, not %r" % mode)
+    if not thresholds:
+      raise ValueError("LoadTrigger needs at least one threshold")
+    self.daemons = list(daemons)
+    self.fault = fault
+    self.thresholds = dict((metric, loadwatch.parse_threshold(metric, spec))
+                           for metric, spec in thresholds.iteritems())
+    self.interval = interval
+    self.cooldown = cooldown
+    self.sustain = max(1, sustain)
+    self.mode = mode
+    self.scheduler = scheduler
+    self.sampler = loadwatch.LoadSampler(daemons, history)
+    self.rng = random.Random()
+    self.should_stop = False
+    self.streak = 0
+    self.quiet_until = None
+    self.timer = None
+    self._init_run()
+
+  def __repr__(self):
+    return "LoadTrigger(%r, %r)" % (self.daemons, self.fault)
+
+  def start(self):
+    if self.scheduler is None:
+      self.scheduler = scheduler.get_default()
+    logging.info("Load trigger starting on %s" % ", ".join(self.daemons))
+    self.timer = self.scheduler.call_at(self.scheduler.now(), self._tick)
+
+  def stop(self):
+    self.should_stop = True
+    if self.timer:
+      self.timer.cancel()
+
+  def join(self):
+    self.idle.wait()
+    logging.info("Load trigger stopping")
+
+  def _tick(self):
+    if self.should_stop:
+      return
+    # Sampling reads /proc, which is better kept off the timer thread
+    self.scheduler.submit(self._sample)
+
+  def _sample(self):
+    try:
+      self._check(self.sampler.sample())
+    finally:
+      if not self.should_stop:
+        self.timer = self.scheduler.call_later(self.interval, self._tick)
+
+  def _check(self, rates):
+    if rates is None:
+      self.streak = 0
+      return
+    crossed = self.sampler.crossed(self.thresholds, rates)
+    if not crossed or (self.mode == "all" and len(crossed) < len(self.thresholds)):
+      self.streak = 0
+      return
+    self.streak += 1
+    if self.streak < self.sustain or self.running:
+      return
+    if self.quiet_until is not None and self.scheduler.now() < self.quiet_until:
+      return
+    self.streak = 0
+    logging.info("Load trigger firing on %s: %s" % (", ".join(self.daemons), ", ".join(crossed)))
+    self._start_run()
+
+  def _trigger_path(self):
+    return "LoadTrigger(%s)" % ",".join(self.daemons)
+
+  def _run_done(self, activation):
+    # A fault that didn't fire (a cap, or maybe_fault saying no) did
+    # nothing to cool down from
+    if activation is not None:
+      self.quiet_until = self.scheduler.now() + self.cooldown
+
 
 class WebServerTrigger(Trigger):
-  def __init__(self, port):
+  """
+  Fires faults posted over HTTP, through the gremlins.control API.
+
+  A posted fault is first looked up by name in the registry, if one is
+  given (eg the faults of a declarative profile). Otherwise it is
+  evaluated in this module's namespace (so faults.*, metafaults.* and so
+  on are available) plus any extra namespace given, unless evaluate is
+  False.
+
+  The server listens on localhost. Listening on another host needs a
+  secret to sign requests with (see gremlins.control), or evaluate=False.
+  """
+  def __init__(self, port, namespace=None, registry=None, host="127.0.0.1", secret=None,
+               evaluate=True):
+    # The HTTP server modules are only worth importing if this is used
+    from gremlins import control
     self.port = port
-    self.server = HTTPServer(('', port), WebServerTrigger.MyHandler)
+    eval_namespace = None
+    if evaluate:
+      eval_namespace = dict(globals())
+      eval_namespace.update(namespace or {})
+    self.server = control.ControlServer(port, eval_namespace, host=host, registry=registry,
+                                        secret=secret)
 
   def start(self):
-    self.thread = threading.Thread(target=self.server.serve_forever)
-    self.thread.setDaemon(True)
-    self.thread.start()
-    time.sleep(60)
+    self.server.start()
 
   def stop(self):
-    self.server.shutdown()
+    self.server.stop()
 
   def join(self):
-    self.thread.join()
-
-  class MyHandler(SimpleHTTPRequestHandler):
-    def do_POST(self):
-      ctype,pdict = cgi.parse_header(self.headers.getheader('Content-type'))
-      if ctype != 'multipart/form-data':
-        self.sendresponse(500)
-        self.end_headers()
-        self.wfile.write('Must post form with fault= data')
-        return
-
-      query = cgi.parse_multipart(self.rfile, pdict)
-      print query
-
-      try:
-        code = query.get('fault', ["NO FAULT"])[0]
-        print "code: " + code
-        result = eval(code, globals())
-        if not result or not callable(result):
-          raise "Fault must be a callable!"
-        result()
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write("Success! " + repr(result) + "\n")
-      except Exception, e:
-        self.send_response(500)
-        self.end_headers()
-        self.wfile.write('Error: ' + repr(e))
+    self.server.join()
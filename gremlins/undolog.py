@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A crash-safe, write-ahead log of the side effects faults leave on the
+host, so that whatever a dead gremlin process left behind can be undone.
+
+Before a fault stops a pid, installs chains, creates ipsets, moves
+processes between cgroups, adds netem qdiscs or writes a scratch file,
+it records the effect here; the record is synced to disk before the
+effect is applied. Once the fault has been reverted its effects are
+marked undone. Whatever is left when gremlins dies is undone by
+recover() (gremlins --recover), in one pass, which leaves alone the
+effects of gremlins that are still running:
+
+  stop     pid, start_time   - SIGCONT, if the pid hasn't been reused
+  restart  daemon            - start it, if it isn't running
+  chains   chains            - those still in iptables-save are unhooked
+                               and deleted in one transaction
+  ipsets   sets              - those still in ipset list destroyed
+  cgroup   cgroup, moves     - processes moved back, the cgroup removed
+  netem    devices           - gremlins' root qdiscs removed in one tc -batch
+  file     path              - the scratch file removed
+
+Records are JSON, one per line, tagged with an effect id unique across
+gremlin processes sharing the file. Each gremlin also records when it
+opened the log, so recover() can tell which effects belong to gremlins
+that are still running. The log is compacted down to the effects never
+undone whenever it is opened with no other gremlin writing to it.
+"""
+import errno
+import fcntl
+import itertools
+import json
+import logging
+import os
+import signal
+import threading
+
+from gremlins import cgroups, ipsets, iptables, probes, procfs, procutils
+
+DEFAULT_PATH = os.getenv("GREMLINS_UNDO_LOG", "/var/tmp/gremlins.undo")
+
+class UndoLog(object):
+  """
+  Appends side-effect records to a file.
+
+  An effect is synced to disk before record() returns, since it is about
+  to be applied; records made at the same time by several threads share
+  one fdatasync. Undone records are not synced: losing one in a crash
+  only means recover() undoes an effect a second time, which is harmless.
+
+  While open, the log holds a shared lock on the file, so compact() can
+  tell whether any gremlin is still writing to it.
+  """
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.sync_lock = threading.Lock()
+    self.written = 0
+    self.synced = 0
+    self.ids = itertools.count(1)
+    # Drop whatever earlier gremlins undid, unless one is still running
+    compact(path)
+    self.fd = _open_shared(path)
+    pid = os.getpid()
+    self._write({"op": "open", "pid": pid, "start_time": _start_time(pid)}, sync=False)
+
+  def _write(self, record, sync=True):
+    with self.lock:
+      # One write per record, so records from several processes
+      # appending to the same file never interleave
+      os.write(self.fd, _line(record))
+      self.written += 1
+      ticket = self.written
+    if sync:
+      self._sync(ticket)
+
+  def _sync(self, ticket):
+    with self.sync_lock:
+      # A sync started after our write, by another thread, covers it
+      if self.synced >= ticket:
+        return
+      with self.lock:
+        written = self.written
+      os.fdatasync(self.fd)
+      self.synced = written
+
+  def record(self, kind, **fields):
+    """Durably record an effect about to be applied. Returns its id."""
+    effect_id = "%d-%d" % (os.getpid(), next(self.ids))
+    fields["op"] = "effect"
+    fields["id"] = effect_id
+    fields["kind"] = kind
+    self._write(fields)
+    return effect_id
+
+  def undone(self, effect_ids):
+    """Record that the given effects have been undone."""
+    if effect_ids:
+      self._write({"op": "undone", "ids": list(effect_ids)}, sync=False)
+
+  def close(self):
+    with self.lock:
+      os.close(self.fd)
+
+
+def _line(record):
+  return json.dumps(record, separators=(",", ":")) + "\n"
+
+def _is_current(fd, path):
+  """Whether fd is still the file at path, ie no compaction replaced it."""
+  try:
+    return os.fstat(fd).st_ino == os.stat(path).st_ino
+  except OSError:
+    return False
+
+def _open_shared(path):
+  while True:
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    if _is_current(fd, path):
+      return fd
+    os.close(fd)
+
+def compact(path):
+  """
+  Rewrite the log with only the effects never undone, if no gremlin
+  has it open. The new log replaces the old one by a rename, so a crash
+  part way through leaves one or the other.
+
+  @returns True if the log was compacted (or does not exist)
+  """
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError, e:
+    if e.errno == errno.ENOENT:
+      return True
+    raise
+  try:
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+      if e.errno not in (errno.EAGAIN, errno.EACCES):
+        raise
+      return False
+    if not _is_current(fd, path):
+      # Another compaction got there first
+      return False
+    temp = path + ".compact"
+    f = os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "w")
+    try:
+      effects, opens = _read(path)
+      for opened in opens.itervalues():
+        f.write(_line(opened))
+      for effect in effects:
+        f.write(_line(effect))
+      f.flush()
+      os.fsync(f.fileno())
+    finally:
+      f.close()
+    os.rename(temp, path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+      os.fsync(directory)
+    finally:
+      os.close(directory)
+    return True
+  finally:
+    os.close(fd)
+
+
+_log = None
+
+def install(log):
+  """Record effects in the given UndoLog (or nowhere, if None)."""
+  global _log
+  _log = log
+
+def record(activation, kind, **fields):
+  """
+  Record an effect the given activation is about to apply, if an undo
+  log is installed. The runtime marks it undone once the activation has
+  been reverted.
+
+  @param activation: the Activation, or a list to collect the effect id in
+  """
+  log = _log
+  if log is None:
+    return None
+  effect_id = log.record(kind, **fields)
+  if isinstance(activation, list):
+    activation.append(effect_id)
+  else:
+    activation.effects.append(effect_id)
+  return effect_id
+
+def undone(effect_ids):
+  log = _log
+  if log is not None:
+    log.undone(effect_ids)
+
+def _read(path):
+  """
+  Return the effects recorded in the log that were never undone, in
+  order, and the open records of the gremlins that wrote them, by pid.
+  """
+  effects = []
+  opens = {}
+  done = set()
+  try:
+    f = open(path)
+  except IOError:
+    return [], {}
+  try:
+    for line in f:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        # A record torn by a crash was never acted on
+        continue
+      if entry.get("op") == "effect":
+        effects.append(entry)
+      elif entry.get("op") == "undone":
+        done.update(entry["ids"])
+      elif entry.get("op") == "open":
+        opens[entry["pid"]] = entry
+  finally:
+    f.close()
+  effects = [effect for effect in effects if effect["id"] not in done]
+  writers = set(_writer(effect) for effect in effects)
+  return effects, dict((pid, entry) for pid, entry in opens.iteritems() if pid in writers)
+
+def pending(path):
+  """Return the effects recorded in the log that were never undone, in order."""
+  return _read(path)[0]
+
+def _writer(effect):
+  return int(effect["id"].split("-")[0])
+
+def _start_time(pid):
+  try:
+    return procfs.start_time(pid)
+  except (IOError, OSError, ValueError):
+    return None
+
+def _process_start_time(pid):
+  # The daemons faults act on live on the backend's host, which may be
+  # a fake one; gremlins themselves always run on this one
+  try:
+    return procutils.get_start_time(pid)
+  except (OSError, ValueError):
+    return None
+
+def _alive(pid, opened):
+  """Whether the gremlin with the given pid and open record still runs."""
+  start_time = _start_time(pid)
+  if start_time is None:
+    return False
+  if opened is None or opened.get("start_time") is None:
+    # Logged before gremlins recorded their start; the pid may be reused
+    return True
+  return start_time == opened["start_time"]
+
+def record_stop(activation, pid):
+  """Record that a pid is about to be SIGSTOPped."""
+  return record(activation, "stop", pid=pid, start_time=_process_start_time(pid))
+
+# Each step returns the effects it undid, or that needed no undoing.
+
+def _resume(effects):
+  undone = []
+  for effect in effects:
+    pid = effect["pid"]
+    if effect["start_time"] is None or _process_start_time(pid) != effect["start_time"]:
+      undone.append(effect)
+      continue
+    logging.warn("Resuming pid %d" % pid)
+    try:
+      procutils.kill(pid, signal.SIGCONT)
+    except OSError, e:
+      if e.errno != errno.ESRCH:
+        logging.warn("Could not resume pid %d: %s" % (pid, e))
+        continue
+    undone.append(effect)
+  return undone
+
+def _restart(effects):
+  undone = []
+  for daemon in sorted(set(effect["daemon"] for effect in effects)):
+    if not probes.find_daemon(daemon, fresh=True):
+      logging.warn("Restarting %s" % daemon)
+      try:
+        procutils.start_daemon(daemon)
+      except Exception, e:
+        logging.warn("Could not restart %s: %s" % (daemon, e))
+        continue
+    undone.extend(effect for effect in effects if effect["daemon"] == daemon)
+  return undone
+
+def _restore_cgroups(effects):
+  undone = []
+  for effect in effects:
+    cgroup = effect["cgroup"]
+    try:
+      cgroups.write(cgroup, "cgroup.freeze", 0)
+    except (IOError, OSError):
+      pass
+    origins = dict((pid, origin) for pid, origin in effect["moves"])
+    try:
+      pids = cgroups.procs(cgroup)
+    except (IOError, OSError):
+      # Never created, or already removed
+      undone.append(effect)
+      continue
+    fallback = effect["moves"] and effect["moves"][0][1] or "/"
+    for pid in pids:
+      try:
+        cgroups.move(pid, origins.get(pid, fallback))
+      except (IOError, OSError), e:
+        logging.warn("Could not move pid %d out of %s: %s" % (pid, cgroup, e))
+    try:
+      cgroups.remove(cgroup)
+    except OSError, e:
+      logging.warn("Could not remove %s: %s" % (cgroup, e))
+      continue
+    undone.append(effect)
+  return undone
+
+def _remove_netem(effects):
+  # netem records its qdiscs through this module
+  from gremlins import netem
+  devices = sorted(set(device for effect in effects for device in effect["devices"]))
+  try:
+    netem.remove_leftovers(devices)
+  except Exception, e:
+    logging.warn("Could not remove qdiscs from %s: %s" % (", ".join(devices), e))
+    return []
+  return effects
+
+def _destroy_ipsets(effects):
+  try:
+    existing = set(ipsets.list_names())
+  except Exception, e:
+    logging.warn("Could not list ipsets: %s" % e)
+    return []
+  failed = set()
+  # Destroy one at a time, so one that is still in use doesn't stop the rest
+  for name in sorted(set(name for effect in effects for name in effect["sets"]) & existing):
+    try:
+      ipsets.destroy([name])
+    except Exception, e:
+      logging.warn("Could not destroy ipset %s: %s" % (name, e))
+      failed.add(name)
+  return [effect for effect in effects if not failed.intersection(effect["sets"])]
+
+def _remove_files(effects):
+  undone = []
+  for effect in effects:
+    try:
+      os.unlink(effect["path"])
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        logging.warn("Could not remove %s: %s" % (effect["path"], e))
+        continue
+    undone.append(effect)
+  return undone
+
+def _remove_chains(effects):
+  names = set()
+  for effect in effects:
+    if effect.get("chains") is None:
+      # Logged by a gremlin that didn't name its chains: sweep them all
+      names = None
+      break
+    names.update(effect["chains"])
+  removed = iptables.remove_gremlin_chains(names)
+  if removed:
+    logging.info("Removed gremlin chains %s" % ", ".join(removed))
+  return effects
+
+def _append(path, record):
+  fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+  try:
+    os.write(fd, _line(record))
+    os.fdatasync(fd)
+  finally:
+    os.close(fd)
+
+def recover(path):
+  """
+  Undo every effect in the given log that was never undone and whose
+  gremlin is no longer running, and record what was undone in the log.
+  The log is compacted afterwards if no gremlin is writing to it.
+
+  @returns True if every such effect was undone
+  """
+  effects, opens = _read(path)
+  dead = [effect for effect in effects
+          if not _alive(_writer(effect), opens.get(_writer(effect)))]
+  logging.info("Recovering %d effects from %s" % (len(dead), path))
+  if len(dead) < len(effects):
+    logging.info("Leaving %d effects of gremlins still running" % (len(effects) - len(dead)))
+  by_kind = {}
+  for effect in dead:
+    by_kind.setdefault(effect["kind"], []).append(effect)
+
+  # Resume stopped daemons first: they are the most visible damage.
+  # Chains have to go before the ipsets they reference.
+  steps = [("stop", _resume), ("chains", _remove_chains), ("ipsets", _destroy_ipsets),
+           ("cgroup", _restore_cgroups), ("netem", _remove_netem), ("file", _remove_files),
+           ("restart", _restart)]
+  undone = []
+  for kind, step in steps:
+    if not by_kind.get(kind):
+      continue
+    try:
+      undone.extend(step(by_kind[kind]))
+    except Exception:
+      logging.exception("Failed to undo %s effects" % kind)
+
+  if undone:
+    _append(path, {"op": "undone", "ids": [effect["id"] for effect in undone]})
+  compact(path)
+  return len(undone) == len(dead)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+ControlServer tests: where it may listen, and request signing.
+"""
+import httplib
+import json
+import unittest
+
+from gremlins import control, scheduler
+
+class ControlServerTest(unittest.TestCase):
+  def serve(self, namespace, host="127.0.0.1", secret=None):
+    sched = scheduler.Scheduler(workers=1)
+    self.addCleanup(sched.stop)
+    server = control.ControlServer(0, namespace, host=host, sched=sched,
+                                   registry={"noop": lambda: None}, secret=secret)
+    server.start()
+    self.addCleanup(server.stop)
+    return server
+
+  def request(self, server, method, path, body="", headers={}):
+    conn = httplib.HTTPConnection("127.0.0.1", server.port)
+    self.addCleanup(conn.close)
+    headers = dict(headers, **{"Content-Type": "application/x-www-form-urlencoded"})
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+  def test_defaults_to_loopback(self):
+    server = self.serve({})
+    self.assertEqual(server.server.server_address[0], "127.0.0.1")
+
+  def test_evaluating_elsewhere_needs_secret(self):
+    self.assertRaises(ValueError, control.ControlServer, 0, {}, host="0.0.0.0")
+    self.serve({}, host="0.0.0.0", secret="s3cret")
+    # Registry names only, so there is nothing to evaluate
+    self.serve(None, host="0.0.0.0")
+
+  def test_registry_only(self):
+    server = self.serve(None)
+    status, body = self.request(server, "POST", "/faults", "fault=__import__('os')")
+    self.assertEqual(status, 400)
+    status, body = self.request(server, "POST", "/faults", "fault=noop")
+    self.assertEqual(status, 202)
+
+  def test_signed_requests(self):
+    server = self.serve({}, secret="s3cret")
+    body = "fault=noop"
+    status, _ = self.request(server, "POST", "/faults", body)
+    self.assertEqual(status, 401)
+    wrong = control.sign_request("other", "POST", "/faults", body)
+    status, _ = self.request(server, "POST", "/faults", body,
+                             {control.SIGNATURE_HEADER: wrong})
+    self.assertEqual(status, 401)
+    # A signature covers the body it was made for
+    signature = control.sign_request("s3cret", "POST", "/faults", body)
+    status, _ = self.request(server, "POST", "/faults", "fault=1",
+                             {control.SIGNATURE_HEADER: signature})
+    self.assertEqual(status, 401)
+    status, record = self.request(server, "POST", "/faults", body,
+                                  {control.SIGNATURE_HEADER: signature})
+    self.assertEqual(status, 202)
+    status, _ = self.request(server, "GET", "/jobs")
+    self.assertEqual(status, 401)
+    status, jobs = self.request(server, "GET", "/jobs",
+                                headers={control.SIGNATURE_HEADER:
+                                         control.sign_request("s3cret", "GET", "/jobs")})
+    self.assertEqual(status, 200)
+    self.assertEqual([job["job"] for job in jobs["jobs"]], [record["job"]])
+
+
+if __name__ == "__main__":
+  unittest.main()
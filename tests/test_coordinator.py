@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Coordinator tests, against agents on localhost driving a FakeBackend.
+
+  $ python -m unittest discover tests
+"""
+import unittest
+
+from gremlins import agent, backends, coordinator, faults, procutils, runtime
+
+# How closely agents on one host should line up a fault
+ALIGNMENT = 0.01
+
+class CoordinatorTest(unittest.TestCase):
+  AGENTS = 3
+
+  def setUp(self):
+    self.backend = backends.FakeBackend()
+    self.backend.add_daemon("HRegionServer", ports=[60020])
+    self.previous_backend = procutils.set_backend(self.backend)
+    self.previous_runtime = runtime.current()
+    self.runtime = runtime.Runtime()
+    runtime.install(self.runtime)
+    registry = {"pause": faults.pause_daemons(["HRegionServer"], 1)}
+    self.agents = [agent.Agent(0, None, registry=registry, secret="s3cret")
+                   for i in xrange(self.AGENTS)]
+    for gremlin_agent in self.agents:
+      gremlin_agent.start()
+    self.addresses = ["127.0.0.1:%d" % a.port for a in self.agents]
+
+  def tearDown(self):
+    for gremlin_agent in self.agents:
+      gremlin_agent.stop()
+    runtime.install(self.previous_runtime)
+    procutils.set_backend(self.previous_backend)
+
+  def coordinator(self, **kwargs):
+    coord = coordinator.Coordinator(self.addresses, secret="s3cret", **kwargs)
+    self.addCleanup(coord.close)
+    coord.sync_clocks()
+    return coord
+
+  def test_fire_all_aligns_agents(self):
+    coord = self.coordinator()
+    results = coord.fire_all("pause")
+    fired = [response["fired_at"] for client, response, error in results]
+    self.assertEqual(len(fired), self.AGENTS)
+    self.assertTrue(max(fired) - min(fired) < ALIGNMENT,
+                    "agents fired %.1fms apart" % ((max(fired) - min(fired)) * 1000))
+    self.assertEqual(coord.count_active(), self.AGENTS)
+
+  def test_max_active(self):
+    coord = self.coordinator(max_active=self.AGENTS - 1)
+    self.assertRaises(Exception, coord.fire_all, "pause")
+    self.assertEqual(coord.count_active(), 0)
+    coord.fire_all("pause", agents=self.addresses[:1])
+    self.assertEqual(coord.count_active(), 1)
+    self.assertRaises(Exception, coord.fire_all, "pause", agents=self.addresses[1:])
+    coord.cancel_all()
+    self.assertEqual(coord.count_active(), 0)
+    coord.fire_all("pause", agents=self.addresses[1:])
+    self.assertEqual(coord.count_active(), self.AGENTS - 1)
+
+  def test_unknown_fault_fails(self):
+    coord = self.coordinator()
+    try:
+      coord.fire_all("faults.kill_daemons(['HRegionServer'], 9, 0)")
+    except coordinator.FireError, e:
+      self.assertEqual(len(e.failed), self.AGENTS)
+      self.assertEqual(e.unknown, [])
+    else:
+      self.fail("an agent fired a fault not in its registry")
+    self.assertEqual(coord.count_active(), 0)
+
+  def test_wrong_secret_refused(self):
+    client = coordinator.AgentClient(self.addresses[0], timeout=5, secret="wrong")
+    self.addCleanup(client.close)
+    self.assertRaises(coordinator.AgentError, client.request, "ping")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Latency probe tests, against the local echo server.
+"""
+import time
+import unittest
+
+from gremlins import latency, runtime
+
+class Hold(runtime.Fault):
+  """A fault that does nothing for its hold."""
+  def __init__(self, seconds):
+    self.duration = seconds
+
+  def __repr__(self):
+    return "hold(%r)" % self.duration
+
+  def inject(self, activation):
+    pass
+
+
+class LatencyProbeTest(unittest.TestCase):
+  def setUp(self):
+    self.server = latency.EchoServer()
+    self.server.start()
+    self.addCleanup(self.server.stop)
+    self.endpoint = ("127.0.0.1", self.server.port)
+
+  def probe(self, seconds, **kwargs):
+    probe = latency.LatencyProbe([self.endpoint], rate=100, connections=2, timeout=1, **kwargs)
+    probe.start()
+    try:
+      time.sleep(seconds)
+    finally:
+      probe.stop()
+    return dict((row["fault"], row) for row in probe.summary())
+
+  def test_modes(self):
+    for mode in latency.MODES:
+      rows = self.probe(0.5, mode=mode)
+      row = rows[latency.NO_FAULT]
+      self.assertTrue(row["probes"] > 20, "%s: only %d probes" % (mode, row["probes"]))
+      self.assertEqual(row["errors"], 0)
+      self.assertTrue(0 < row["p50"] <= row["p99"] <= row["p999"])
+
+  def test_charged_to_faults_in_effect(self):
+    previous = runtime.current()
+    fault_runtime = runtime.Runtime()
+    runtime.install(fault_runtime)
+    self.addCleanup(runtime.install, previous)
+    self.addCleanup(fault_runtime.shutdown)
+    probe = latency.LatencyProbe([self.endpoint], rate=100, mode="echo", timeout=1)
+    probe.start()
+    try:
+      time.sleep(0.3)
+      Hold(0.5)()
+      time.sleep(1.0)
+    finally:
+      probe.stop()
+    rows = dict((row["fault"], row) for row in probe.summary())
+    self.assertTrue(rows["hold"]["probes"] > 10)
+    self.assertTrue(rows[latency.NO_FAULT]["probes"] > 10)
+
+  def test_errors_counted(self):
+    self.server.stop()
+    rows = self.probe(0.3, mode="connect")
+    row = rows[latency.NO_FAULT]
+    self.assertTrue(row["errors"] > 0)
+    self.assertEqual(row["error_rate"], 1.0)
+    self.assertEqual(row["p50"], None)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+netem tests: the tc commands for each band, and the band allocator, on
+a FakeBackend.
+"""
+import unittest
+
+from gremlins import backends, netem, procutils
+
+ARGS = netem.netem_args(delay_ms=100)
+
+class NetemTest(unittest.TestCase):
+  def setUp(self):
+    self.backend = backends.FakeBackend()
+    self.addCleanup(procutils.set_backend, procutils.set_backend(self.backend))
+    self.addCleanup(netem._bands.clear)
+    self.addCleanup(netem._roots.clear)
+
+  def qdisc_parents(self, device):
+    return sorted(parent for qdisc_device, parent in self.backend.qdiscs
+                  if qdisc_device == device and parent != "root")
+
+  def test_band_commands_are_hex(self):
+    commands = netem._filter_commands("eth0", 10, [60020])
+    self.assertTrue(commands)
+    for command in commands:
+      self.assertTrue(command.endswith("flowid 7000:a"), command)
+    self.assertEqual(netem._classid(16), "7000:10")
+    self.assertEqual(netem._netem_handle(10), "700a:")
+
+  def test_allocates_every_band(self):
+    slots = [netem.install(["eth0"], [60000 + i], ARGS) for i in xrange(netem.BANDS - 1)]
+    self.assertEqual([slot for [slot] in slots],
+                     [["eth0", band] for band in xrange(2, netem.BANDS + 1)])
+    self.assertEqual(self.qdisc_parents("eth0"),
+                     sorted("7000:%x" % band for band in xrange(2, netem.BANDS + 1)))
+    self.assertEqual(self.backend.qdiscs[("eth0", "7000:a")].split()[4:6],
+                     ["handle", "700a:"])
+    for [device, band] in [slot for [slot] in slots]:
+      flowids = set(spec.split()[-1] for spec in
+                    self.backend.filters[("eth0", netem._filter_prios(band)[0])])
+      self.assertEqual(flowids, set(["7000:%x" % band]))
+    self.assertRaises(Exception, netem.install, ["eth0"], [61000], ARGS)
+
+    # Freeing band 10 removes its qdisc and filters, and nothing else
+    netem.uninstall(slots[8])
+    self.assertFalse("7000:a" in self.qdisc_parents("eth0"))
+    self.assertEqual(len(self.qdisc_parents("eth0")), netem.BANDS - 2)
+    for prio in netem._filter_prios(10):
+      self.assertFalse(("eth0", prio) in self.backend.filters)
+    # and it is the one handed out next
+    again = netem.install(["eth0"], [61000], ARGS)
+    self.assertEqual(again, [["eth0", 10]])
+
+    for slot in slots[:8] + [again] + slots[9:]:
+      netem.uninstall(slot)
+    self.assertEqual(self.backend.qdiscs, {})
+    self.assertEqual(self.backend.filters, {})
+    self.assertEqual(netem._bands["eth0"], set())
+
+  def test_refuses_configured_root(self):
+    netem.batch(["qdisc replace dev eth0 root handle 1: fq"])
+    self.assertRaises(Exception, netem.install, ["eth0"], [60020], ARGS)
+    self.assertEqual(netem._bands["eth0"], set())
+
+
+if __name__ == "__main__":
+  unittest.main()
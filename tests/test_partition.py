@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+partition_hosts tests, on a FakeBackend: which hosts and networks end up
+in the partition's set.
+"""
+import unittest
+
+from gremlins import backends, faults, procutils, runtime
+
+# This host, as far as these tests are concerned
+LOCAL = set(["127.0.0.1", "10.0.0.5"])
+
+class PartitionHostsTest(unittest.TestCase):
+  def setUp(self):
+    self.backend = backends.FakeBackend()
+    self.addCleanup(procutils.set_backend, procutils.set_backend(self.backend))
+    self.addCleanup(setattr, faults, "_local_addresses", faults._local_addresses)
+    faults._local_addresses = lambda: set(LOCAL)
+
+  def partition(self, groups):
+    fault = faults.partition_hosts(groups, 60)
+    activation = runtime.Activation(fault)
+    fault.inject(activation)
+    return activation
+
+  def members(self):
+    return sorted(entry for set_type, entries in self.backend.ipsets.values()
+                  for entry in entries)
+
+  def test_networks(self):
+    activation = self.partition([["10.0.0.5"], ["10.0.1.7/24", "192.0.2.1"]])
+    self.assertEqual(activation.details["hosts"], ["10.0.1.0/24", "192.0.2.1"])
+    self.assertEqual(self.members(), ["10.0.1.0/24", "192.0.2.1"])
+
+  def test_own_group_found_by_network(self):
+    activation = self.partition([["10.0.0.0/24"], ["192.0.2.1"]])
+    self.assertEqual(activation.details["hosts"], ["192.0.2.1"])
+
+  def test_local_addresses_skipped(self):
+    activation = self.partition([["10.0.0.5", "127.0.0.1", "localhost", "192.0.2.1"]])
+    self.assertEqual(activation.details["hosts"], ["192.0.2.1"])
+    self.assertEqual(self.members(), ["192.0.2.1"])
+
+  def test_local_networks_refused(self):
+    for net in ("10.0.0.0/16", "127.0.0.0/8", "0.0.0.0/0"):
+      self.assertRaises(ValueError, self.partition, [[net]])
+    self.assertEqual(self.backend.ipsets, {})
+
+  def test_bad_networks_refused(self):
+    for net in ("10.0.0.0/33", "10.0.0/8", "10.0.0.0/x"):
+      self.assertRaises(ValueError, faults.partition_hosts, [[net]], 60)
+
+
+if __name__ == "__main__":
+  unittest.main()
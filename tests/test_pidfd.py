@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+ExitWatcher tests, against real child processes.
+"""
+import signal
+import subprocess
+import time
+import unittest
+
+from gremlins import pidfd
+
+class ExitWatcherTest(unittest.TestCase):
+  def spawn(self):
+    child = subprocess.Popen(["sleep", "60"])
+    def reap():
+      if child.poll() is None:
+        child.kill()
+        child.wait()
+    self.addCleanup(reap)
+    return child
+
+  def test_timeout_returns(self):
+    child = self.spawn()
+    watcher = pidfd.ExitWatcher([child.pid])
+    self.addCleanup(watcher.close)
+    for timeout in (0, 0.05):
+      start = time.time()
+      self.assertEqual(watcher.wait(timeout), {})
+      self.assertTrue(time.time() - start < 1)
+    self.assertEqual(watcher.running(), [child.pid])
+
+  def test_sees_exit(self):
+    child = self.spawn()
+    watcher = pidfd.ExitWatcher([child.pid])
+    self.addCleanup(watcher.close)
+    child.send_signal(signal.SIGTERM)
+    child.wait()
+    self.assertEqual(watcher.wait(5).keys(), [child.pid])
+    self.assertEqual(watcher.running(), [])
+
+
+if __name__ == "__main__":
+  unittest.main()
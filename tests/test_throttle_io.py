@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+throttle_io tests, on a FakeBackend.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from gremlins import backends, cgroups, faults, procutils, runtime
+
+class ThrottleIOTest(unittest.TestCase):
+  def setUp(self):
+    self.backend = backends.FakeBackend()
+    self.pid = self.backend.add_daemon("DataNode")
+    self.addCleanup(procutils.set_backend, procutils.set_backend(self.backend))
+
+  def test_device_looked_up_when_fired(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory, True)
+    data_dir = os.path.join(directory, "data")
+    # Building the fault must not need the path to exist yet
+    fault = faults.throttle_io(["DataNode"], data_dir, 60, wbps=1048576)
+    os.mkdir(data_dir)
+    activation = runtime.Activation(fault)
+    fault.inject(activation)
+    st = os.stat(data_dir)
+    number = "%d:%d" % (os.major(st.st_dev), os.minor(st.st_dev))
+    self.assertEqual(activation.details["device"], number)
+    io_max = cgroups.path(activation.details["cgroup"], "io.max")
+    self.assertEqual(self.backend.files[io_max], "%s wbps=1048576" % number)
+    fault.revert(activation)
+    self.assertEqual(cgroups.cgroup_of(self.pid), "/")
+
+  def test_missing_device_fails_when_fired(self):
+    fault = faults.throttle_io(["DataNode"], "/nonexistent/gremlins", 60, rbps=1024)
+    self.assertRaises(OSError, fault.inject, runtime.Activation(fault))
+    self.assertEqual(cgroups.cgroup_of(self.pid), "/")
+
+
+if __name__ == "__main__":
+  unittest.main()
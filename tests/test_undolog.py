@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Undo log tests: effects recorded by a gremlin that then dies mid-fault
+are undone by recover(), on a FakeBackend.
+"""
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from gremlins import backends, cgroups, faults, iptables, netem, procutils, runtime, undolog
+
+def dead_pid():
+  """Return the pid of a process that has exited."""
+  child = subprocess.Popen(["true"])
+  child.wait()
+  return child.pid
+
+
+class RecoverTest(unittest.TestCase):
+  def setUp(self):
+    self.backend = backends.FakeBackend()
+    self.pid = self.backend.add_daemon("HRegionServer", ports=[60020, 60030])
+    self.previous_backend = procutils.set_backend(self.backend)
+    self.addCleanup(procutils.set_backend, self.previous_backend)
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+    self.path = os.path.join(self.directory, "gremlins.undo")
+    self.log = undolog.UndoLog(self.path)
+    undolog.install(self.log)
+    self.addCleanup(undolog.install, None)
+
+  def inject(self, fault):
+    activation = runtime.Activation(fault)
+    fault.inject(activation)
+    return activation
+
+  def crash(self):
+    """Leave the log as a gremlin killed mid-fault would: closed, by a dead pid."""
+    undolog.install(None)
+    self.log.close()
+    pid = dead_pid()
+    records = []
+    for line in open(self.path):
+      record = json.loads(line)
+      if record["op"] == "open":
+        record["pid"] = pid
+      elif record["op"] == "effect":
+        record["id"] = "%d-%s" % (pid, record["id"].split("-", 1)[1])
+      records.append(json.dumps(record))
+    with open(self.path, "w") as f:
+      f.write("".join(record + "\n" for record in records))
+    # A new gremlin starts with none of the dead one's state
+    netem._bands.clear()
+    netem._roots.clear()
+
+  def gremlin_chains(self):
+    return [chain for chain in self.backend.chains if chain.startswith("gremlin_")]
+
+  def assertRecovered(self):
+    self.assertTrue(undolog.recover(self.path))
+    self.assertEqual(undolog.pending(self.path), [])
+
+  def test_fail_network(self):
+    self.inject(faults.fail_network("192.0.2.1", 60))
+    self.assertEqual(len(self.gremlin_chains()), 2)
+    self.crash()
+    self.assertRecovered()
+    self.assertEqual(self.gremlin_chains(), [])
+    self.assertEqual(self.backend.chains["INPUT"], [])
+    self.assertEqual(self.backend.chains["OUTPUT"], [])
+
+  def test_unnamed_chains_swept(self):
+    # Logs from before chains were named up front record none
+    undolog.record([], "chains", chains=None)
+    iptables.install_gremlin_network_failure("192.0.2.1")
+    self.crash()
+    self.assertRecovered()
+    self.assertEqual(self.gremlin_chains(), [])
+
+  def test_drop_packets(self):
+    self.inject(faults.drop_packets_to_daemons(["HRegionServer"], 60))
+    self.assertEqual(len(self.backend.ipsets), 1)
+    self.crash()
+    self.assertRecovered()
+    self.assertEqual(self.gremlin_chains(), [])
+    self.assertEqual(self.backend.chains["INPUT"], [])
+    self.assertEqual(self.backend.ipsets, {})
+
+  def test_ipsets_without_chains(self):
+    # Sets are recorded before they are created; a crash can come between
+    faults.drop_packets_to_daemons(["HRegionServer"], 60)._build(hook=False)
+    for chain in self.gremlin_chains():
+      del self.backend.chains[chain]
+    self.crash()
+    self.assertRecovered()
+    self.assertEqual(self.backend.ipsets, {})
+
+  def test_netem(self):
+    self.inject(faults.delay_packets_to_daemons(["HRegionServer"], 100, 60, devices=["eth0"]))
+    self.assertEqual(netem.root_qdisc("eth0")[1], netem.ROOT_HANDLE + ":")
+    self.crash()
+    self.assertRecovered()
+    self.assertEqual(netem.root_qdisc("eth0")[1], netem.DEFAULT_HANDLE)
+    self.assertEqual(self.backend.filters, {})
+
+  def test_cgroup(self):
+    activation = self.inject(faults.throttle_cpu(["HRegionServer"], 0.5, 60))
+    cgroup = activation.details["cgroup"]
+    self.assertEqual(cgroups.cgroup_of(self.pid), cgroup)
+    self.crash()
+    self.assertRecovered()
+    self.assertEqual(cgroups.cgroup_of(self.pid), "/")
+    self.assertFalse(cgroups.path(cgroup) in self.backend.dirs)
+
+  def test_stop(self):
+    self.inject(faults.pause_daemons(["HRegionServer"], 60))
+    self.assertTrue(self.backend.processes[self.pid].stopped)
+    self.crash()
+    self.assertRecovered()
+    self.assertFalse(self.backend.processes[self.pid].stopped)
+
+  def test_live_writer_left_alone(self):
+    self.inject(faults.drop_packets_to_daemons(["HRegionServer"], 60))
+    chains = self.gremlin_chains()
+    self.assertTrue(undolog.recover(self.path))
+    self.assertEqual(self.gremlin_chains(), chains)
+    self.assertEqual(len(undolog.pending(self.path)), 2)
+
+
+class UndoLogTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+    self.path = os.path.join(self.directory, "gremlins.undo")
+
+  def test_pending(self):
+    log = undolog.UndoLog(self.path)
+    first = log.record("file", path="/tmp/a")
+    second = log.record("file", path="/tmp/b")
+    log.undone([first])
+    self.assertEqual([effect["id"] for effect in undolog.pending(self.path)], [second])
+    log.close()
+
+  def test_compacts_only_without_writers(self):
+    log = undolog.UndoLog(self.path)
+    ids = [log.record("file", path="/tmp/%d" % i) for i in xrange(10)]
+    log.undone(ids[:9])
+    self.assertFalse(undolog.compact(self.path))
+    log.close()
+    self.assertTrue(undolog.compact(self.path))
+    lines = [json.loads(line) for line in open(self.path)]
+    # The writer's open record is kept with its one pending effect
+    self.assertEqual([line["op"] for line in lines], ["open", "effect"])
+    self.assertEqual(lines[1]["id"], ids[9])
+
+  def test_torn_record_ignored(self):
+    log = undolog.UndoLog(self.path)
+    log.record("file", path="/tmp/a")
+    log.close()
+    with open(self.path, "a") as f:
+      f.write('{"op":"effect","id":"1-')
+    self.assertEqual(len(undolog.pending(self.path)), 1)
+
+
+if __name__ == "__main__":
+  unittest.main()